@@ -0,0 +1,101 @@
+"""
+Admission control: per-class concurrency limits with bounded wait queues
+
+Each traffic class (recognition, background removal, health) gets its own
+AdmissionLimit, so a flood of one kind of request cannot take the capacity of
+another. A request runs if its class has a free slot, otherwise it waits in a
+FIFO queue for at most max_wait seconds. Requests are rejected right away when
+the queue is full, and dropped when the client's deadline passes before they
+start, so overload shows up as fast 503s instead of timeouts.
+"""
+import collections
+import threading
+import time
+
+import metrics
+
+
+class Rejected(Exception):
+    """A request was not admitted; status is 503 (overloaded) or 504 (deadline passed)"""
+
+    def __init__(self, message, status=503, retry_after=None, reason='queue_full'):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionLimit:
+    """
+    max_concurrent requests run at once (0 = unlimited); up to max_queue more
+    wait at most max_wait seconds each. retry_after is the Retry-After hint
+    (seconds) sent with 503s.
+    """
+
+    def __init__(self, name, max_concurrent, max_queue=0, max_wait=2.0, retry_after=1):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.active = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _update_gauges(self):
+        metrics.ADMISSION_ACTIVE.set(self.active, budget=self.name)
+        metrics.ADMISSION_QUEUED.set(len(self._waiters), budget=self.name)
+
+    def _reject(self, reason):
+        metrics.ADMISSION_REJECTED.inc(budget=self.name, reason=reason)
+        if reason == 'deadline':
+            return Rejected("Request deadline exceeded", 504, reason=reason)
+        return Rejected(f"Server busy ({self.name}), retry later", 503, self.retry_after, reason)
+
+    def acquire(self, deadline=None):
+        """
+        Take a slot, waiting in line if needed; deadline is a time.time() value
+        after which the client no longer wants the answer. Raises Rejected.
+        """
+        if deadline is not None and time.time() >= deadline:
+            raise self._reject('deadline')
+
+        with self._lock:
+            if not self.max_concurrent or (self.active < self.max_concurrent and not self._waiters):
+                self.active += 1
+                self._update_gauges()
+                return
+            if len(self._waiters) >= self.max_queue:
+                raise self._reject('queue_full')
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+            self._update_gauges()
+
+        timeout = self.max_wait
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.time())
+        if waiter.wait(max(0.0, timeout)):
+            return
+
+        with self._lock:
+            # release() may have handed us the slot just as the wait timed out
+            if waiter.is_set():
+                return
+            self._waiters.remove(waiter)
+            self._update_gauges()
+        timed_out = deadline is not None and time.time() >= deadline
+        raise self._reject('deadline' if timed_out else 'wait_timeout')
+
+    def release(self):
+        """Give the slot to the longest waiting request, or free it"""
+        with self._lock:
+            if self._waiters:
+                # The slot passes straight to the waiter; active is unchanged
+                self._waiters.popleft().set()
+            else:
+                self.active -= 1
+            self._update_gauges()
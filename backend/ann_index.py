@@ -0,0 +1,239 @@
+"""
+Approximate nearest-neighbour index for large galleries (IVF, pure NumPy)
+
+The gallery is partitioned with k-means into inverted lists. A query only
+scans the nprobe lists whose centroids are closest to it, and the shortlist is
+re-ranked with exact Euclidean distances, so a returned distance means exactly
+the same thing as with FaceMatcher and the match tolerance keeps its meaning.
+Recall (not precision) is what nprobe trades for speed; see
+benchmarks/ann_recall.py.
+"""
+import numpy as np
+
+from face_matcher import as_encoding_matrix, pairwise_distances, top_k_smallest
+
+
+def kmeans(data, n_clusters, iterations=20, seed=0):
+    """Plain Lloyd's k-means, returns the (n_clusters, dim) centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = np.argmin(pairwise_distances(data, centroids), axis=1)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed empty clusters from random points so no list stays unused
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index with exact re-ranking
+
+    Supports the same build/add/remove/search interface as FaceMatcher.
+    Galleries smaller than min_train_size are searched exhaustively.
+    """
+
+    def __init__(self, n_lists=None, n_probe=8, min_train_size=1000, train_sample_size=100000, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.train_sample_size = train_sample_size
+        self.seed = seed
+        self.centroids = None
+        self._reset_lists(0)
+
+    def _reset_lists(self, n_lists):
+        self.list_ids = [np.empty(0, dtype=np.int64) for _ in range(n_lists)]
+        self.list_vectors = [np.empty((0, 128), dtype=np.float32) for _ in range(n_lists)]
+        self.list_norms = [np.empty(0, dtype=np.float32) for _ in range(n_lists)]
+        self.id_to_list = {}
+
+    def __len__(self):
+        return len(self.id_to_list)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def build(self, encodings, ids=None):
+        """Train the coarse quantizer on the encodings and index all of them"""
+        encodings = as_encoding_matrix(encodings)
+        if ids is None:
+            ids = np.arange(len(encodings))
+
+        self.centroids = None
+        self._reset_lists(1)
+        if len(encodings) >= self.min_train_size:
+            self.train(encodings)
+        self.add(encodings, ids)
+
+    def train(self, encodings):
+        """Learn the list centroids from (a sample of) the encodings"""
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(len(encodings))))
+        n_lists = min(n_lists, len(encodings))
+
+        rng = np.random.default_rng(self.seed)
+        sample = encodings
+        if len(encodings) > self.train_sample_size:
+            sample = encodings[rng.choice(len(encodings), self.train_sample_size, replace=False)]
+
+        self.centroids = kmeans(sample, n_lists, seed=self.seed)
+        self._reset_lists(n_lists)
+
+    def empty_copy(self):
+        """A new, empty index that shares this index's trained centroids"""
+        index = IVFIndex(self.n_lists, self.n_probe, self.min_train_size, self.train_sample_size, self.seed)
+        index.centroids = self.centroids
+        index._reset_lists(len(self.list_ids))
+        return index
+
+    def copy(self):
+        """
+        A copy that can be changed without affecting this index
+
+        add() and remove() replace list arrays instead of writing into them,
+        so the arrays are shared; only the containers are copied.
+        """
+        index = self.empty_copy()
+        index.list_ids = list(self.list_ids)
+        index.list_vectors = list(self.list_vectors)
+        index.list_norms = list(self.list_norms)
+        index.id_to_list = dict(self.id_to_list)
+        return index
+
+    @property
+    def ids(self):
+        """Every id, in list order (the order save() writes them in)"""
+        return np.concatenate(self.list_ids) if self.list_ids else np.empty(0, dtype=np.int64)
+
+    def renumber(self, ids):
+        """Replace the ids with new ones, given in the order of the ids property"""
+        ids = np.asarray(ids, dtype=np.int64)
+        self.id_to_list = {}
+        start = 0
+        for list_no, old_ids in enumerate(self.list_ids):
+            self.list_ids[list_no] = ids[start:start + len(old_ids)]
+            start += len(old_ids)
+            for encoding_id in self.list_ids[list_no]:
+                self.id_to_list[int(encoding_id)] = list_no
+
+    def _assign(self, encodings):
+        if not self.is_trained:
+            return np.zeros(len(encodings), dtype=np.int64)
+        return np.argmin(pairwise_distances(encodings, self.centroids), axis=1)
+
+    def add(self, encodings, ids):
+        """Add encodings to the lists of their nearest centroids"""
+        encodings = as_encoding_matrix(encodings)
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(encodings) == 0:
+            return
+
+        assignment = self._assign(encodings)
+        for list_no in np.unique(assignment):
+            members = assignment == list_no
+            vectors = encodings[members]
+            self.list_ids[list_no] = np.concatenate([self.list_ids[list_no], ids[members]])
+            self.list_vectors[list_no] = np.vstack([self.list_vectors[list_no], vectors])
+            self.list_norms[list_no] = np.concatenate(
+                [self.list_norms[list_no], np.einsum('ij,ij->i', vectors, vectors)]
+            )
+            for encoding_id in ids[members]:
+                self.id_to_list[int(encoding_id)] = int(list_no)
+
+    def remove(self, ids):
+        """Remove encodings by id; unknown ids are ignored"""
+        by_list = {}
+        for encoding_id in ids:
+            list_no = self.id_to_list.pop(int(encoding_id), None)
+            if list_no is not None:
+                by_list.setdefault(list_no, []).append(int(encoding_id))
+
+        for list_no, removed in by_list.items():
+            keep = ~np.isin(self.list_ids[list_no], removed)
+            self.list_ids[list_no] = self.list_ids[list_no][keep]
+            self.list_vectors[list_no] = self.list_vectors[list_no][keep]
+            self.list_norms[list_no] = self.list_norms[list_no][keep]
+
+    def search(self, queries, k=1, n_probe=None):
+        """
+        Find approximately the k nearest encodings for each query
+
+        Returns (ids, distances) of shape (n_queries, k); rows with fewer than
+        k candidates are padded with id -1 and distance inf.
+        """
+        queries = as_encoding_matrix(queries)
+        n_probe = min(n_probe or self.n_probe, len(self.list_ids))
+
+        out_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        out_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        if len(self) == 0 or len(queries) == 0:
+            return out_ids, out_distances
+
+        if self.is_trained:
+            probes, _ = top_k_smallest(pairwise_distances(queries, self.centroids), n_probe)
+        else:
+            probes = np.zeros((len(queries), 1), dtype=np.int64)
+
+        for row, (query, lists) in enumerate(zip(queries, probes)):
+            vectors = [self.list_vectors[i] for i in lists]
+            ids = np.concatenate([self.list_ids[i] for i in lists])
+            if len(ids) == 0:
+                continue
+            norms = np.concatenate([self.list_norms[i] for i in lists])
+
+            # Exact re-ranking of the shortlist
+            distances = pairwise_distances(query[None, :], np.vstack(vectors), norms)
+            positions, best = top_k_smallest(distances, k)
+            out_ids[row, :positions.shape[1]] = ids[positions[0]]
+            out_distances[row, :positions.shape[1]] = best[0]
+
+        return out_ids, out_distances
+
+    def save(self, path, **metadata):
+        """Persist the index to an .npz file; extra keyword arrays are stored alongside"""
+        lengths = np.array([len(ids) for ids in self.list_ids], dtype=np.int64)
+        np.savez(
+            path,
+            centroids=self.centroids if self.is_trained else np.empty((0, 128), dtype=np.float32),
+            list_lengths=lengths,
+            ids=self.ids,
+            vectors=np.vstack(self.list_vectors) if self.list_vectors else np.empty((0, 128), dtype=np.float32),
+            params=np.array([self.n_lists or 0, self.n_probe, self.min_train_size], dtype=np.int64),
+            **metadata
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save(); returns (index, metadata)"""
+        with np.load(path) as data:
+            n_lists, n_probe, min_train_size = (int(v) for v in data['params'])
+            index = cls(n_lists=n_lists or None, n_probe=n_probe, min_train_size=min_train_size)
+            centroids = data['centroids']
+            index.centroids = centroids if len(centroids) else None
+
+            lengths = data['list_lengths']
+            index._reset_lists(len(lengths))
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            ids, vectors = data['ids'], data['vectors']
+            for list_no in range(len(lengths)):
+                start, end = offsets[list_no], offsets[list_no + 1]
+                index.list_ids[list_no] = ids[start:end].copy()
+                index.list_vectors[list_no] = np.ascontiguousarray(vectors[start:end])
+                index.list_norms[list_no] = np.einsum(
+                    'ij,ij->i', index.list_vectors[list_no], index.list_vectors[list_no]
+                )
+                for encoding_id in index.list_ids[list_no]:
+                    index.id_to_list[int(encoding_id)] = list_no
+
+            metadata = {key: data[key] for key in data.files
+                        if key not in ('centroids', 'list_lengths', 'ids', 'vectors', 'params')}
+        return index, metadata
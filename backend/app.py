@@ -1,23 +1,327 @@
-from flask import Flask, request, jsonify
+import os
+import threading
+import time
+# Startup is timed from here; the breakdown is logged once warm-up finishes
+STARTUP = time.perf_counter()
+
+from flask import Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
-import base64
-import io
 from PIL import Image
-import numpy as np
-from face_service import FaceRecognitionService
-from rembg import remove
+from admission import AdmissionLimit, Rejected
+from bg_removal import AUTO, BackgroundRemovalEngine, SessionUnavailable
+from face_service import FaceRecognitionService, valid_name
+from face_tracking import StreamSessionStore
+from gallery_shard import ShardClient, ShardUnavailable
+from image_decode import ImageDecodeError, ImageTooLarge, b64decode_image, decode_image, read_header
+from image_encode import OutputOptions
+from job_queue import JobQueue, QueueFull
+import metrics
+from mask_cache import MaskCache, composite, image_id_for, is_image_id
+from readiness import READY, Readiness
+from unknown_faces import UnknownFaceStore
+
+# What /ready reports; recognition needs the gallery, the rest only warms caches
+readiness = Readiness(
+    ('imports', 'gallery', 'encoder', 'detectors', 'background_model'),
+    required=('gallery', 'encoder'), started=STARTUP
+)
+readiness.record('imports', time.perf_counter() - STARTUP)
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for frontend communication
+# Enable CORS for frontend communication; raw image responses carry metadata in headers
+CORS(app, expose_headers=['X-Image-Id', 'X-Model', 'X-Background-Color', 'X-Cached', 'X-Shards-Missing'])
+
+# Limits for uploaded images, checked before their pixels are decoded
+MAX_IMAGE_BYTES = int(float(os.environ.get('MAX_IMAGE_MB', 20)) * 1024 * 1024)
+MAX_IMAGE_PIXELS = int(float(os.environ.get('MAX_IMAGE_MEGAPIXELS', 40)) * 1000000)
+# Recognition decodes larger images at most this long (0 = full resolution)
+RECOGNITION_MAX_SIDE = int(os.environ.get('RECOGNITION_MAX_SIDE', 0)) or None
 
 # Initialize face recognition service
-face_service = FaceRecognitionService()
+face_service = FaceRecognitionService(
+    tolerance=float(os.environ.get('FACE_TOLERANCE', 0.6)),
+    top_k=int(os.environ.get('FACE_TOP_K', 1)),
+    index=os.environ.get('FACE_INDEX', 'exact'),
+    n_probe=int(os.environ.get('FACE_INDEX_NPROBE', 8)),
+    storage=os.environ.get('FACE_STORAGE', 'float32'),
+    rescore=os.environ.get('FACE_RESCORE', '1') == '1',
+    detection_scale=float(os.environ.get('DETECTION_SCALE', 1.0)),
+    upsample=int(os.environ.get('DETECTION_UPSAMPLE', 1)),
+    adaptive_detection=os.environ.get('DETECTION_ADAPTIVE', '0') == '1',
+    detector=os.environ.get('FACE_DETECTOR', 'hog'),
+    allowed_detectors=os.environ.get('FACE_DETECTORS', os.environ.get('FACE_DETECTOR', 'hog') + ',haar').split(','),
+    detector_files={
+        'haar_cascade': os.environ.get('DETECTOR_HAAR_CASCADE') or None,
+        'lbp_cascade': os.environ.get('DETECTOR_LBP_CASCADE') or None,
+        'yunet_model': os.environ.get('DETECTOR_YUNET_MODEL') or None,
+    }
+)
+
+# With several server processes (gunicorn.conf.py) all of them map one gallery
+if os.environ.get('GALLERY_SHARED_DIR'):
+    face_service.use_shared_gallery(os.environ['GALLERY_SHARED_DIR'])
+
+# With gallery shards (gallery_shard.py) this process matches remotely and holds no gallery
+if os.environ.get('GALLERY_SHARDS'):
+    face_service.shards = ShardClient(
+        os.environ['GALLERY_SHARDS'].split(','),
+        timeout=float(os.environ.get('GALLERY_SHARD_TIMEOUT_MS', 500)) / 1000
+    )
+
+# Faces that match nobody are kept and clustered only when a directory is set
+unknown_faces = None
+if os.environ.get('UNKNOWN_FACES_DIR'):
+    unknown_faces = UnknownFaceStore(
+        os.environ['UNKNOWN_FACES_DIR'],
+        threshold=float(os.environ.get('UNKNOWN_CLUSTER_THRESHOLD', 0.5)),
+        min_size=int(os.environ.get('UNKNOWN_CLUSTER_MIN_SIZE', 3))
+    )
+    face_service.unknown_faces = unknown_faces
+
+# Background removal sessions are created lazily (or at startup by warm-up)
+bg_engine = BackgroundRemovalEngine(
+    default_model=os.environ.get('BG_MODEL', 'u2net'),
+    allowed_models=os.environ.get('BG_MODELS', 'u2net,u2netp,grabcut,edges').split(','),
+    pool_size=int(os.environ.get('BG_POOL_SIZE', 2)),
+    intra_op_threads=int(os.environ.get('BG_INTRA_OP_THREADS', 0)) or None,
+    inter_op_threads=int(os.environ.get('BG_INTER_OP_THREADS', 1)),
+    default_budget_ms=float(os.environ.get('BG_LATENCY_BUDGET_MS', 2000)),
+    session_timeout=float(os.environ.get('BG_SESSION_TIMEOUT', 30))
+)
+
+# gunicorn worker processes (gunicorn.conf.py); state that lives in one worker
+# can't be served by the others, see PER_WORKER_ENDPOINTS
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 1))
+
+# Computed alpha masks, so background color changes skip segmentation. With
+# several workers every mask is written to MASK_CACHE_DIR, shared by all of them
+mask_cache = MaskCache(
+    max_bytes=int(os.environ.get('MASK_CACHE_MB', 256)) * 1024 * 1024,
+    spill_dir=os.environ.get('MASK_CACHE_DIR') or None,
+    max_spill_bytes=int(os.environ.get('MASK_CACHE_DISK_MB', 2048)) * 1024 * 1024,
+    write_through=WEB_WORKERS > 1 and bool(os.environ.get('MASK_CACHE_DIR'))
+)
+
+# Worker pool for queued background removal jobs
+background_jobs = JobQueue(
+    workers=int(os.environ.get('JOB_WORKERS', 2)),
+    max_queue=int(os.environ.get('JOB_QUEUE_DEPTH', 32)),
+    result_ttl=float(os.environ.get('JOB_RESULT_TTL', 300)),
+    name='bg-jobs'
+)
+JOB_MAX_WAIT = 30.0
+JOB_RETRY_AFTER = 5
+
+# Live camera sessions for /stream
+stream_sessions = StreamSessionStore(
+    face_service,
+    idle_timeout=float(os.environ.get('STREAM_IDLE_TIMEOUT', 60)),
+    max_sessions=int(os.environ.get('STREAM_MAX_SESSIONS', 100)),
+    reverify_every=int(os.environ.get('STREAM_REVERIFY_EVERY', 15))
+)
+
+def admission_limit(budget, concurrency, queue, max_wait):
+    """AdmissionLimit for a traffic class, overridable with ADMIT_<BUDGET>_* variables"""
+    prefix = f"ADMIT_{budget.upper()}_"
+    max_wait = float(os.environ.get(prefix + 'MAX_WAIT', max_wait))
+    return AdmissionLimit(
+        budget,
+        max_concurrent=int(os.environ.get(prefix + 'CONCURRENCY', concurrency)),
+        max_queue=int(os.environ.get(prefix + 'QUEUE', queue)),
+        max_wait=max_wait,
+        retry_after=max(1, round(max_wait))
+    )
+
+# Separate budgets per traffic class, so one kind of request can't starve another
+CPU_COUNT = os.cpu_count() or 1
+admission_limits = {
+    'recognition': admission_limit('recognition', CPU_COUNT, 2 * CPU_COUNT, 2.0),
+    'background': admission_limit('background', bg_engine.pool_size, 2 * bg_engine.pool_size, 10.0),
+    'control': admission_limit('control', 4, 8, 2.0),
+    # Long polls hold their thread for up to JOB_MAX_WAIT, so they never queue
+    'poll': admission_limit('poll', 8, 0, JOB_RETRY_AFTER),
+    'health': admission_limit('health', 4, 8, 1.0),
+}
+# Every endpoint that can hold a server thread has a budget
+ADMISSION_BUDGETS = {
+    'recognize_face': 'recognition',
+    'recognize_batch': 'recognition',
+    'stream_frame': 'recognition',
+    'enroll_face': 'recognition',
+    'promote_unknown_cluster': 'recognition',
+    'remove_background': 'background',
+    'recolor_background': 'background',
+    'submit_background_job': 'control',
+    'create_stream_session': 'control',
+    'close_stream_session': 'control',
+    'get_known_faces': 'control',
+    'unenroll_face': 'control',
+    'get_unknown_clusters': 'control',
+    'get_unknown_crop': 'control',
+    'cluster_unknown_faces': 'control',
+    'get_job': 'poll',
+    'health_check': 'health',
+    'readiness_check': 'health',
+    'prometheus_metrics': 'health',
+}
+
+# Endpoints whose state (stream sessions, queued jobs, masks without a shared
+# MASK_CACHE_DIR) lives in the worker that created it. gunicorn gives each
+# request to any worker, so with several workers they are refused (501)
+# instead of failing at random with 404s.
+PER_WORKER_ENDPOINTS = {
+    'create_stream_session', 'stream_frame', 'close_stream_session', 'submit_background_job', 'get_job'
+}
+if not mask_cache.write_through:
+    PER_WORKER_ENDPOINTS.add('recolor_background')
+
+metrics.REGISTRY.register(metrics.Gauge(
+    'face_app_gallery_identities', 'Known identities in the gallery',
+    callback=lambda: len(face_service.known_face_names)))
+metrics.REGISTRY.register(metrics.Gauge(
+    'face_app_job_queue_depth', 'Background removal jobs waiting to start',
+    callback=background_jobs.depth))
+metrics.REGISTRY.register(metrics.Gauge(
+    'face_app_stream_sessions', 'Active streaming sessions',
+    callback=lambda: len(stream_sessions.sessions)))
+metrics.REGISTRY.register(metrics.Gauge(
+    'face_app_mask_cache_bytes', 'Bytes held by the in-memory mask cache',
+    callback=lambda: mask_cache.current_bytes))
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') == '1'
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.request_received = time.time()
+    metrics.begin_request(request.endpoint or 'unknown')
+    if face_service.shards is not None:
+        face_service.shards.begin_request()
+
+def request_deadline():
+    """
+    The client's deadline as a time.time() value, or None
+    From X-Request-Deadline (Unix seconds, covers time spent in proxies and
+    the accept queue) or X-Request-Timeout-Ms (counted from arrival here).
+    """
+    if 'X-Request-Deadline' in request.headers:
+        return float(request.headers['X-Request-Deadline'])
+    if 'X-Request-Timeout-Ms' in request.headers:
+        return g.request_received + float(request.headers['X-Request-Timeout-Ms']) / 1000
+    return None
+
+@app.before_request
+def reject_per_worker_state():
+    if WEB_WORKERS > 1 and request.endpoint in PER_WORKER_ENDPOINTS:
+        return jsonify({
+            "error": f"{request.path} is not supported with several server workers (WEB_WORKERS={WEB_WORKERS}): "
+                     "its state lives in one worker. See Multi-Worker Serving in the README."
+        }), 501
+    return None
+
+@app.before_request
+def admit_request():
+    budget = ADMISSION_BUDGETS.get(request.endpoint)
+    if budget is None:
+        return None
+    try:
+        deadline = request_deadline()
+    except ValueError:
+        return jsonify({"error": "Invalid request deadline header"}), 400
+    
+    # Matching against a half-loaded gallery would report known people as unknown
+    if budget == 'recognition' and readiness.state('gallery') != READY:
+        response = jsonify({"error": "Gallery is still loading", "gallery": readiness.state('gallery')})
+        response.headers['Retry-After'] = '2'
+        return response, 503
+    
+    limit = admission_limits[budget]
+    with metrics.stage('admission_wait'):
+        try:
+            limit.acquire(deadline)
+        except Rejected as e:
+            response = jsonify({"error": str(e)})
+            if e.retry_after:
+                response.headers['Retry-After'] = str(e.retry_after)
+            return response, e.status
+    g.admission = limit
+    return None
+
+@app.teardown_request
+def release_admission(error=None):
+    limit = g.pop('admission', None)
+    if limit is not None:
+        limit.release()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    stages = metrics.end_request()
+    elapsed = time.perf_counter() - g.get('request_start', time.perf_counter())
+    
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method)
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if response.status_code >= 400:
+        metrics.ERRORS.inc(endpoint=endpoint, status=response.status_code)
+    
+    if SERVER_TIMING and stages:
+        response.headers['Server-Timing'] = metrics.server_timing_header(stages + [('total', elapsed)])
+    if face_service.shards is not None and face_service.shards.missing():
+        # Matches from these shards' identities are absent from the response
+        response.headers['X-Shards-Missing'] = ','.join(map(str, face_service.shards.missing()))
+    return response
+
+def body_too_large(images=1):
+    """Whether the declared request body exceeds what this many base64 images may need"""
+    limit = (MAX_IMAGE_BYTES * 4 // 3 + 64 * 1024) * images
+    return request.content_length is not None and request.content_length > limit
+
+def decode_base64_upload(value):
+    """Base64 string or data URL -> image bytes, size-checked before decoding"""
+    with metrics.stage('base64_decode'):
+        return b64decode_image(value, MAX_IMAGE_BYTES)
+
+def decode_upload(image_bytes, max_side=None):
+    """Image bytes -> (contiguous uint8 RGB array, scale), see image_decode.py"""
+    with metrics.stage('image_decode'):
+        return decode_image(image_bytes, max_side, MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS)
+
+def image_error_response(error, prefix=""):
+    """413 for images over the limits, 400 for anything undecodable"""
+    return jsonify({"error": prefix + str(error)}), 413 if isinstance(error, ImageTooLarge) else 400
+
+def shard_unavailable_response(error):
+    """503 when the gallery shard that owns a name can't take an update"""
+    print(f"[X] {str(error)}")
+    response = jsonify({"error": "The gallery shard for this name is unavailable"})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+def scale_locations(results, scale):
+    """Map face boxes found on a downscaled decode back to original image coordinates"""
+    if scale != 1.0:
+        for result in results:
+            result["location"] = {side: int(round(value / scale)) for side, value in result["location"].items()}
+    return results
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Metrics in Prometheus text exposition format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
+    """Liveness: the process answers; see /ready for whether it can serve"""
     return jsonify({"status": "healthy", "service": "face-recognition-api"})
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """
+    Readiness: 200 once the gallery is loaded, the encoder warmed and no
+    warm-up is still running, 503 before; lists each component's state
+    """
+    ready = readiness.ready
+    return jsonify({"ready": ready, "components": readiness.components()}), 200 if ready else 503
+
 @app.route('/recognize', methods=['POST'])
 def recognize_face():
     """
@@ -25,34 +329,220 @@ def recognize_face():
     Expects JSON with base64 encoded image
     """
     try:
-        data = request.get_json()
+        if body_too_large():
+            return jsonify({"error": "Request body too large"}), 413
+        
+        with metrics.stage('body_parse'):
+            data = request.get_json()
         
         if not data or 'image' not in data:
             return jsonify({"error": "No image provided"}), 400
         
-        # Decode base64 image
-        image_data = data['image'].split(',')[1]  # Remove data:image/jpeg;base64, prefix
-        image_bytes = base64.b64decode(image_data)
-        
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(image_bytes))
+        try:
+            detector = face_service.resolve_detector(data.get('detector'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Convert to numpy array (RGB)
-        image_array = np.array(image)
+        image_array, scale = decode_upload(decode_base64_upload(data['image']), RECOGNITION_MAX_SIDE)
         
         # Perform face recognition
-        results = face_service.recognize_faces(image_array)
+        results = scale_locations(face_service.recognize_faces(image_array, detector), scale)
+        metrics.FACES_PER_FRAME.observe(len(results), endpoint='recognize')
+        
+        with metrics.stage('response_encoding'):
+            return jsonify({
+                "success": True,
+                "detector": detector,
+                "faces_detected": len(results),
+                "results": results
+            })
+        
+    except ImageDecodeError as e:
+        return image_error_response(e)
+    except Exception as e:
+        print(f"Error processing image: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+MAX_BATCH_IMAGES = int(os.environ.get('BATCH_MAX_IMAGES', 64))
+# Bounds multipart parsing; single-image endpoints check body_too_large() first
+app.config['MAX_CONTENT_LENGTH'] = (MAX_IMAGE_BYTES * 4 // 3 + 64 * 1024) * MAX_BATCH_IMAGES
+
+
+def read_exact(stream, size):
+    """Read exactly size bytes from a stream, or fewer only at end of stream"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def iter_batch_images():
+    """
+    Yield the raw image parts of a /recognize/batch request, in order
+    
+    Accepts multipart/form-data (every file part is an image) or
+    application/octet-stream made of [4-byte big-endian length][image bytes]
+    records.
+    """
+    if request.mimetype == 'multipart/form-data':
+        for _, part in request.files.items(multi=True):
+            yield part.read()
+        return
+    
+    stream = request.stream
+    offset = 0
+    while True:
+        header = read_exact(stream, 4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ImageDecodeError(f"Truncated length prefix at byte {offset}")
+        length = int.from_bytes(header, 'big')
+        if length > MAX_IMAGE_BYTES:
+            raise ImageTooLarge(f"Image too large ({length} bytes, max {MAX_IMAGE_BYTES})")
+        data = read_exact(stream, length)
+        if len(data) < length:
+            raise ImageDecodeError(
+                f"Truncated image data at byte {offset + 4}: expected {length} bytes, got {len(data)}"
+            )
+        offset += 4 + length
+        yield data
+
+@app.route('/recognize/batch', methods=['POST'])
+def recognize_batch():
+    """
+    Endpoint to recognize faces in several images at once
+    Expects multipart/form-data file parts or a length-prefixed binary body;
+    ?detector= selects the face detector for the whole batch
+    """
+    try:
+        if body_too_large(MAX_BATCH_IMAGES):
+            return jsonify({"error": "Request body too large"}), 413
+        
+        try:
+            detector = face_service.resolve_detector(request.args.get('detector'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        image_arrays = []
+        scales = []
+        errors = {}
+        
+        for position, image_bytes in enumerate(iter_batch_images()):
+            if position >= MAX_BATCH_IMAGES:
+                return jsonify({"error": f"Too many images (max {MAX_BATCH_IMAGES})"}), 413
+            try:
+                image_array, scale = decode_upload(image_bytes, RECOGNITION_MAX_SIDE)
+            except ImageDecodeError as e:
+                errors[position] = str(e)
+                image_array, scale = None, 1.0
+            image_arrays.append(image_array)
+            scales.append(scale)
+        
+        if not image_arrays:
+            return jsonify({"error": "No images provided"}), 400
+        
+        batch_results = iter(face_service.recognize_faces_batch(
+            [image_array for image_array in image_arrays if image_array is not None], detector
+        ))
+        
+        results = []
+        for position, image_array in enumerate(image_arrays):
+            if image_array is None:
+                results.append({"success": False, "error": errors[position]})
+                continue
+            faces = scale_locations(next(batch_results), scales[position])
+            metrics.FACES_PER_FRAME.observe(len(faces), endpoint='recognize_batch')
+            results.append({
+                "success": True,
+                "faces_detected": len(faces),
+                "results": faces
+            })
+        
+        with metrics.stage('response_encoding'):
+            return jsonify({
+                "success": True,
+                "detector": detector,
+                "images": len(results),
+                "results": results
+            })
+        
+    except ImageDecodeError as e:
+        # Too large or a truncated binary body; undecodable images are reported per position
+        return image_error_response(e)
+    except Exception as e:
+        print(f"Error processing batch: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/stream/sessions', methods=['POST'])
+def create_stream_session():
+    """Start a streaming recognition session for one camera (optional JSON: detector)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        detector = face_service.resolve_detector(data.get('detector'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    session = stream_sessions.create(detector)
+    if session is None:
+        return jsonify({"error": "Too many active sessions"}), 503
+    return jsonify({"success": True, "session_id": session.session_id, "detector": detector}), 201
+
+@app.route('/stream/sessions/<session_id>/frames', methods=['POST'])
+def stream_frame(session_id):
+    """
+    Recognize faces in the next frame of a session
+    Expects the raw JPEG/PNG frame as the body, or JSON with a base64 image
+    """
+    try:
+        session = stream_sessions.get(session_id)
+        if session is None:
+            return jsonify({"error": "Unknown or expired session"}), 404
+        
+        if body_too_large():
+            return jsonify({"error": "Request body too large"}), 413
+        
+        if request.is_json:
+            data = request.get_json()
+            if not data or 'image' not in data:
+                return jsonify({"error": "No image provided"}), 400
+            image_bytes = decode_base64_upload(data['image'])
+        else:
+            image_bytes = request.get_data()
+        
+        if not image_bytes:
+            return jsonify({"error": "No image provided"}), 400
+        
+        image_array, scale = decode_upload(image_bytes, RECOGNITION_MAX_SIDE)
+        results = scale_locations(session.process_frame(image_array), scale)
+        metrics.FACES_PER_FRAME.observe(len(results), endpoint='stream_frame')
         
         return jsonify({
             "success": True,
+            "frame": session.frame_number,
             "faces_detected": len(results),
             "results": results
         })
         
+    except ImageDecodeError as e:
+        return image_error_response(e)
     except Exception as e:
-        print(f"Error processing image: {str(e)}")
+        print(f"Error processing stream frame: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/stream/sessions/<session_id>', methods=['DELETE'])
+def close_stream_session(session_id):
+    """End a streaming session and return its statistics"""
+    session = stream_sessions.close(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown session"}), 404
+    return jsonify({"success": True, "stats": session.stats})
+
 @app.route('/known-faces', methods=['GET'])
 def get_known_faces():
     """Get list of known faces"""
@@ -65,6 +555,260 @@ def get_known_faces():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/enroll', methods=['POST'])
+def enroll_face():
+    """
+    Add photos of a person to the gallery without restarting
+    Expects JSON with a name and base64 image, or multipart/form-data with a
+    name field and one or more image files
+    """
+    try:
+        if body_too_large(MAX_BATCH_IMAGES):
+            return jsonify({"error": "Request body too large"}), 413
+        
+        if request.mimetype == 'multipart/form-data':
+            name = request.form.get('name')
+            images = [part.read() for _, part in request.files.items(multi=True)]
+        else:
+            data = request.get_json(silent=True) or {}
+            name = data.get('name')
+            images = []
+            if data.get('image'):
+                images.append(decode_base64_upload(data['image']))
+        
+        if not name:
+            return jsonify({"error": "No name provided"}), 400
+        if not images:
+            return jsonify({"error": "No image provided"}), 400
+        
+        try:
+            name = valid_name(name)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Check every image before enrolling any, so a 400 leaves the gallery unchanged
+        encoded = []
+        for position, image_bytes in enumerate(images, 1):
+            prefix = f"Image {position}: " if len(images) > 1 else ""
+            try:
+                image_array, _ = decode_upload(image_bytes)
+                encoded.append(face_service.encode_enrollment(image_bytes, image_array))
+            except ImageDecodeError as e:
+                return image_error_response(e, prefix)
+            except ValueError as e:
+                return jsonify({"error": prefix + str(e)}), 400
+        
+        try:
+            added = face_service.enroll_encoded(name, encoded)
+        except ShardUnavailable as e:
+            return shard_unavailable_response(e)
+        
+        samples = {face["name"]: face["samples"] for face in face_service.get_known_faces_list()}
+        return jsonify({
+            "success": True,
+            "name": name,
+            "added": added,
+            "samples": samples.get(name, 0)
+        }), 201
+        
+    except ImageDecodeError as e:
+        return image_error_response(e)
+    except Exception as e:
+        print(f"Error enrolling face: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/unenroll', methods=['POST'])
+def unenroll_face():
+    """
+    Remove a person (or one of their images) from the gallery and known_faces/
+    Expects JSON with a name and optionally the image key returned by /enroll
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        if not data.get('name'):
+            return jsonify({"error": "No name provided"}), 400
+        
+        try:
+            removed = face_service.unenroll(data['name'], data.get('image'))
+        except ShardUnavailable as e:
+            return shard_unavailable_response(e)
+        if not removed:
+            return jsonify({"error": "Unknown name or image"}), 404
+        
+        return jsonify({"success": True, "name": data['name'], "removed": removed})
+        
+    except Exception as e:
+        print(f"Error unenrolling face: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/unknown-faces/clusters', methods=['GET'])
+def get_unknown_clusters():
+    """
+    Clusters of unrecognized faces, largest first
+    ?limit=N&offset=M page through them
+    """
+    if unknown_faces is None:
+        return jsonify({"error": "Unknown face collection is disabled"}), 404
+    try:
+        limit = int(request.args.get('limit', 50))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    
+    clusters = unknown_faces.clusters()
+    return jsonify({
+        "success": True,
+        "total": len(clusters),
+        "faces": len(unknown_faces),
+        "clusters": clusters[offset:offset + limit]
+    })
+
+@app.route('/unknown-faces/crops/<int:face_id>', methods=['GET'])
+def get_unknown_crop(face_id):
+    """JPEG crop of one unrecognized face"""
+    if unknown_faces is None:
+        return jsonify({"error": "Unknown face collection is disabled"}), 404
+    path = unknown_faces.crop_path(face_id)
+    if not os.path.exists(path):
+        return jsonify({"error": "Unknown face"}), 404
+    return send_file(path, mimetype='image/jpeg', max_age=86400)
+
+@app.route('/unknown-faces/clusters/<int:cluster_id>/promote', methods=['POST'])
+def promote_unknown_cluster(cluster_id):
+    """
+    Enroll a cluster of unrecognized faces as a known person
+    Expects JSON with the name to give them
+    """
+    if unknown_faces is None:
+        return jsonify({"error": "Unknown face collection is disabled"}), 404
+    try:
+        data = request.get_json(silent=True) or {}
+        if not data.get('name'):
+            return jsonify({"error": "No name provided"}), 400
+        
+        try:
+            added, size = unknown_faces.promote(
+                cluster_id, lambda samples: face_service.enroll_encoded(data['name'], samples)
+            )
+        except KeyError:
+            return jsonify({"error": "Unknown cluster"}), 404
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except ShardUnavailable as e:
+            return shard_unavailable_response(e)
+        
+        return jsonify({"success": True, "name": data['name'].strip(), "added": added, "faces": size}), 201
+        
+    except Exception as e:
+        print(f"Error promoting cluster: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/unknown-faces/cluster', methods=['POST'])
+def cluster_unknown_faces():
+    """
+    Cluster the unrecognized faces collected since the last run now
+    JSON {"full": true} re-clusters all of them
+    """
+    if unknown_faces is None:
+        return jsonify({"error": "Unknown face collection is disabled"}), 404
+    try:
+        data = request.get_json(silent=True) or {}
+        return jsonify({"success": True, **unknown_faces.cluster(full=bool(data.get('full', False)))})
+    except Exception as e:
+        print(f"Error clustering unknown faces: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+def parse_hex_color(value):
+    """Convert '#RRGGBB' to an RGB tuple"""
+    value = value.lstrip('#')
+    return tuple(int(value[i:i+2], 16) for i in (0, 2, 4))
+
+
+def image_response(metadata, encoded, output):
+    """
+    JSON with the image as a base64 data URL, or with output.raw the encoded
+    image itself as the body and the metadata in X- headers
+    """
+    if not output.raw:
+        return jsonify({**metadata, "image": output.data_url(encoded)})
+
+    response = Response(encoded, mimetype=output.mimetype)
+    response.headers['X-Image-Id'] = metadata["imageId"]
+    response.headers['X-Model'] = metadata["model"]
+    response.headers['X-Background-Color'] = metadata["backgroundColor"]
+    if "cached" in metadata:
+        response.headers['X-Cached'] = str(metadata["cached"]).lower()
+    return response
+
+def encode_result(image_array, mask, background_color, output):
+    """Composite (or take the bare mask, for output=mask) and encode it"""
+    if output.output == 'mask':
+        result = Image.fromarray(mask, mode='L')
+    else:
+        with metrics.stage('compositing'):
+            result = composite(Image.fromarray(image_array), mask, parse_hex_color(background_color))
+
+    with metrics.stage('response_encoding'):
+        return output.encode(result)
+
+def parse_background_request(data):
+    """
+    Validate a /remove-background request body
+    Returns (image_bytes, model, background_color, output options); raises
+    ValueError (ImageTooLarge for images over the limits)
+    """
+    if not data or 'image' not in data:
+        raise ValueError("No image provided")
+
+    # Get background color (default to white if not provided)
+    background_color = data.get('backgroundColor', '#FFFFFF')
+    parse_hex_color(background_color)
+    output = OutputOptions.from_request(data)
+
+    image_bytes = decode_base64_upload(data['image'])
+
+    # Only the header is read here; pixels are decoded later, by render_background_removal
+    header = read_header(image_bytes, MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS)
+
+    # Pick the engine; 'auto' decides by image size and latency budget
+    model = bg_engine.resolve_model(data.get('model'), header.size, data.get('latencyBudgetMs'))
+
+    return image_bytes, model, background_color, output
+
+
+def render_background_removal(image_bytes, model, background_color, output):
+    """Segment (or reuse a cached mask), composite and encode; returns (metadata, encoded image)"""
+    # Reuse the mask if this image was already segmented with this model
+    image_id = image_id_for(image_bytes)
+    cached = mask_cache.get(image_id, model)
+
+    # A cached mask sent on its own needs no pixels
+    image_array = None
+    if cached is None or output.output != 'mask':
+        image_array, _ = decode_upload(image_bytes)
+
+    if cached is not None:
+        mask = cached[1]
+    else:
+        with metrics.stage('segmentation'):
+            mask, model = bg_engine.compute_mask(Image.fromarray(image_array), model)
+        mask_cache.put(image_id, model, image_bytes, mask)
+
+    metadata = {
+        "success": True,
+        "imageId": image_id,
+        "backgroundColor": background_color,
+        "model": model,
+        "cached": cached is not None
+    }
+    return metadata, encode_result(image_array, mask, background_color, output)
+
+
+def render_background_job(image_bytes, model, background_color, output):
+    """render_background_removal() for the job queue: the JSON payload"""
+    metadata, encoded = render_background_removal(image_bytes, model, background_color, output)
+    return {**metadata, "image": output.data_url(encoded)}
+
 @app.route('/remove-background', methods=['POST'])
 def remove_background():
     """
@@ -72,55 +816,206 @@ def remove_background():
     Expects JSON with base64 encoded image and background color (hex format)
     """
     try:
-        data = request.get_json()
+        if body_too_large():
+            return jsonify({"error": "Request body too large"}), 413
 
-        if not data or 'image' not in data:
-            return jsonify({"error": "No image provided"}), 400
+        try:
+            with metrics.stage('body_parse'):
+                data = request.get_json()
+            request_args = parse_background_request(data)
+        except ImageTooLarge as e:
+            return image_error_response(e)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        # Get background color (default to white if not provided)
-        bg_color = data.get('backgroundColor', '#FFFFFF')
+        return image_response(*render_background_removal(*request_args), request_args[-1])
 
-        # Convert hex color to RGB tuple
-        bg_color = bg_color.lstrip('#')
-        bg_rgb = tuple(int(bg_color[i:i+2], 16) for i in (0, 2, 4))
+    except SessionUnavailable as e:
+        response = jsonify({"error": str(e)})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    except ImageDecodeError as e:
+        return image_error_response(e)
+    except Exception as e:
+        print(f"Error removing background: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-        # Decode base64 image
-        image_data = data['image'].split(',')[1] if ',' in data['image'] else data['image']
-        image_bytes = base64.b64decode(image_data)
+@app.route('/remove-background/jobs', methods=['POST'])
+def submit_background_job():
+    """
+    Queue a background removal and return a job id immediately
+    Same request body as /remove-background; fetch the result from /jobs/<jobId>
+    """
+    try:
+        if body_too_large():
+            return jsonify({"error": "Request body too large"}), 413
 
-        # Convert to PIL Image
-        input_image = Image.open(io.BytesIO(image_bytes))
+        try:
+            with metrics.stage('body_parse'):
+                data = request.get_json()
+            request_args = parse_background_request(data)
+        except ImageTooLarge as e:
+            return image_error_response(e)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if request_args[-1].raw:
+            return jsonify({"error": "raw output is not available for jobs"}), 400
 
-        # Remove background (returns image with transparent background)
-        output_image = remove(input_image)
+        try:
+            job = background_jobs.submit(
+                metrics.in_scope('remove_background_job', render_background_job), *request_args
+            )
+        except QueueFull as e:
+            response = jsonify({"error": str(e)})
+            response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+            return response, 503
 
-        # Create a new image with the selected background color
-        if output_image.mode == 'RGBA':
-            # Create background with selected color
-            background = Image.new('RGB', output_image.size, bg_rgb)
-            # Paste the image with transparency onto the colored background
-            background.paste(output_image, mask=output_image.split()[3])
-            output_image = background
+        response = jsonify({"success": True, "jobId": job.job_id, "status": job.status})
+        response.headers['Location'] = f"/jobs/{job.job_id}"
+        return response, 202
 
-        # Convert to base64
-        buffered = io.BytesIO()
-        output_image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+    except Exception as e:
+        print(f"Error submitting background job: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-        return jsonify({
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Job status and, once done, its result
+    ?wait=N long-polls up to N seconds (max JOB_MAX_WAIT) for the job to finish
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)), JOB_MAX_WAIT)
+    except ValueError:
+        return jsonify({"error": "wait must be a number"}), 400
+
+    job = background_jobs.get(job_id, wait=wait)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/recolor', methods=['POST'])
+def recolor_background():
+    """
+    Endpoint to change the background color of an already processed image
+    Expects JSON with the imageId returned by /remove-background and a color
+    """
+    try:
+        data = request.get_json()
+
+        if not data or 'imageId' not in data:
+            return jsonify({"error": "No imageId provided"}), 400
+        if not is_image_id(data['imageId']):
+            return jsonify({"error": "imageId must be the 64-character hex id returned by /remove-background"}), 400
+        
+        try:
+            background_color = data.get('backgroundColor', '#FFFFFF')
+            parse_hex_color(background_color)
+            output = OutputOptions.from_request(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Without an explicit model, use the best mask cached for this image
+        model = data.get('model')
+        if model not in (None, AUTO) and model not in bg_engine.allowed_models:
+            available = ', '.join(bg_engine.allowed_models + (AUTO,))
+            return jsonify({"error": f"Unknown model '{model}'. Available: {available}"}), 400
+        models = [model] if model not in (None, AUTO) else bg_engine.models_by_quality()
+        cached = None
+        for model in models:
+            cached = mask_cache.get(data['imageId'], model)
+            if cached is not None:
+                break
+
+        if cached is None:
+            # Evicted or never seen: the client should fall back to /remove-background
+            return jsonify({"error": "Unknown imageId"}), 404
+
+        image_bytes, mask = cached
+        image_array = decode_upload(image_bytes)[0] if output.output != 'mask' else None
+        encoded = encode_result(image_array, mask, background_color, output)
+
+        metadata = {
             "success": True,
-            "image": f"data:image/png;base64,{img_str}",
-            "backgroundColor": data.get('backgroundColor', '#FFFFFF')
-        })
+            "imageId": data['imageId'],
+            "backgroundColor": background_color,
+            "model": model
+        }
+        return image_response(metadata, encoded, output)
 
     except Exception as e:
-        print(f"Error removing background: {str(e)}")
+        print(f"Error recoloring background: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def load_gallery(token=None):
+    """
+    Load known faces and start the directory watcher
+    Under gunicorn every worker calls this with the same token, and only the
+    first one loads known_faces/ (see FaceRecognitionService.load_known_faces).
+    """
+    with readiness.track('gallery'):
+        if face_service.shards is not None:
+            print(f"Matching against {len(face_service.shards)} gallery shards")
+        else:
+            print("Loading known faces...")
+            enroll_workers = int(os.environ.get('ENROLL_WORKERS', os.cpu_count() or 1))
+            face_service.load_known_faces(workers=enroll_workers, token=token)
+            print(f"Loaded {len(face_service.known_face_names)} known faces")
+            watch_interval = float(os.environ.get('GALLERY_WATCH_INTERVAL', 0))
+            if watch_interval > 0:
+                print(f"Watching {face_service.known_faces_dir}/ for changes every {watch_interval:g}s")
+                face_service.watch(watch_interval)
+    cluster_interval = float(os.environ.get('UNKNOWN_CLUSTER_INTERVAL', 300))
+    if unknown_faces is not None and cluster_interval > 0:
+        print(f"Clustering unknown faces in {unknown_faces.directory}/ every {cluster_interval:g}s")
+        unknown_faces.watch(cluster_interval)
+
+def warm_up_encoder():
+    """Load dlib's models (before fork under gunicorn, so workers share them copy-on-write)"""
+    with readiness.track('encoder'):
+        face_service.warm_up_encoder()
+
+def warm_up_models():
+    """Load detectors and background removal sessions (after fork under gunicorn: ONNX Runtime is not fork-safe)"""
+    with readiness.track('detectors'):
+        for detector in face_service.allowed_detectors:
+            try:
+                face_service.get_detector(detector)
+            except Exception as e:
+                print(f"[X] Face detector {detector} unavailable: {str(e)}")
+    if os.environ.get('BG_WARMUP', '1') == '1':
+        print("Warming up background removal model...")
+        try:
+            with readiness.track('background_model'):
+                bg_engine.warm_up()
+        except Exception as e:
+            print(f"[X] Background removal warm-up failed: {str(e)}")
+    else:
+        readiness.skip('background_model', "BG_WARMUP=0, loaded on first use")
+
+def start_warm_up(steps):
+    """
+    Run startup steps in a background thread while the server already
+    answers, then log how long each one took
+    """
+    def run():
+        for step in steps:
+            try:
+                step()
+            except Exception as e:
+                print(f"[X] Startup step {step.__name__} failed: {str(e)}")
+        for name, info in readiness.components().items():
+            if info["seconds"] is not None:
+                metrics.STARTUP_SECONDS.set(info["seconds"], component=name)
+        status = "[OK] Ready" if readiness.ready else "[X] Not ready"
+        print(f"{status} after {readiness.summary()}")
+    
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
 if __name__ == '__main__':
     print("Starting Face Recognition API...")
-    print("Loading known faces...")
-    face_service.load_known_faces()
-    print(f"Loaded {len(face_service.known_face_names)} known faces")
-    print("API running on http://localhost:5000")
+    start_warm_up([load_gallery, warm_up_encoder, warm_up_models])
+    print("API running on http://localhost:5000 (see /ready)")
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
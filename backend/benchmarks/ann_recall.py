@@ -0,0 +1,68 @@
+"""
+Recall-vs-latency report for the IVF index against exact search
+
+Usage (from backend/):
+    python -m benchmarks.ann_recall --sizes 10000 100000 --nprobe 1 4 8 16 32
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ann_index import IVFIndex
+from benchmarks.synthetic import noisy_queries, random_encodings
+from face_matcher import FaceMatcher
+
+
+def timed_search(index, queries, k, **kwargs):
+    start = time.perf_counter()
+    ids, distances = index.search(queries, k=k, **kwargs)
+    elapsed = time.perf_counter() - start
+    return ids, distances, elapsed * 1000 / len(queries)
+
+
+def recall_at_k(approx_ids, exact_ids):
+    """Fraction of the exact top-k ids that the approximate search also returned"""
+    hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approx_ids, exact_ids))
+    return hits / exact_ids.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('--nlists', type=int, default=None, help="IVF lists (default: 4*sqrt(n))")
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        gallery = random_encodings(size)
+        queries, _ = noisy_queries(gallery, args.queries)
+
+        exact = FaceMatcher(gallery)
+        exact_ids, exact_distances, exact_ms = timed_search(exact, queries, args.k)
+        exact_matches = exact_distances[:, 0] <= args.tolerance
+
+        start = time.perf_counter()
+        index = IVFIndex(n_lists=args.nlists, min_train_size=0)
+        index.build(gallery)
+        build_s = time.perf_counter() - start
+
+        print(f"\nGallery: {size} encodings, {len(index.list_ids)} lists, built in {build_s:.1f}s")
+        print(f"{'search':>10} {'ms/query':>9} {'recall@1':>9} {'recall@' + str(args.k):>9} {'match agree':>12}")
+        print(f"{'exact':>10} {exact_ms:>9.3f} {1.0:>9.3f} {1.0:>9.3f} {1.0:>12.3f}")
+
+        for n_probe in args.nprobe:
+            ids, distances, ms = timed_search(index, queries, args.k, n_probe=n_probe)
+            matches = distances[:, 0] <= args.tolerance
+            # A match decision agrees when both searches find the same identity (or both find none)
+            agree = np.mean(np.where(exact_matches, matches & (ids[:, 0] == exact_ids[:, 0]), ~matches))
+            print(f"{'nprobe=' + str(n_probe):>10} {ms:>9.3f} "
+                  f"{recall_at_k(ids[:, :1], exact_ids[:, :1]):>9.3f} "
+                  f"{recall_at_k(ids, exact_ids):>9.3f} {agree:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Detection time vs recall for different detection scales and upsample counts
+
+Full-resolution detection with upsample=1 is the reference; a face counts as
+found at another setting when a box overlaps a reference box with IoU >= 0.5.
+
+Usage (from backend/):
+    python -m benchmarks.detection_scale path/to/frames --scales 1 0.5 0.25 --upsample 0 1
+"""
+import argparse
+import os
+import time
+
+import cv2
+
+from face_service import FaceRecognitionService
+from face_tracking import box_iou
+
+
+def load_images(directory, width):
+    images = []
+    for filename in sorted(os.listdir(directory)):
+        if os.path.splitext(filename)[1].lower() not in ('.jpg', '.jpeg', '.png'):
+            continue
+        image = cv2.imread(os.path.join(directory, filename))
+        if image is None:
+            continue
+        if width:
+            image = cv2.resize(image, (width, int(image.shape[0] * width / image.shape[1])))
+        images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    return images
+
+
+def run(service, images):
+    start = time.perf_counter()
+    boxes = [service.detect_faces(image) for image in images]
+    return boxes, (time.perf_counter() - start) * 1000 / len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', nargs='?', default='known_faces')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.75, 0.5, 0.33, 0.25])
+    parser.add_argument('--upsample', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--width', type=int, default=1280, help="resize inputs to this width first (0 = as is)")
+    parser.add_argument('--adaptive', action='store_true', help="also measure adaptive retry at full resolution")
+    args = parser.parse_args()
+
+    images = load_images(args.directory, args.width)
+    if not images:
+        print(f"No images found in {args.directory}")
+        return
+
+    reference, reference_ms = run(FaceRecognitionService(), images)
+    total = sum(len(b) for b in reference)
+    print(f"{len(images)} images, {total} reference faces, reference {reference_ms:.1f} ms/image\n")
+    print(f"{'scale':>6} {'upsample':>8} {'adaptive':>8} {'ms/image':>9} {'speedup':>8} {'recall':>7} {'extra':>6}")
+
+    for scale in args.scales:
+        for upsample in args.upsample:
+            for adaptive in ([False, True] if args.adaptive and scale < 1.0 else [False]):
+                service = FaceRecognitionService(
+                    detection_scale=scale, upsample=upsample, adaptive_detection=adaptive
+                )
+                boxes, ms = run(service, images)
+                found = sum(
+                    any(box_iou(ref, box) >= 0.5 for box in image_boxes)
+                    for ref_boxes, image_boxes in zip(reference, boxes)
+                    for ref in ref_boxes
+                )
+                extra = sum(len(b) for b in boxes) - found
+                recall = found / total if total else 1.0
+                print(f"{scale:>6.2f} {upsample:>8} {str(adaptive):>8} {ms:>9.1f} "
+                      f"{reference_ms / ms:>7.1f}x {recall:>7.3f} {extra:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Latency and accuracy of each face detector backend
+
+One detector (default: dlib CNN) is the reference; a reference face counts as
+found when a box of the tested detector overlaps it with IoU >= 0.5. For the
+found faces the report also shows how well the normalized boxes feed the
+encoding step: the distance between the encoding computed from the detector's
+box and from the reference box ("enc dist", "same id" = within tolerance 0.6),
+and the remaining size/offset versus the reference box, to tune box_scale and
+box_shift in face_detectors.create_detector.
+
+Usage (from backend/):
+    python -m benchmarks.detectors path/to/frames --detectors hog haar --reference cnn
+"""
+import argparse
+import time
+
+import face_recognition
+import numpy as np
+
+from benchmarks.detection_scale import load_images
+from face_detectors import DETECTORS, create_detector
+from face_tracking import box_iou
+
+
+def run(detector, images, upsample):
+    detector.detect(images[0], upsample)
+    start = time.perf_counter()
+    boxes = [detector.detect(image, upsample) for image in images]
+    return boxes, (time.perf_counter() - start) * 1000 / len(images)
+
+
+def best_match(reference_box, boxes):
+    overlaps = [box_iou(reference_box, box) for box in boxes]
+    if not overlaps or max(overlaps) < 0.5:
+        return None
+    return boxes[int(np.argmax(overlaps))]
+
+
+def box_geometry(reference_box, box):
+    """(size ratio, vertical centre offset in reference heights) of box vs reference_box"""
+    top, right, bottom, left = reference_box
+    height = bottom - top
+    ratio = (box[2] - box[0]) / height
+    offset = ((box[0] + box[2]) - (top + bottom)) / 2 / height
+    return ratio, offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', nargs='?', default='known_faces')
+    parser.add_argument('--detectors', nargs='+', default=['hog', 'haar'], choices=DETECTORS)
+    parser.add_argument('--reference', default='cnn', choices=DETECTORS)
+    parser.add_argument('--upsample', type=int, default=1)
+    parser.add_argument('--width', type=int, default=1280, help="resize inputs to this width first (0 = as is)")
+    parser.add_argument('--haar-cascade', help="Haar cascade .xml (default: the one shipped with OpenCV)")
+    parser.add_argument('--lbp-cascade', help="LBP cascade .xml, needed for lbp")
+    parser.add_argument('--yunet-model', help="YuNet .onnx model, needed for yunet")
+    args = parser.parse_args()
+
+    images = load_images(args.directory, args.width)
+    if not images:
+        print(f"No images found in {args.directory}")
+        return
+    files = {'haar_cascade': args.haar_cascade, 'lbp_cascade': args.lbp_cascade, 'yunet_model': args.yunet_model}
+
+    reference, reference_ms = run(create_detector(args.reference, **files), images, args.upsample)
+    total = sum(len(b) for b in reference)
+    print(f"{len(images)} images, {total} {args.reference} faces, {args.reference} {reference_ms:.1f} ms/image\n")
+    print(f"{'detector':>8} {'ms/image':>9} {'recall':>7} {'precision':>9} {'IoU':>5} "
+          f"{'enc dist':>8} {'same id':>7} {'size':>5} {'shift':>6}")
+
+    for name in args.detectors:
+        try:
+            detector = create_detector(name, **files)
+        except ValueError as e:
+            print(f"{name:>8} skipped: {str(e)}")
+            continue
+        boxes, ms = run(detector, images, args.upsample)
+
+        overlaps, distances, geometry = [], [], []
+        for image, ref_boxes, image_boxes in zip(images, reference, boxes):
+            pairs = [(ref, best_match(ref, image_boxes)) for ref in ref_boxes]
+            pairs = [(ref, box) for ref, box in pairs if box is not None]
+            if not pairs:
+                continue
+            ref_encodings = face_recognition.face_encodings(image, [ref for ref, _ in pairs])
+            encodings = face_recognition.face_encodings(image, [box for _, box in pairs])
+            for (ref, box), ref_encoding, encoding in zip(pairs, ref_encodings, encodings):
+                overlaps.append(box_iou(ref, box))
+                distances.append(float(np.linalg.norm(ref_encoding - encoding)))
+                geometry.append(box_geometry(ref, box))
+
+        found = len(overlaps)
+        detected = sum(len(b) for b in boxes)
+        recall = found / total if total else 1.0
+        precision = found / detected if detected else 1.0
+        if found:
+            ratio, offset = np.median(np.array(geometry), axis=0)
+            print(f"{name:>8} {ms:>9.1f} {recall:>7.3f} {precision:>9.3f} {np.mean(overlaps):>5.2f} "
+                  f"{np.mean(distances):>8.3f} {np.mean(np.array(distances) <= 0.6):>7.3f} "
+                  f"{ratio:>5.2f} {offset:>+6.2f}")
+        else:
+            print(f"{name:>8} {ms:>9.1f} {recall:>7.3f} {precision:>9.3f}   no faces matched the reference")
+
+    print("\nsize/shift: median box height and centre offset relative to the reference box;"
+          "\nroughly, divide box_scale by size and subtract shift from box_shift to line a backend up.")
+
+
+if __name__ == '__main__':
+    main()
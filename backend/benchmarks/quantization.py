@@ -0,0 +1,135 @@
+"""
+Memory and accuracy of float32, float16 and int8 gallery storage
+
+Loads a synthetic gallery into FaceRecognitionService once per storage mode,
+with and without re-scoring against the templates, and compares every match
+against float32 with re-scoring (the default). Queries are new photos of
+gallery identities at several noise levels, so their distances straddle the
+tolerance, plus as many strangers. Reports latency, how often the best identity
+and the match decision at --tolerance agree with the baseline, the largest
+distance error, and memory per million identities:
+
+    private   everything the service still holds after loading (traced by
+              tracemalloc): templates, norms, matcher, names, sample counts
+              and any per-image samples it keeps. With --shared this is what
+              every worker holds on top of the mapped files.
+    mapped    with --shared, the gallery files every worker maps (one copy in
+              the page cache)
+    exact     the float32 originals a quantized gallery keeps for re-scoring,
+              in a memory-mapped file; only shortlisted rows are read, so
+              they stay on disk unless queries touch them
+
+Also compares the memory of the identity names as a Python list and as a
+StringTable.
+
+Usage (from backend/):
+    python -m benchmarks.quantization --sizes 100000 1000000
+    python -m benchmarks.quantization --sizes 100000 --shared
+"""
+import argparse
+import gc
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.synthetic import SAMPLE_NOISE, noisy_queries, random_encodings
+from face_service import FaceRecognitionService
+from identity_gallery import StringTable
+
+MODES = (('float32', True), ('float32', False), ('float16', True), ('float16', False), ('int8', True), ('int8', False))
+
+
+def identity_names(size):
+    return [f"person_{i:07d}" for i in range(size)]
+
+
+def names_memory(size):
+    """Bytes allocated for size names as a list of str and as a StringTable"""
+    tracemalloc.start()
+    as_list = identity_names(size)
+    list_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return list_bytes, StringTable.from_strings(as_list).nbytes
+
+
+def load_service(size, storage, rescore, tolerance, state_dir, shared=False):
+    """Load the synthetic gallery; returns (service, private bytes, mapped bytes, exact bytes)"""
+    gc.collect()
+    tracemalloc.start()
+    service = FaceRecognitionService(known_faces_dir=state_dir, tolerance=tolerance, storage=storage,
+                                     rescore=rescore)
+    if shared:
+        service.use_shared_gallery(os.path.join(state_dir, '.shared_gallery'))
+    # Built inside the trace, so whatever the service keeps of them is counted
+    service.load_encodings(identity_names(size), random_encodings(size))
+    gc.collect()
+    private = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    exact = service._current().gallery.exact_nbytes
+    mapped = 0
+    if shared:
+        generation = os.path.join(state_dir, '.shared_gallery', str(service._shared.generation))
+        mapped = sum(os.path.getsize(os.path.join(generation, f)) for f in os.listdir(generation)) - exact
+    return service, private, mapped, exact
+
+
+def best_matches(service, queries, batch):
+    names, distances = [], []
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch):
+        for candidates in service.match_encodings(queries[i:i + batch]):
+            names.append(candidates[0]["name"])
+            distances.append(candidates[0]["distance"])
+    elapsed = time.perf_counter() - start
+    return np.array(names), np.array(distances), elapsed * 1000 / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000])
+    parser.add_argument('--queries', type=int, default=1000, help="genuine queries (plus as many strangers)")
+    parser.add_argument('--batch', type=int, default=8, help="faces matched per call")
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--shared', action='store_true', help="serve from a shared (memory-mapped) gallery")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        encodings = random_encodings(size)
+        names = identity_names(size)
+        per_level = args.queries // 4
+        queries = np.vstack(
+            [noisy_queries(encodings, per_level, noise=SAMPLE_NOISE * f, seed=i)[0] for i, f in enumerate((1, 1.3, 1.5, 1.7))]
+            + [random_encodings(per_level * 4, seed=size + 1)]
+        )
+
+        list_bytes, table_bytes = names_memory(size)
+        print(f"\nGallery: {size} identities, {len(queries)} queries, tolerance {args.tolerance}")
+        print(f"Names per 1M identities: list {list_bytes / size:.0f} MB, StringTable {table_bytes / size:.0f} MB")
+        print(f"{'storage':>8} {'rescore':>8} {'private MB/1M':>14} {'mapped MB/1M':>13} {'exact MB/1M':>12} "
+              f"{'ms/face':>8} {'same best':>10} {'same match':>11} {'max |dd|':>9}")
+
+        baseline = None
+        for storage, rescore in MODES:
+            state_dir = tempfile.mkdtemp()
+            service, private, mapped, exact = load_service(size, storage, rescore, args.tolerance, state_dir,
+                                                           args.shared)
+            matched_names, distances, ms = best_matches(service, queries, args.batch)
+            if baseline is None:
+                baseline = matched_names, distances
+
+            same_best = np.mean(matched_names == baseline[0])
+            same_match = np.mean((distances <= args.tolerance) == (baseline[1] <= args.tolerance))
+            error = np.max(np.abs(distances - baseline[1]))
+            print(f"{storage:>8} {'yes' if rescore else 'no':>8} {private / size:>14.0f} {mapped / size:>13.0f} "
+                  f"{exact / size:>12.0f} {ms:>8.3f} {same_best:>10.4f} {same_match:>11.4f} {error:>9.4f}")
+            del service
+            shutil.rmtree(state_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+"""
+Reproducible benchmark harness for recognition and background removal
+
+Suites:
+    matching     gallery matching alone against synthetic galleries (10 .. 1M)
+    recognize    FaceRecognitionService.recognize_faces on fixture frames
+    enroll       load_known_faces, cold (no cache) and warm (cached)
+    decode       upload decode: PIL + np.array vs image_decode (full size and --decode-max-side)
+    background   mask computation per engine (u2net/u2netp if rembg is installed, grabcut, edges)
+    encode       /remove-background response encoding per output option, with response size
+    http         N concurrent clients against the Flask app (/recognize, /remove-background)
+
+Fixture frames are built from the face photos in --faces (default known_faces/)
+pasted onto a background at each --resolutions size, --faces-per-frame times.
+Without face photos, synthetic frames are used (detection cost only).
+
+Usage (from backend/):
+    python -m benchmarks.run --suites matching background --output baseline.json
+    python -m benchmarks.run --suites matching background --baseline baseline.json --tolerance 0.15
+    python -m benchmarks.run --results after.json --baseline
+
+Results are written as JSON; with --baseline each result is compared by p50 and
+the exit code is 1 if anything regressed by more than --tolerance (or stopped
+succeeding at all). --baseline without a file uses the committed
+benchmarks/baseline.json (every results file records its machine and
+arguments); --results compares a saved run instead of running the suites again.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from benchmarks.synthetic import noisy_queries, random_encodings
+
+VALID_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def summarize(name, samples_s, params=None, items=1):
+    """
+    Latency percentiles (ms) and throughput (items/s) for a list of timings in seconds
+
+    Without timings (e.g. every HTTP request was shed) the latencies are None
+    and the throughput is 0.
+    """
+    samples = np.asarray(samples_s) * 1000
+    total_s = float(np.sum(samples_s))
+    result = {
+        "name": name,
+        "params": params or {},
+        "n": len(samples),
+        "mean_ms": None,
+        "p50_ms": None,
+        "p95_ms": None,
+        "p99_ms": None,
+        "throughput_per_s": len(samples) * items / total_s if total_s else 0.0,
+    }
+    if len(samples):
+        result.update(
+            mean_ms=float(np.mean(samples)),
+            p50_ms=float(np.percentile(samples, 50)),
+            p95_ms=float(np.percentile(samples, 95)),
+            p99_ms=float(np.percentile(samples, 99)),
+        )
+    return result
+
+
+def format_ms(value, width=9):
+    return f"{value:{width}.3f}" if value is not None else f"{'-':>{width}}"
+
+
+def time_calls(func, args_list, warmup=1):
+    """Call func(*args) for each args tuple (after warmup calls) and return per-call seconds"""
+    for args in args_list[:warmup]:
+        func(*args)
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def load_face_photos(directory, limit=8):
+    photos = []
+    if not os.path.isdir(directory):
+        return photos
+    for filename in sorted(os.listdir(directory)):
+        if os.path.splitext(filename)[1].lower() in VALID_EXTENSIONS:
+            image = cv2.imread(os.path.join(directory, filename))
+            if image is not None:
+                photos.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        if len(photos) >= limit:
+            break
+    return photos
+
+
+def make_frame(resolution, face_photos, n_faces, seed=0):
+    """A (height, width, 3) RGB frame with n_faces face photos tiled across it"""
+    width, height = resolution
+    rng = np.random.default_rng(seed)
+    frame = cv2.GaussianBlur(rng.integers(0, 255, (height, width, 3), dtype=np.uint8), (31, 31), 0)
+    if not face_photos or n_faces == 0:
+        return frame
+
+    columns = int(np.ceil(np.sqrt(n_faces)))
+    rows = int(np.ceil(n_faces / columns))
+    cell_w, cell_h = width // columns, height // rows
+    for i in range(n_faces):
+        photo = face_photos[i % len(face_photos)]
+        scale = min(cell_w / photo.shape[1], cell_h / photo.shape[0]) * 0.9
+        resized = cv2.resize(photo, (max(1, int(photo.shape[1] * scale)), max(1, int(photo.shape[0] * scale))))
+        top = (i // columns) * cell_h
+        left = (i % columns) * cell_w
+        frame[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+    return frame
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def bench_matching(args):
+    from face_service import FaceRecognitionService
+
+    results = []
+    for size in args.gallery_sizes:
+        gallery = random_encodings(size)
+        names = [f"id{i}" for i in range(size)]
+        for index in args.indexes:
+            service = FaceRecognitionService(known_faces_dir=tempfile.mkdtemp(), index=index)
+            start = time.perf_counter()
+            service.load_encodings(names, gallery)
+            build_s = time.perf_counter() - start
+            shutil.rmtree(service.known_faces_dir, ignore_errors=True)
+
+            for faces in args.faces_per_frame:
+                queries, _ = noisy_queries(gallery, faces * args.iterations)
+                batches = [(queries[i * faces:(i + 1) * faces],) for i in range(args.iterations)]
+                timings = time_calls(service.match_encodings, batches)
+                result = summarize("matching", timings, {"gallery": size, "index": index, "faces": faces}, faces)
+                result["build_s"] = build_s
+                results.append(result)
+    return results
+
+
+def bench_recognize(args, face_photos):
+    from face_service import FaceRecognitionService
+
+    service = FaceRecognitionService(args.faces)
+    service.load_known_faces(workers=args.workers)
+
+    results = []
+    for resolution in args.resolutions:
+        for faces in args.faces_per_frame:
+            frames = [(make_frame(resolution, face_photos, faces, seed=i),) for i in range(args.iterations)]
+            timings = time_calls(service.recognize_faces, frames)
+            results.append(summarize("recognize", timings, {"resolution": f"{resolution[0]}x{resolution[1]}",
+                                                             "faces": faces}))
+    return results
+
+
+def bench_enroll(args, face_photos):
+    from face_service import FaceRecognitionService
+
+    results = []
+    gallery_dir = tempfile.mkdtemp(prefix='bench_gallery_')
+    try:
+        for i in range(args.enroll_images):
+            photo = face_photos[i % len(face_photos)] if face_photos else make_frame((320, 240), [], 0, seed=i)
+            cv2.imwrite(os.path.join(gallery_dir, f"person{i:05d}.jpg"), cv2.cvtColor(photo, cv2.COLOR_RGB2BGR))
+
+        # Populate the encoding cache once for the warm runs
+        FaceRecognitionService(gallery_dir).load_known_faces(workers=args.workers)
+
+        for workers in sorted({1, args.workers}):
+            for cache in ('cold', 'warm'):
+                timings = []
+                for _ in range(max(1, args.iterations // 5)):
+                    service = FaceRecognitionService(gallery_dir)
+                    start = time.perf_counter()
+                    service.load_known_faces(use_cache=(cache == 'warm'), workers=workers)
+                    timings.append(time.perf_counter() - start)
+                results.append(summarize("enroll", timings, {"images": args.enroll_images, "workers": workers,
+                                                              "cache": cache}, args.enroll_images))
+    finally:
+        shutil.rmtree(gallery_dir, ignore_errors=True)
+    return results
+
+
+def bench_decode(args, face_photos):
+    from image_decode import decode_image
+
+    def pil_decode(data):
+        return np.array(Image.open(io.BytesIO(data)).convert('RGB'))
+
+    decoders = {
+        "pil": pil_decode,
+        "image_decode": lambda data: decode_image(data),
+        f"image_decode max_side={args.decode_max_side}": lambda data: decode_image(data, args.decode_max_side),
+    }
+
+    results = []
+    for resolution in args.resolutions:
+        payloads = []
+        for i in range(args.iterations):
+            buffer = io.BytesIO()
+            Image.fromarray(make_frame(resolution, face_photos, 1, seed=i)).save(buffer, format='JPEG', quality=90)
+            payloads.append((buffer.getvalue(),))
+        for decoder, func in decoders.items():
+            timings = time_calls(func, payloads)
+            results.append(summarize("decode", timings, {"resolution": f"{resolution[0]}x{resolution[1]}",
+                                                          "decoder": decoder}))
+    return results
+
+
+def bench_background(args, face_photos):
+    from bg_removal import FAST_ENGINES, BackgroundRemovalEngine, SUPPORTED_MODELS
+
+    engines = list(FAST_ENGINES)
+    try:
+        import rembg  # noqa: F401
+        engines = ['u2net', 'u2netp'] + engines
+    except ImportError:
+        print("rembg not installed: skipping u2net/u2netp")
+
+    engine = BackgroundRemovalEngine(allowed_models=engines, default_model=engines[0], pool_size=1)
+    results = []
+    for resolution in args.resolutions:
+        images = [(Image.fromarray(make_frame(resolution, face_photos, 1, seed=i)),) for i in range(args.iterations)]
+        for model in engines:
+            timings = time_calls(lambda image: engine.compute_mask(image, model), images)
+            results.append(summarize("background", timings, {
+                "resolution": f"{resolution[0]}x{resolution[1]}",
+                "engine": model,
+                "kind": "model" if model in SUPPORTED_MODELS else "opencv"
+            }))
+    return results
+
+
+def bench_encode(args, face_photos):
+    from image_encode import OutputOptions
+    from mask_cache import composite
+
+    options = {
+        "png level 6 (json)": OutputOptions(),
+        "png level 1 (json)": OutputOptions(compress_level=1),
+        "jpeg q90 (raw)": OutputOptions(format='jpeg', raw=True),
+        "webp q80 (raw)": OutputOptions(format='webp', quality=80, raw=True),
+        "mask png (raw)": OutputOptions(output='mask', compress_level=1, raw=True),
+    }
+
+    def encode(output, image, mask):
+        result = Image.fromarray(mask, mode='L') if output.output == 'mask' else image
+        encoded = output.encode(result)
+        return encoded if output.raw else output.data_url(encoded)
+
+    results = []
+    for resolution in args.resolutions:
+        width, height = resolution
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.ellipse(mask, (width // 2, height // 2), (width // 4, height // 2 - 10), 0, 0, 360, 255, -1)
+        mask = cv2.GaussianBlur(mask, (15, 15), 0)
+        composites = [
+            (composite(Image.fromarray(make_frame(resolution, face_photos, 1, seed=i)), mask, (0, 255, 0)), mask)
+            for i in range(args.iterations)
+        ]
+        for label, output in options.items():
+            timings = time_calls(lambda image, mask: encode(output, image, mask), composites)
+            result = summarize("encode", timings, {"resolution": f"{width}x{height}", "output": label})
+            result["bytes"] = len(encode(output, *composites[0]))
+            results.append(result)
+    return results
+
+
+def bench_http(args, face_photos):
+    import logging
+    import urllib.error
+    import urllib.request
+    from werkzeug.serving import make_server
+
+    import app as app_module
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with app_module.readiness.track('gallery'):
+        app_module.face_service.load_known_faces(workers=args.workers)
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    frame = make_frame(args.resolutions[0], face_photos, 1)
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format='JPEG', quality=90)
+    image_url = "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+    requests_to_run = {
+        "/recognize": {"image": image_url},
+        "/remove-background": {"image": image_url, "model": "grabcut"},
+    }
+
+    def post(path, body):
+        """Seconds the request took, or None if admission control shed it (503)"""
+        request = urllib.request.Request(base_url + path, data=json.dumps(body).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if e.code != 503:
+                raise
+            return None
+        return time.perf_counter() - start
+
+    results = []
+    try:
+        for path, body in requests_to_run.items():
+            post(path, body)
+            for clients in args.clients:
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=clients) as executor:
+                    outcomes = list(executor.map(lambda _: post(path, body), range(args.iterations * clients)))
+                wall_s = time.perf_counter() - start
+                timings = [t for t in outcomes if t is not None]
+                result = summarize("http", timings, {"path": path, "clients": clients,
+                                                      "resolution": "%dx%d" % args.resolutions[0]})
+                # Concurrent throughput is completed requests per wall-clock second
+                result["throughput_per_s"] = len(timings) / wall_s
+                result["rejected"] = len(outcomes) - len(timings)
+                results.append(result)
+    finally:
+        server.shutdown()
+    return results
+
+
+def result_key(result):
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare(results, baseline_path, tolerance):
+    """Print p50 changes against a baseline file; returns the regressed results"""
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"]}
+
+    regressions = []
+    print(f"\n{'benchmark':<70} {'base p50':>10} {'p50':>10} {'change':>8}")
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None or base["p50_ms"] is None:
+            continue
+        label = result["name"] + " " + ", ".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+        if result["p50_ms"] is None:
+            # Nothing succeeded where the baseline had timings
+            print(f"{label:<70} {base['p50_ms']:>10.3f} {'-':>10} {'-':>8}  REGRESSION (no successes)")
+            regressions.append(result)
+            continue
+        change = result["p50_ms"] / base["p50_ms"] - 1 if base["p50_ms"] else 0.0
+        flag = "  REGRESSION" if change > tolerance else ""
+        print(f"{label:<70} {base['p50_ms']:>10.3f} {result['p50_ms']:>10.3f} {change:>+7.1%}{flag}")
+        if change > tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def check_regressions(results, baseline_path, tolerance):
+    """compare() and exit with status 1 if anything regressed"""
+    regressions = compare(results, baseline_path, tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {tolerance:.0%}")
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suites', nargs='+', default=['matching', 'background'],
+                        choices=['matching', 'recognize', 'enroll', 'decode', 'background', 'encode', 'http'])
+    parser.add_argument('--faces', default='known_faces', help="directory with face photos for fixtures")
+    parser.add_argument('--resolutions', type=parse_resolution, nargs='+',
+                        default=[(640, 480), (1280, 720), (1920, 1080)])
+    parser.add_argument('--faces-per-frame', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--gallery-sizes', type=int, nargs='+', default=[10, 1000, 100000, 1000000])
+    parser.add_argument('--indexes', nargs='+', default=['exact', 'ivf'])
+    parser.add_argument('--enroll-images', type=int, default=200)
+    parser.add_argument('--decode-max-side', type=int, default=640)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--output', help="write results JSON to this file")
+    parser.add_argument('--baseline', nargs='?', const=BASELINE,
+                        help="compare against a results JSON file (no file: benchmarks/baseline.json)")
+    parser.add_argument('--results', help="compare this results JSON file with the baseline instead of running")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="allowed p50 slowdown vs baseline")
+    args = parser.parse_args()
+
+    if args.results:
+        with open(args.results) as f:
+            results = json.load(f)["results"]
+        check_regressions(results, args.baseline or BASELINE, args.tolerance)
+        return
+
+    face_photos = load_face_photos(args.faces)
+    if not face_photos:
+        print(f"No face photos in {args.faces}: using synthetic frames")
+
+    suites = {
+        'matching': lambda: bench_matching(args),
+        'recognize': lambda: bench_recognize(args, face_photos),
+        'enroll': lambda: bench_enroll(args, face_photos),
+        'decode': lambda: bench_decode(args, face_photos),
+        'background': lambda: bench_background(args, face_photos),
+        'encode': lambda: bench_encode(args, face_photos),
+        'http': lambda: bench_http(args, face_photos),
+    }
+
+    results = []
+    for suite in args.suites:
+        print(f"\n== {suite} ==")
+        for result in suites[suite]():
+            params = ", ".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+            print(f"{result['name']:<11} {params:<55} p50 {format_ms(result['p50_ms'])} ms  "
+                  f"p95 {format_ms(result['p95_ms'])}  p99 {format_ms(result['p99_ms'])}  "
+                  f"{result['throughput_per_s']:10.1f}/s"
+                  + (f"  {result['bytes'] / 1024:8.0f} kB" if "bytes" in result else "")
+                  + (f"  {result['rejected']} shed (503)" if result.get("rejected") else ""))
+            results.append(result)
+
+    report = {
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "cpus": os.cpu_count(), "numpy": np.__version__},
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "args": sys.argv[1:],
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        check_regressions(results, args.baseline, args.tolerance)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Scatter-gather matching over local gallery shard processes
+
+Starts one gallery_shard.py process per shard on a synthetic gallery, checks
+that the merged top-k equals matching against the whole gallery in one
+process, and reports latency. Then it pauses one shard (SIGSTOP) to show that
+requests still return within the per-shard timeout, minus that shard's
+identities, and kills one to show a refused connection fails fast.
+
+Usage (from backend/):
+    python -m benchmarks.shards --size 100000 --shards 1 2 4
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import numpy as np
+
+from benchmarks.synthetic import noisy_queries, random_encodings
+from face_service import FaceRecognitionService
+from gallery_shard import ShardClient
+
+
+def start_shards(count, encodings_path, base_port):
+    processes = [
+        subprocess.Popen(
+            [sys.executable, 'gallery_shard.py', '--shard', str(i), '--shards', str(count),
+             '--port', str(base_port + i), '--encodings', encodings_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        for i in range(count)
+    ]
+    urls = [f"http://127.0.0.1:{base_port + i}" for i in range(count)]
+    deadline = time.time() + 120
+    for url in urls:
+        while True:
+            try:
+                urllib.request.urlopen(url + '/health', timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise RuntimeError(f"Shard {url} did not start")
+                time.sleep(0.2)
+    return processes, urls
+
+
+def timed(client, queries, batch, k, rounds):
+    client.begin_request()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for i in range(0, len(queries), batch):
+            client.match(queries[i:i + batch], k)
+    return (time.perf_counter() - start) * 1000 / (rounds * -(-len(queries) // batch)), client.missing()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100000, help="identities in the gallery")
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--queries', type=int, default=64)
+    parser.add_argument('--batch', type=int, default=4, help="faces per match call (one frame)")
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--timeout-ms', type=float, default=500)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--port', type=int, default=5600, help="first shard port")
+    args = parser.parse_args()
+
+    encodings = random_encodings(args.size)
+    names = np.array([f"id{i}" for i in range(args.size)])
+    queries, _ = noisy_queries(encodings, args.queries)
+
+    reference = FaceRecognitionService(top_k=args.k)
+    reference.load_encodings(list(names), encodings)
+    expected = [[c["name"] for c in row] for row in reference.match_encodings(queries)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        encodings_path = os.path.join(tmp, 'gallery.npz')
+        np.savez(encodings_path, names=names, encodings=encodings)
+
+        print(f"Gallery: {args.size} identities, {args.batch} faces per call, timeout {args.timeout_ms:g} ms")
+        print(f"{'shards':>7} {'ms/call':>8} {'same top-k':>11} {'1 paused ms':>12} {'missing':>8} "
+              f"{'1 down ms':>10}")
+        for count in args.shards:
+            processes, urls = start_shards(count, encodings_path, args.port)
+            try:
+                client = ShardClient(urls, timeout=args.timeout_ms / 1000)
+                merged = client.match(queries, args.k)
+                same = np.mean([[name for name, _ in row] == names_ for row, names_ in zip(merged, expected)])
+                ms, _ = timed(client, queries, args.batch, args.k, args.rounds)
+
+                paused_ms = missing = down_ms = float('nan')
+                if count > 1:
+                    os.kill(processes[-1].pid, signal.SIGSTOP)
+                    paused_ms, missing = timed(client, queries[:args.batch * 2], args.batch, args.k, 1)
+                    os.kill(processes[-1].pid, signal.SIGCONT)
+                    processes[-1].kill()
+                    processes[-1].wait()
+                    down_ms, _ = timed(client, queries, args.batch, args.k, 1)
+                print(f"{count:>7} {ms:>8.2f} {same:>11.3f} {paused_ms:>12.1f} {str(missing):>8} {down_ms:>10.2f}")
+            finally:
+                for process in processes:
+                    process.kill()
+                    process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Per-worker memory and matching throughput with a shared vs private gallery
+
+Forks W worker processes that each match queries against a synthetic gallery,
+either mapped from a SharedGallery (as under gunicorn.conf.py) or built as a
+private copy per worker. Reports each worker's unique memory (USS, Linux only)
+and the combined matching throughput. A lone shared worker still counts the
+mapped gallery as its own; it is only divided once several workers map it.
+
+Usage (from backend/):
+    python -m benchmarks.shared_memory --size 200000 --workers 1 2 4 8
+"""
+import argparse
+import multiprocessing
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import noisy_queries, random_encodings
+from face_matcher import FaceMatcher
+from identity_gallery import IdentityGallery
+from shared_gallery import SharedGallery
+
+
+def unique_memory_mb():
+    """Private (unshared) memory of this process in MB, from /proc/self/smaps_rollup"""
+    total_kb = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                total_kb += int(line.split()[1])
+    return total_kb / 1024
+
+
+def worker(shared_dir, gallery_path, queries, seconds, results):
+    baseline_mb = unique_memory_mb()
+    if shared_dir is not None:
+        _, gallery = SharedGallery(shared_dir).load()
+    else:
+        encodings = np.load(gallery_path)
+        gallery = IdentityGallery.from_encodings(range(len(encodings)), encodings)
+    matcher = FaceMatcher(gallery.centroids)
+
+    searched = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        matcher.search(queries, k=5)
+        searched += len(queries)
+    results.put((searched, unique_memory_mb() - baseline_mb))
+
+
+def run(shared_dir, gallery_path, queries, workers, seconds):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(shared_dir, gallery_path, queries, seconds, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    searched = sum(count for count, _ in outcomes)
+    return searched / seconds, max(memory for _, memory in outcomes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=200000, help="identities in the gallery")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--queries', type=int, default=8, help="faces matched per call")
+    parser.add_argument('--seconds', type=float, default=3.0, help="matching time per worker")
+    args = parser.parse_args()
+
+    encodings = random_encodings(args.size)
+    queries, _ = noisy_queries(encodings, args.queries)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        gallery_path = f"{tmp}/gallery.npy"
+        np.save(gallery_path, encodings)
+        shared = SharedGallery(f"{tmp}/shared")
+        with shared.lock():
+            shared.publish(IdentityGallery.from_encodings(range(len(encodings)), encodings))
+
+        print(f"Gallery: {args.size} identities ({encodings.nbytes / 2**20:.0f} MB as float32)")
+        print(f"{'mode':>8} {'workers':>8} {'faces/s':>10} {'MB/worker':>10}")
+        for mode, shared_dir in (('private', None), ('shared', shared.directory)):
+            for workers in args.workers:
+                throughput, memory = run(shared_dir, gallery_path, queries, workers, args.seconds)
+                print(f"{mode:>8} {workers:>8} {throughput:>10.0f} {memory:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
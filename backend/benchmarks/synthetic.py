@@ -0,0 +1,32 @@
+"""
+Synthetic face encodings for benchmarks
+
+Real dlib encodings have a norm of roughly 1 and two photos of the same person
+are typically 0.3-0.5 apart, while different people are ~0.8-1.4 apart. The
+generators below mimic that geometry.
+"""
+import numpy as np
+
+DIMENSIONS = 128
+# Per-dimension standard deviation giving encodings with norm ~1
+IDENTITY_SCALE = 0.09
+# Per-dimension noise giving same-person distances of ~0.4
+SAMPLE_NOISE = 0.035
+
+
+def random_encodings(n, seed=0):
+    """n random identity encodings, float32 (n, 128)"""
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal((n, DIMENSIONS)) * IDENTITY_SCALE).astype(np.float32)
+
+
+def noisy_queries(gallery, n, noise=SAMPLE_NOISE, seed=1):
+    """
+    Queries that are new 'photos' of n random gallery identities
+
+    Returns (queries, true_indices).
+    """
+    rng = np.random.default_rng(seed)
+    true_indices = rng.choice(len(gallery), n, replace=len(gallery) < n)
+    queries = gallery[true_indices] + rng.standard_normal((n, DIMENSIONS)).astype(np.float32) * noise
+    return queries.astype(np.float32), true_indices
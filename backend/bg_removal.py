@@ -0,0 +1,223 @@
+"""
+Managed background-removal engine on top of rembg
+
+rembg (and onnxruntime underneath it) is imported only when the engine is
+first used. Each model gets a small pool of ONNX Runtime sessions with explicit
+thread settings, so concurrent requests share the cores instead of each
+session spawning one thread per core.
+
+Besides the rembg models the engine offers the OpenCV engines from
+simple_bg_removal ('grabcut', 'edges'), and 'auto', which picks the best
+quality engine expected to finish within a latency budget.
+"""
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+import simple_bg_removal
+
+SUPPORTED_MODELS = ('u2net', 'u2netp', 'u2net_human_seg', 'silueta', 'isnet-general-use')
+FAST_ENGINES = {
+    'grabcut': simple_bg_removal.grabcut_mask,
+    'edges': simple_bg_removal.edge_mask,
+}
+AUTO = 'auto'
+
+# Best quality first; 'auto' walks this list
+QUALITY_ORDER = ('u2net', 'isnet-general-use', 'u2net_human_seg', 'silueta', 'u2netp', 'grabcut', 'edges')
+
+# Starting latency estimates (ms) until real measurements replace them. rembg
+# models resize to a fixed input, so their cost is roughly constant; the
+# OpenCV engines are given per megapixel of segmentation resolution.
+PRIOR_LATENCY_MS = {
+    'u2net': 1500.0,
+    'isnet-general-use': 2500.0,
+    'u2net_human_seg': 1500.0,
+    'silueta': 1200.0,
+    'u2netp': 400.0,
+    'grabcut': 2000.0,
+    'edges': 60.0,
+}
+FAST_ENGINE_MAX_SIDE = 512
+
+
+class SessionUnavailable(Exception):
+    """No session of a model became free in time"""
+
+
+class BackgroundRemovalEngine:
+    def __init__(self, default_model='u2net', allowed_models=('u2net', 'u2netp', 'grabcut', 'edges'), pool_size=2,
+                 intra_op_threads=None, inter_op_threads=1, default_budget_ms=2000, session_timeout=30.0):
+        unknown = set(allowed_models) - set(SUPPORTED_MODELS) - set(FAST_ENGINES)
+        if unknown:
+            raise ValueError(f"Unsupported background removal models: {', '.join(sorted(unknown))}")
+        if default_model != AUTO and default_model not in allowed_models:
+            raise ValueError(f"Default model {default_model} is not in allowed models")
+
+        self.default_model = default_model
+        self.allowed_models = tuple(allowed_models)
+        self.pool_size = pool_size
+        # Split the cores between the sessions that can run at once
+        self.intra_op_threads = intra_op_threads or max(1, (os.cpu_count() or 1) // pool_size)
+        self.inter_op_threads = inter_op_threads
+        self.default_budget_ms = default_budget_ms
+        self.session_timeout = session_timeout
+        # Pools hold idle sessions, or None for a slot whose session still has to be created
+        self._pools = {model: queue.Queue() for model in self.allowed_models}
+        self._created = {model: 0 for model in self.allowed_models}
+        self._latency_ms = {model: PRIOR_LATENCY_MS[model] for model in self.allowed_models}
+        self._lock = threading.Lock()
+
+    def resolve_model(self, model, image_size=None, budget_ms=None):
+        """
+        Return the engine to use for a request, raising ValueError if not allowed
+
+        'auto' needs the image size (width, height) and picks an engine by
+        expected latency (see choose_engine).
+        """
+        model = model or self.default_model
+        if model == AUTO:
+            return self.choose_engine(image_size or (1, 1), budget_ms)
+        if model not in self.allowed_models:
+            raise ValueError(f"Unknown model '{model}'. Available: {', '.join(self.allowed_models + (AUTO,))}")
+        return model
+
+    def models_by_quality(self):
+        """Allowed engines, best quality first"""
+        return [m for m in QUALITY_ORDER if m in self.allowed_models]
+
+    def _busy(self, model):
+        """True if every session of a rembg model is in use, so a request would queue"""
+        return self._created[model] >= self.pool_size and self._pools[model].empty()
+
+    def expected_latency_ms(self, model, image_size):
+        """Expected time to compute a mask for an image of image_size with model"""
+        if model in FAST_ENGINES:
+            width, height = image_size
+            scale = min(1.0, FAST_ENGINE_MAX_SIDE / max(width, height))
+            return self._latency_ms[model] * (width * scale) * (height * scale) / 1e6
+        # A busy pool means waiting for a running inference first
+        return self._latency_ms[model] * (2 if self._busy(model) else 1)
+
+    def choose_engine(self, image_size, budget_ms=None):
+        """Pick the best quality allowed engine expected to fit the latency budget"""
+        budget_ms = budget_ms or self.default_budget_ms
+        candidates = self.models_by_quality()
+        for model in candidates:
+            if self.expected_latency_ms(model, image_size) <= budget_ms:
+                return model
+        # Nothing fits: take the fastest
+        return min(candidates, key=lambda m: self.expected_latency_ms(m, image_size))
+
+    def _record_latency(self, model, elapsed_ms, image_size):
+        if model in FAST_ENGINES:
+            width, height = image_size
+            scale = min(1.0, FAST_ENGINE_MAX_SIDE / max(width, height))
+            elapsed_ms = elapsed_ms * 1e6 / max(1.0, (width * scale) * (height * scale))
+        with self._lock:
+            # Exponentially weighted moving average
+            self._latency_ms[model] = 0.8 * self._latency_ms[model] + 0.2 * elapsed_ms
+
+    def _new_session(self, model):
+        import onnxruntime as ort
+        from rembg import new_session
+
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = self.intra_op_threads
+        sess_opts.inter_op_num_threads = self.inter_op_threads
+
+        try:
+            from rembg.sessions import sessions_class
+        except ImportError:
+            # Older rembg: thread settings come from OMP_NUM_THREADS only
+            return new_session(model)
+
+        for session_class in sessions_class:
+            if session_class.name() == model:
+                return session_class(model, sess_opts)
+        return new_session(model)
+
+    @contextmanager
+    def session(self, model):
+        """
+        Borrow a session for model from its pool, creating one if the pool is not full
+
+        Waits up to session_timeout seconds for a session to be returned, then
+        raises SessionUnavailable. If creating a session fails, its slot goes
+        back to the pool as a placeholder, so a waiting request creates it.
+        """
+        pool = self._pools[model]
+        try:
+            session = pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created[model] < self.pool_size
+                if create:
+                    self._created[model] += 1
+            session = None
+            if not create:
+                try:
+                    session = pool.get(timeout=self.session_timeout)
+                except queue.Empty:
+                    raise SessionUnavailable(
+                        f"No {model} session became free within {self.session_timeout:g}s"
+                    ) from None
+        if session is None:
+            try:
+                session = self._new_session(model)
+            except Exception:
+                pool.put(None)
+                raise
+        try:
+            yield session
+        finally:
+            pool.put(session)
+
+    def compute_mask(self, image, model=None, budget_ms=None):
+        """
+        Compute the foreground alpha mask of a PIL image
+
+        Returns (uint8 (h, w) mask array, model name used).
+        """
+        model = self.resolve_model(model, image.size, budget_ms)
+        start = time.perf_counter()
+
+        if model in FAST_ENGINES:
+            mask = FAST_ENGINES[model](image, max_side=FAST_ENGINE_MAX_SIDE)
+        else:
+            from rembg import remove
+
+            with self.session(model) as session:
+                mask = np.asarray(remove(image, session=session, only_mask=True).convert('L'))
+
+        self._record_latency(model, (time.perf_counter() - start) * 1000, image.size)
+        return mask, model
+
+    def warm_up(self, models=None):
+        """Load models and fill their session pools by running a tiny inference"""
+        from rembg import remove
+
+        test_image = Image.new('RGB', (64, 64), color='white')
+        for model in models or [self.default_model]:
+            model = self.resolve_model(model, test_image.size)
+            if model in FAST_ENGINES:
+                continue
+            with self._lock:
+                missing = self.pool_size - self._created[model]
+                self._created[model] = self.pool_size
+            for done in range(missing):
+                try:
+                    session = self._new_session(model)
+                except Exception:
+                    # Leave the remaining slots to requests, which create them on demand
+                    for _ in range(missing - done):
+                        self._pools[model].put(None)
+                    raise
+                remove(test_image, session=session)
+                self._pools[model].put(session)
+            print(f"[OK] Background removal model ready: {model} ({self.pool_size} sessions)")
@@ -0,0 +1,297 @@
+"""
+Bulk recognition of photo archives and recorded video
+
+    python bulk_recognize.py photos/ recordings/lobby.mp4 --output tags.jsonl --workers 8 --stride 10
+
+Inputs (files or directories, walked in sorted order) are read lazily: image
+paths are handed to worker processes that decode them, video frames are read
+with cv2.VideoCapture and only every --stride-th frame is decoded. Detection
+and encoding run in a process pool with at most --in-flight items queued, so
+memory stays flat however large the input is. Faces are matched against the
+gallery in this process and one JSON line per image or sampled frame is
+appended to --output, in input order:
+
+    {"source": "photos/a.jpg", "width": 4000, "height": 3000, "faces": [...]}
+    {"source": "recordings/lobby.mp4", "frame": 120, "time": 4.0, "width": 1920, "height": 1080, "faces": [...]}
+    {"source": "photos/broken.jpg", "error": "Could not decode image: ..."}
+
+faces uses the /recognize result format. Progress is checkpointed to
+<output>.checkpoint; running the same command again resumes after the last
+checkpoint (video resumes by seeking, which some codecs only do to the nearest
+keyframe). --restart discards earlier output.
+"""
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import cv2
+import face_recognition
+
+from face_service import FaceRecognitionService
+from image_decode import decode_image_file
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tif', '.tiff')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v')
+
+# Detection-only service of this worker process, created by init_worker
+_worker_service = None
+
+
+def init_worker(detector_options):
+    global _worker_service
+    _worker_service = FaceRecognitionService(**detector_options)
+
+
+def analyze(task, max_side=None):
+    """
+    Detect and encode the faces of an image path or a BGR video frame
+
+    Runs in a worker process. Returns (locations in original coordinates,
+    encodings, (width, height), error).
+    """
+    try:
+        if isinstance(task, str):
+            image, scale = decode_image_file(task, max_side)
+            height, width = round(image.shape[0] / scale), round(image.shape[1] / scale)
+        else:
+            height, width = task.shape[:2]
+            scale = min(1.0, max_side / max(height, width)) if max_side else 1.0
+            if scale < 1.0:
+                task = cv2.resize(task, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+            image = cv2.cvtColor(task, cv2.COLOR_BGR2RGB)
+
+        locations = _worker_service.detect_faces(image)
+        encodings = face_recognition.face_encodings(image, locations)
+    except Exception as e:
+        return None, None, None, str(e)
+
+    if scale != 1.0:
+        locations = [tuple(int(round(value / scale)) for value in box) for box in locations]
+    return locations, encodings, (width, height), None
+
+
+def iter_sources(inputs):
+    """Image and video files under inputs, in a stable order"""
+    for path in inputs:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS):
+                    yield os.path.join(root, name)
+
+
+def iter_video_frames(path, stride, start=0):
+    """(frame index, seconds, BGR frame) for every stride-th frame from start"""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video: {path}")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+        if start:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        index = start
+        while True:
+            if (index - start) % stride:
+                # Skipped frames are demuxed but not decoded
+                if not capture.grab():
+                    break
+            else:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield index, round(index / fps, 3) if fps else None, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+def iter_items(inputs, stride, resume_after=None):
+    """
+    Yield (record, task) for every image and every stride-th video frame
+
+    task is what analyze() takes, or None if the record is already final.
+    resume_after is the (source, frame) of the last item already written.
+    """
+    skipping = resume_after is not None
+    for source in iter_sources(inputs):
+        start = 0
+        if skipping:
+            if source != resume_after[0]:
+                continue
+            skipping = False
+            if resume_after[1] is None:
+                continue
+            start = resume_after[1] + stride
+
+        if not source.lower().endswith(VIDEO_EXTENSIONS):
+            yield {"source": source}, source
+            continue
+        try:
+            for index, seconds, frame in iter_video_frames(source, stride, start):
+                yield {"source": source, "frame": index, "time": seconds}, frame
+        except ValueError as e:
+            yield {"source": source, "error": str(e)}, None
+
+    if skipping:
+        raise ValueError(f"Checkpoint source not found in inputs: {resume_after[0]}")
+
+
+def load_checkpoint(path, inputs, stride):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["inputs"] != inputs or checkpoint["stride"] != stride:
+        raise ValueError("Checkpoint was written for other inputs or stride; use --restart")
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def run(args):
+    checkpoint_path = f"{args.output}.checkpoint"
+    if args.restart:
+        for path in (args.output, checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    checkpoint = load_checkpoint(checkpoint_path, args.inputs, args.stride)
+    if checkpoint is None:
+        if os.path.exists(args.output) and os.path.getsize(args.output):
+            raise ValueError(f"{args.output} exists without a checkpoint; use --restart to overwrite it")
+        checkpoint = {"inputs": args.inputs, "stride": args.stride, "last": None, "items": 0, "output_bytes": 0}
+    elif checkpoint["last"] is not None:
+        print(f"[OK] Resuming after {checkpoint['items']} items ({checkpoint['last'][0]})")
+
+    service = FaceRecognitionService(
+        known_faces_dir=args.known_faces, tolerance=args.tolerance, top_k=args.top_k, index=args.index,
+        storage=args.storage
+    )
+    service.load_known_faces(workers=args.workers)
+
+    detector_options = {
+        "detector": args.detector,
+        "allowed_detectors": (args.detector,),
+        "detection_scale": args.detection_scale,
+        "upsample": args.upsample,
+        "detector_files": {
+            'haar_cascade': os.environ.get('DETECTOR_HAAR_CASCADE') or None,
+            'lbp_cascade': os.environ.get('DETECTOR_LBP_CASCADE') or None,
+            'yunet_model': os.environ.get('DETECTOR_YUNET_MODEL') or None,
+        },
+    }
+    executor = None
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(detector_options,))
+    else:
+        init_worker(detector_options)
+    in_flight = args.in_flight or 2 * args.workers
+
+    started = time.perf_counter()
+    done = 0
+    faces = 0
+
+    def submit(task):
+        if executor is not None:
+            return executor.submit(analyze, task, args.max_side)
+        future = Future()
+        future.set_result(analyze(task, args.max_side))
+        return future
+
+    def finish(record, future, out):
+        nonlocal done, faces
+        if future is not None:
+            locations, encodings, size, error = future.result()
+            if error:
+                record["error"] = error
+            else:
+                record["width"], record["height"] = size
+                record["faces"] = service.build_results(locations, service.match_encodings(encodings))
+                if args.with_encodings:
+                    for face, encoding in zip(record["faces"], encodings):
+                        face["encoding"] = [round(float(value), 6) for value in encoding]
+                faces += len(encodings)
+
+        if record.get("faces") or "error" in record or not args.skip_empty:
+            out.write(json.dumps(record) + "\n")
+
+        done += 1
+        checkpoint["last"] = [record["source"], record.get("frame")]
+        checkpoint["items"] += 1
+        if done % args.checkpoint_every == 0:
+            commit(out)
+            rate = done / (time.perf_counter() - started)
+            print(f"[OK] {checkpoint['items']} items, {faces} faces ({rate:.1f} items/s)")
+
+    def commit(out):
+        # The output must be on disk before the checkpoint points past it
+        out.flush()
+        os.fsync(out.fileno())
+        checkpoint["output_bytes"] = out.tell()
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    # Items finish in input order, so the checkpoint is always a clean prefix
+    pending = deque()
+    with open(args.output, 'a') as out:
+        out.truncate(checkpoint["output_bytes"])
+        try:
+            for record, task in iter_items(args.inputs, args.stride, checkpoint["last"]):
+                pending.append((record, submit(task) if task is not None else None))
+                if len(pending) >= in_flight:
+                    finish(*pending.popleft(), out)
+            while pending:
+                finish(*pending.popleft(), out)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            commit(out)
+
+    elapsed = time.perf_counter() - started
+    print(f"\n[OK] {done} items, {faces} faces in {elapsed:.1f}s "
+          f"({done / elapsed if elapsed else 0:.1f} items/s) -> {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="image/video files or directories")
+    parser.add_argument('--output', required=True, help="JSONL file to append results to")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--in-flight', type=int, default=0, help="items queued for workers (default 2 x workers)")
+    parser.add_argument('--stride', type=int, default=1, help="analyze every Nth video frame")
+    parser.add_argument('--max-side', type=int, default=0, help="downscale inputs to this long side (0 = as is)")
+    parser.add_argument('--skip-empty', action='store_true', help="don't write items without faces")
+    parser.add_argument('--with-encodings', action='store_true', help="include each face's 128-d encoding")
+    parser.add_argument('--checkpoint-every', type=int, default=100, help="items between checkpoints")
+    parser.add_argument('--restart', action='store_true', help="discard earlier output and checkpoint")
+    parser.add_argument('--known-faces', default='known_faces')
+    parser.add_argument('--tolerance', type=float, default=float(os.environ.get('FACE_TOLERANCE', 0.6)))
+    parser.add_argument('--top-k', type=int, default=int(os.environ.get('FACE_TOP_K', 1)))
+    parser.add_argument('--index', default=os.environ.get('FACE_INDEX', 'exact'))
+    parser.add_argument('--storage', default=os.environ.get('FACE_STORAGE', 'float32'), help="float32, float16 or int8")
+    parser.add_argument('--detector', default=os.environ.get('FACE_DETECTOR', 'hog'))
+    parser.add_argument('--detection-scale', type=float, default=float(os.environ.get('DETECTION_SCALE', 1.0)))
+    parser.add_argument('--upsample', type=int, default=int(os.environ.get('DETECTION_UPSAMPLE', 1)))
+    args = parser.parse_args()
+
+    if args.stride < 1:
+        parser.error("--stride must be at least 1")
+    try:
+        run(args)
+    except ValueError as e:
+        print(f"[X] {str(e)}")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""
+Persistent on-disk cache of face encodings for the known_faces gallery
+
+Each image in known_faces/ is keyed by filename, size, mtime and a SHA-256
+content hash. On startup only new or changed images are re-encoded; everything
+else is loaded straight from the cache.
+
+Usage:
+    python encoding_cache.py verify   # check the cache against known_faces/
+    python encoding_cache.py rebuild  # throw the cache away and re-encode all
+"""
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+# 2: gallery images are decoded with their EXIF orientation applied
+CACHE_VERSION = 2
+ENCODINGS_FILE = '.encoding_cache.npz'
+MANIFEST_FILE = '.encoding_cache.json'
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Return the hex SHA-256 digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _array_sha256(array):
+    return hashlib.sha256(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+class EncodingCache:
+    """
+    Encodings live in a single .npz matrix, the manifest in a JSON file next to
+    it. The manifest stores a checksum of the matrix so that a torn or corrupted
+    cache is detected and discarded instead of serving stale identities.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.encodings_path = os.path.join(cache_dir, ENCODINGS_FILE)
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+        self.entries = {}
+        self.dirty = False
+
+    def load(self):
+        """
+        Load the cache from disk. Returns False (and starts empty) if the cache
+        is missing, from another version, or fails its integrity check.
+        """
+        self.entries = {}
+        if not (os.path.exists(self.encodings_path) and os.path.exists(self.manifest_path)):
+            return False
+
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            with np.load(self.encodings_path) as data:
+                encodings = data['encodings']
+        except Exception as e:
+            print(f"[X] Encoding cache unreadable, ignoring it: {e}")
+            self.dirty = True
+            return False
+
+        if manifest.get('version') != CACHE_VERSION:
+            print("[X] Encoding cache version mismatch, ignoring it")
+            self.dirty = True
+            return False
+
+        if manifest.get('checksum') != _array_sha256(encodings):
+            print("[X] Encoding cache checksum mismatch, ignoring it")
+            self.dirty = True
+            return False
+
+        for filename, entry in manifest.get('files', {}).items():
+            index = entry.get('index')
+            encoding = encodings[index].copy() if index is not None else None
+            self.entries[filename] = {
+                'size': entry['size'],
+                'mtime_ns': entry['mtime_ns'],
+                'sha256': entry['sha256'],
+                'encoding': encoding,
+            }
+        return True
+
+    def lookup(self, filename, path):
+        """
+        Return (hit, encoding) for an image. A hit with encoding None means the
+        image is known to contain no face.
+        """
+        entry = self.entries.get(filename)
+        if entry is None:
+            return False, None
+
+        stat = os.stat(path)
+        if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+            return True, entry['encoding']
+
+        # Touched but possibly unchanged (e.g. copied or restored from backup)
+        if stat.st_size == entry['size'] and file_sha256(path) == entry['sha256']:
+            entry['mtime_ns'] = stat.st_mtime_ns
+            self.dirty = True
+            return True, entry['encoding']
+
+        return False, None
+
+    def store(self, filename, path, encoding):
+        """Record the encoding (or None for 'no face') computed for an image"""
+        stat = os.stat(path)
+        self.entries[filename] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_sha256(path),
+            'encoding': None if encoding is None else np.asarray(encoding, dtype=np.float64),
+        }
+        self.dirty = True
+
+    def forget(self, filenames):
+        """Drop entries for the given images"""
+        for filename in filenames:
+            if self.entries.pop(filename, None) is not None:
+                self.dirty = True
+
+    def prune(self, filenames):
+        """Drop entries for images that are no longer in the gallery"""
+        for filename in set(self.entries) - set(filenames):
+            del self.entries[filename]
+            self.dirty = True
+
+    def save(self):
+        """Atomically write the cache back to disk if anything changed"""
+        if not self.dirty:
+            return
+
+        files = {}
+        rows = []
+        for filename in sorted(self.entries):
+            entry = self.entries[filename]
+            index = None
+            if entry['encoding'] is not None:
+                index = len(rows)
+                rows.append(entry['encoding'])
+            files[filename] = {
+                'size': entry['size'],
+                'mtime_ns': entry['mtime_ns'],
+                'sha256': entry['sha256'],
+                'index': index,
+            }
+
+        encodings = np.array(rows, dtype=np.float64).reshape(len(rows), 128)
+        manifest = {
+            'version': CACHE_VERSION,
+            'checksum': _array_sha256(encodings),
+            'files': files,
+        }
+
+        tmp_encodings = self.encodings_path + '.tmp.npz'
+        tmp_manifest = self.manifest_path + '.tmp'
+        np.savez(tmp_encodings, encodings=encodings)
+        with open(tmp_manifest, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_encodings, self.encodings_path)
+        os.replace(tmp_manifest, self.manifest_path)
+        self.dirty = False
+
+    def clear(self):
+        """Delete the cache files"""
+        self.entries = {}
+        self.dirty = True
+        for path in (self.encodings_path, self.manifest_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def verify(self, image_paths):
+        """
+        Check the cache against the images on disk by content hash.
+        Returns a list of problems; an empty list means the cache is sound.
+        """
+        problems = []
+        if not self.load():
+            return ["cache missing or failed integrity check"]
+
+        for filename, path in image_paths.items():
+            entry = self.entries.get(filename)
+            if entry is None:
+                problems.append(f"{filename}: not in cache")
+            elif file_sha256(path) != entry['sha256']:
+                problems.append(f"{filename}: content changed since it was cached")
+
+        for filename in set(self.entries) - set(image_paths):
+            problems.append(f"{filename}: cached but no longer on disk")
+
+        return problems
+
+
+def main():
+    from face_service import FaceRecognitionService
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('verify', 'rebuild'):
+        print("Usage: python encoding_cache.py verify|rebuild [known_faces_dir]")
+        sys.exit(2)
+
+    command = sys.argv[1]
+    known_faces_dir = sys.argv[2] if len(sys.argv) > 2 else 'known_faces'
+    service = FaceRecognitionService(known_faces_dir)
+
+    if command == 'rebuild':
+        service.load_known_faces(rebuild_cache=True, workers=os.cpu_count() or 1)
+        return
+
+    problems = EncodingCache(known_faces_dir).verify(service.list_gallery_images())
+    if problems:
+        print("Encoding cache is NOT valid:")
+        for problem in problems:
+            print(f"  [X] {problem}")
+        print("Run: python encoding_cache.py rebuild")
+        sys.exit(1)
+    print("[OK] Encoding cache is valid")
+
+
+if __name__ == '__main__':
+    main()
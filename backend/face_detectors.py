@@ -0,0 +1,151 @@
+"""
+Pluggable face detectors
+
+Every detector takes a uint8 RGB array and returns boxes as (top, right,
+bottom, left) in image coordinates, the format face_recognition's landmark and
+encoding step expects. Backends:
+
+    hog     dlib HOG via face_recognition (default)
+    cnn     dlib CNN (MMOD) via face_recognition: most accurate, slow on CPU
+    haar    OpenCV Haar cascade shipped with opencv-python
+    lbp     OpenCV LBP cascade (pass the .xml path; not shipped in the wheel)
+    yunet   OpenCV FaceDetectorYN DNN (pass the .onnx model path)
+
+OpenCV boxes are framed differently from dlib's, so they are normalized
+(resized about their centre and shifted) to match HOG boxes before the
+5-point landmark model sees them. benchmarks/detectors.py measures the
+adjustment a backend needs on your own images.
+"""
+import os
+import threading
+
+import cv2
+
+DETECTORS = ('hog', 'cnn', 'haar', 'lbp', 'yunet')
+
+
+def normalize_boxes(boxes, image_shape, scale=1.0, shift=0.0):
+    """
+    Convert (x, y, w, h) boxes to clipped (top, right, bottom, left)
+
+    Each box is resized about its centre by scale and moved down by shift
+    times its height. Degenerate boxes are dropped.
+    """
+    height, width = image_shape[:2]
+    locations = []
+    for x, y, w, h in boxes:
+        cx = x + w / 2
+        cy = y + h / 2 + shift * h
+        half_w, half_h = w * scale / 2, h * scale / 2
+        top = max(0, int(round(cy - half_h)))
+        bottom = min(height, int(round(cy + half_h)))
+        left = max(0, int(round(cx - half_w)))
+        right = min(width, int(round(cx + half_w)))
+        if bottom - top > 1 and right - left > 1:
+            locations.append((top, right, bottom, left))
+    return locations
+
+
+class FaceDetector:
+    """detect(image, upsample) -> [(top, right, bottom, left)]"""
+    name = None
+
+    def detect(self, image, upsample=1):
+        raise NotImplementedError
+
+
+class DlibDetector(FaceDetector):
+    def __init__(self, model='hog'):
+        self.name = model
+        self.model = model
+
+    def detect(self, image, upsample=1):
+        import face_recognition
+
+        return face_recognition.face_locations(image, number_of_times_to_upsample=upsample, model=self.model)
+
+
+class CascadeDetector(FaceDetector):
+    """
+    OpenCV cascade classifier; upsample lowers the minimum face size instead of
+    enlarging the image. Classifiers are kept per thread.
+    """
+
+    def __init__(self, name, path, scale_factor=1.1, min_neighbors=5, min_size=40, box_scale=1.0, box_shift=0.0):
+        if not os.path.exists(path):
+            raise ValueError(f"Cascade file not found for {name}: {path}")
+        self.name = name
+        self.path = path
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+        self.box_scale = box_scale
+        self.box_shift = box_shift
+        self._local = threading.local()
+        if self._classifier().empty():
+            raise ValueError(f"Could not load cascade for {name}: {path}")
+
+    def _classifier(self):
+        classifier = getattr(self._local, 'classifier', None)
+        if classifier is None:
+            classifier = self._local.classifier = cv2.CascadeClassifier(self.path)
+        return classifier
+
+    def detect(self, image, upsample=1):
+        gray = cv2.equalizeHist(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY))
+        min_size = max(12, self.min_size >> upsample)
+        boxes = self._classifier().detectMultiScale(
+            gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors, minSize=(min_size, min_size)
+        )
+        return normalize_boxes(boxes, image.shape, self.box_scale, self.box_shift)
+
+
+class YuNetDetector(FaceDetector):
+    """OpenCV's FaceDetectorYN DNN; one network per thread"""
+    name = 'yunet'
+
+    def __init__(self, path, score_threshold=0.7, box_scale=1.0, box_shift=0.0):
+        if not os.path.exists(path):
+            raise ValueError(f"Model file not found for yunet: {path}")
+        self.path = path
+        self.score_threshold = score_threshold
+        self.box_scale = box_scale
+        self.box_shift = box_shift
+        self._local = threading.local()
+        self._network()
+
+    def _network(self):
+        network = getattr(self._local, 'network', None)
+        if network is None:
+            network = self._local.network = cv2.FaceDetectorYN.create(
+                self.path, "", (320, 320), self.score_threshold
+            )
+        return network
+
+    def detect(self, image, upsample=1):
+        network = self._network()
+        height, width = image.shape[:2]
+        network.setInputSize((width, height))
+        _, faces = network.detect(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+        if faces is None:
+            return []
+        return normalize_boxes(faces[:, :4], image.shape, self.box_scale, self.box_shift)
+
+
+def create_detector(name, haar_cascade=None, lbp_cascade=None, yunet_model=None):
+    """Build a detector backend by name; raises ValueError if it is unknown or its files are missing"""
+    if name in ('hog', 'cnn'):
+        return DlibDetector(name)
+    if name == 'haar':
+        # Haar boxes reach higher up the forehead than dlib's
+        path = haar_cascade or os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+        return CascadeDetector('haar', path, box_scale=0.9, box_shift=0.08)
+    if name == 'lbp':
+        if not lbp_cascade:
+            raise ValueError("lbp needs a cascade file (e.g. lbpcascade_frontalface_improved.xml)")
+        return CascadeDetector('lbp', lbp_cascade, min_neighbors=4, box_scale=0.95, box_shift=0.05)
+    if name == 'yunet':
+        if not yunet_model:
+            raise ValueError("yunet needs a model file (face_detection_yunet_2023mar.onnx)")
+        return YuNetDetector(yunet_model)
+    raise ValueError(f"Unknown detector: {name} (choose from {', '.join(DETECTORS)})")
@@ -0,0 +1,230 @@
+"""
+Vectorized nearest-neighbour matching of face encodings against the gallery
+
+The gallery is held as one contiguous float32 matrix with precomputed squared
+norms, so every face in a frame is matched in a single matrix product instead
+of one compare_faces/face_distance call per face. QuantizedMatcher scans rows
+stored as float16 or int8 instead (see quantize()), a half or a quarter of the
+float32 bytes.
+"""
+import numpy as np
+
+ENCODING_SIZE = 128
+STORAGE = ('float32', 'float16', 'int8')
+
+
+def as_encoding_matrix(encodings):
+    """Stack encodings into a contiguous (n, 128) float32 matrix"""
+    if len(encodings) == 0:
+        return np.empty((0, ENCODING_SIZE), dtype=np.float32)
+    return np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE))
+
+
+def quantization_scale(matrix):
+    """int8 scale of each dimension: its largest |x| / 127"""
+    peak = np.abs(matrix).max(axis=0) if len(matrix) else np.ones(ENCODING_SIZE, dtype=np.float32)
+    return (np.maximum(peak, 1e-6) / 127).astype(np.float32)
+
+
+def quantize(matrix, storage, scale=None):
+    """Store float32 rows as storage; int8 stores round(x / scale), clipping outliers"""
+    if storage == 'float32':
+        return matrix
+    if storage == 'float16':
+        return matrix.astype(np.float16)
+    return np.clip(np.rint(matrix / scale), -127, 127).astype(np.int8)
+
+
+def dequantize(rows, scale=None):
+    """Widen stored rows back to float32 (a copy unless they already are)"""
+    widened = np.asarray(rows, dtype=np.float32)
+    if rows.dtype == np.int8:
+        widened *= scale
+    return widened
+
+
+def stored_norms(rows, scale=None, block_rows=32768):
+    """Squared norms of stored rows, widening block_rows rows at a time"""
+    if len(rows) == 0:
+        return np.empty(0, dtype=np.float32)
+    norms = []
+    for start in range(0, len(rows), block_rows):
+        widened = dequantize(rows[start:start + block_rows], scale)
+        norms.append(np.einsum('ij,ij->i', widened, widened))
+    return np.concatenate(norms)
+
+
+def pairwise_distances(queries, matrix, squared_norms=None):
+    """
+    Euclidean distances between each query and each row of matrix, computed
+    as |q|^2 + |g|^2 - 2 q.g with a single matrix product
+    """
+    queries = as_encoding_matrix(queries)
+    if squared_norms is None:
+        squared_norms = np.einsum('ij,ij->i', matrix, matrix)
+    query_norms = np.einsum('ij,ij->i', queries, queries)
+    squared = query_norms[:, None] + squared_norms[None, :] - 2.0 * (queries @ matrix.T)
+    np.maximum(squared, 0.0, out=squared)
+    return np.sqrt(squared, out=squared)
+
+
+def top_k_smallest(distances, k):
+    """
+    Return (indices, values) of the k smallest entries of each row of a
+    distance matrix, sorted ascending
+    """
+    n_rows, n_cols = distances.shape
+    k = min(k, n_cols)
+    if k == 0:
+        return np.empty((n_rows, 0), dtype=np.int64), np.empty((n_rows, 0), dtype=distances.dtype)
+
+    if k < n_cols:
+        indices = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(n_cols), (n_rows, n_cols))
+    values = np.take_along_axis(distances, indices, axis=1)
+
+    order = np.argsort(values, axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+class FaceMatcher:
+    """Exact brute-force matcher over the whole gallery"""
+
+    def __init__(self, encodings=(), ids=None):
+        self.build(encodings, ids)
+
+    @classmethod
+    def wrap(cls, rows, squared_norms, scale=None):
+        """
+        Match against stored gallery rows (see IdentityGallery.centroids) and
+        their squared norms without copying them; ids are the row positions
+        """
+        matcher = cls.__new__(cls)
+        matcher.matrix = rows
+        matcher.squared_norms = squared_norms
+        matcher.ids = None
+        return matcher
+
+    def build(self, encodings, ids=None):
+        """
+        Replace the gallery with the given encodings. ids are the values
+        returned by search(); they default to the row positions.
+        """
+        self.matrix = as_encoding_matrix(encodings)
+        self.squared_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        if ids is None:
+            ids = np.arange(len(self.matrix))
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+    def _positions(self):
+        if self.ids is None:
+            self.ids = np.arange(len(self), dtype=np.int64)
+        return self.ids
+
+    def add(self, encodings, ids):
+        """Append encodings with the given ids"""
+        encodings = as_encoding_matrix(encodings)
+        self.matrix = np.ascontiguousarray(np.vstack([self.matrix, encodings]))
+        self.squared_norms = np.concatenate([self.squared_norms, np.einsum('ij,ij->i', encodings, encodings)])
+        self.ids = np.concatenate([self._positions(), np.asarray(ids, dtype=np.int64)])
+
+    def remove(self, ids):
+        """Drop the rows with the given ids"""
+        keep = ~np.isin(self._positions(), np.asarray(ids, dtype=np.int64))
+        self.matrix = np.ascontiguousarray(self.matrix[keep])
+        self.squared_norms = self.squared_norms[keep]
+        self.ids = self.ids[keep]
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def distances(self, queries):
+        """Euclidean distances from each query to every gallery row, shape (n, gallery)"""
+        return pairwise_distances(queries, self.matrix, self.squared_norms)
+
+    def search(self, queries, k=1):
+        """
+        Find the k nearest gallery rows for each query
+
+        Returns (ids, distances), both of shape (n_queries, min(k, gallery)).
+        """
+        positions, distances = top_k_smallest(self.distances(queries), k)
+        if self.ids is None:
+            return positions, distances
+        return self.ids[positions], distances
+
+    @property
+    def nbytes(self):
+        """Bytes of the matcher's arrays, including wrapped (possibly shared) ones"""
+        ids_bytes = 0 if self.ids is None else self.ids.nbytes
+        return self.matrix.nbytes + self.squared_norms.nbytes + ids_bytes
+
+
+class QuantizedMatcher(FaceMatcher):
+    """
+    Brute-force matcher over float16 or int8 rows
+
+    float16 halves the matrix. int8 stores round(x / scale) with one scale per
+    dimension (the largest |x| of that dimension / 127), a quarter of float32.
+    Rows are widened to float32 block by block during the matrix product, so
+    only block_rows rows are ever held at full width. Distances are to the
+    stored rows. The service wraps the gallery's own stored centroids (see
+    wrap()), so no float32 copy of the gallery is kept.
+    """
+
+    def __init__(self, encodings=(), ids=None, storage='int8', block_rows=32768):
+        if storage not in ('float16', 'int8'):
+            raise ValueError(f"Unknown quantized storage: {storage}")
+        self.storage = storage
+        self.block_rows = block_rows
+        self.scale = None
+        super().__init__(encodings, ids)
+
+    @classmethod
+    def wrap(cls, rows, squared_norms, scale=None, block_rows=32768):
+        matcher = super().wrap(rows, squared_norms)
+        matcher.storage = str(rows.dtype)
+        matcher.scale = scale
+        matcher.block_rows = block_rows
+        return matcher
+
+    @property
+    def codes(self):
+        return self.matrix
+
+    def _blocks(self):
+        """(start, float32 block) over the stored rows, without the int8 scale"""
+        for start in range(0, len(self.matrix), self.block_rows):
+            yield start, self.matrix[start:start + self.block_rows].astype(np.float32)
+
+    def build(self, encodings, ids=None):
+        matrix = as_encoding_matrix(encodings)
+        if self.storage == 'int8':
+            self.scale = quantization_scale(matrix)
+        self.matrix = quantize(matrix, self.storage, self.scale)
+        # Norms of the stored rows, so that distances are consistent with them
+        self.squared_norms = stored_norms(self.matrix, self.scale, self.block_rows)
+        if ids is None:
+            ids = np.arange(len(self.matrix))
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+    def add(self, encodings, ids):
+        """Append encodings; int8 keeps its scales, so outliers are clipped"""
+        codes = quantize(as_encoding_matrix(encodings), self.storage, self.scale)
+        self.matrix = np.ascontiguousarray(np.vstack([self.matrix, codes]))
+        self.squared_norms = np.concatenate([self.squared_norms, stored_norms(codes, self.scale)])
+        self.ids = np.concatenate([self._positions(), np.asarray(ids, dtype=np.int64)])
+
+    def distances(self, queries):
+        queries = as_encoding_matrix(queries)
+        # q . (scale * c) == (q * scale) . c, so the codes are never rescaled
+        scaled = queries * self.scale if self.storage == 'int8' else queries
+        products = np.empty((len(queries), len(self.matrix)), dtype=np.float32)
+        for start, block in self._blocks():
+            products[:, start:start + len(block)] = scaled @ block.T
+
+        query_norms = np.einsum('ij,ij->i', queries, queries)
+        squared = query_norms[:, None] + self.squared_norms[None, :] - 2.0 * products
+        np.maximum(squared, 0.0, out=squared)
+        return np.sqrt(squared, out=squared)
@@ -1,107 +1,996 @@
-import face_recognition
+import hashlib
+import multiprocessing
 import os
+import re
+import threading
+import time
 import numpy as np
 import cv2
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+
+from ann_index import IVFIndex
+from encoding_cache import EncodingCache
+from face_detectors import DETECTORS, create_detector
+from face_matcher import STORAGE, FaceMatcher, QuantizedMatcher, as_encoding_matrix, dequantize
+from identity_gallery import IdentityGallery, StringTable
+from image_decode import ImageDecodeError, decode_image, decode_image_file
+from metrics import stage
+from shared_gallery import SharedGallery
+
+
+def encode_image_file(image_path):
+    """
+    Decode an image file and compute its face encodings
+    
+    Module-level so it can run in a worker process. Returns a tuple
+    (encodings, error) where error is a message if the image could not be read.
+    """
+    import face_recognition
+    
+    filename = os.path.basename(image_path)
+    try:
+        # Contiguous uint8 RGB whatever the file's mode, with EXIF orientation applied
+        try:
+            image, _ = decode_image_file(image_path)
+        except ImageDecodeError:
+            return None, f"Could not load image: {filename}"
+        
+        # Get face encodings
+        return face_recognition.face_encodings(image), None
+        
+    except Exception as e:
+        return None, f"Error loading {filename}: {str(e)}"
+
+
+# Identity names become directory names under known_faces/
+VALID_NAME = re.compile(r"[\w][\w .'-]{0,99}")
+
+
+def valid_name(name):
+    """Strip and check an identity name; raises ValueError"""
+    name = (name or '').strip()
+    if not VALID_NAME.fullmatch(name):
+        raise ValueError("Invalid name")
+    return name
+
+
+def shard_of(name, count):
+    """Shard (0..count-1) that holds identity name, stable across processes and restarts"""
+    return int(hashlib.sha1(name.encode()).hexdigest()[:8], 16) % count
+
+
+class GallerySnapshot:
+    """
+    One published version of the gallery
+    
+    samples maps image key -> encoding; gallery and matcher are built from it.
+    A snapshot is never modified after it is published: updates build a new
+    one and swap it in, so a recognition that took a snapshot always sees a
+    consistent gallery. With a shared or quantized gallery samples is None
+    outside of updates; writers re-read them from the encoding cache.
+    """
+    
+    def __init__(self, samples, gallery, matcher):
+        self.samples = samples
+        self.gallery = gallery
+        self.matcher = matcher
+
 
 class FaceRecognitionService:
-    def __init__(self, known_faces_dir='known_faces'):
+    def __init__(self, known_faces_dir='known_faces', tolerance=0.6, top_k=1, index='exact', n_probe=8,
+                 max_medoids=3, prune_k=10, detection_scale=1.0, upsample=1, adaptive_detection=False,
+                 detector='hog', allowed_detectors=('hog',), detector_files=None, shard=None,
+                 storage='float32', rescore=True):
+        unknown = set(allowed_detectors) - set(DETECTORS)
+        if unknown:
+            raise ValueError(f"Unsupported face detectors: {', '.join(sorted(unknown))}")
+        if detector not in allowed_detectors:
+            raise ValueError(f"Default detector {detector} is not in allowed detectors")
+        if storage not in STORAGE:
+            raise ValueError(f"Unknown gallery storage '{storage}'. Available: {', '.join(STORAGE)}")
+        if storage != 'float32' and index != 'exact':
+            raise ValueError("Quantized gallery storage requires the exact index")
+
         self.known_faces_dir = known_faces_dir
-        self.known_face_encodings = []
-        self.known_face_names = []
+        # (index, count): only load the identities of this gallery shard
+        self.shard = shard
+        self.tolerance = tolerance
+        self.top_k = top_k
+        self.index = index
+        self.n_probe = n_probe
+        self.max_medoids = max_medoids
+        self.prune_k = prune_k
+        # Template rows are stored as float32, float16 or int8; the matcher scans
+        # their centroids and with rescore re-ranks its shortlist against the
+        # full float32 templates (memory-mapped originals when quantized)
+        self.storage = storage
+        self.rescore = rescore
+        # Detection runs on a copy resized by detection_scale; encodings always
+        # use the full-resolution image
+        self.detection_scale = detection_scale
+        self.upsample = upsample
+        self.adaptive_detection = adaptive_detection
+        self.default_detector = detector
+        self.allowed_detectors = tuple(dict.fromkeys(allowed_detectors))
+        # Cascade/model paths passed to create_detector (haar_cascade, lbp_cascade, yunet_model)
+        self.detector_files = detector_files or {}
+        self._detectors = {}
+        self._detector_lock = threading.Lock()
+        self._snapshot = GallerySnapshot(
+            {}, IdentityGallery(max_medoids=max_medoids, storage=storage, keep_exact=rescore), FaceMatcher()
+        )
+        # Serializes gallery writers (enroll, unenroll, directory sync); readers never lock
+        self._update_lock = threading.RLock()
+        # (size, mtime_ns) of every gallery image the snapshot reflects
+        self._file_stats = {}
+        self._cache = None
+        self._watcher = None
+        self._shared = None
+        self._generation = None
+        self._refresh_lock = threading.Lock()
+        self._write_depth = 0
+        # UnknownFaceStore that keeps unmatched faces, if attached
+        self.unknown_faces = None
+        # ShardClient that matches against remote gallery shards, if attached
+        self.shards = None
+    
+    @property
+    def gallery(self):
+        return self._current().gallery
+    
+    @property
+    def matcher(self):
+        return self._current().matcher
+    
+    @property
+    def known_face_names(self):
+        """One entry per identity"""
+        gallery = self._current().gallery
+        if gallery.live.all():
+            return gallery.names
+        return [name for name, live in zip(gallery.names, gallery.live) if live]
+    
+    @property
+    def known_face_encodings(self):
+        """Identity centroids, in the order of known_face_names"""
+        gallery = self._current().gallery
+        return list(dequantize(gallery.centroids[gallery.live], gallery.scale))
+    
+    def use_shared_gallery(self, directory):
+        """
+        Serve the gallery from memory-mapped files shared with other processes
+        
+        Every update is published to directory as a new generation, and every
+        process maps the newest generation before matching (see
+        shared_gallery.py). Call before load_known_faces(); requires the
+        encoding cache, which is where writers read the current samples from.
+        """
+        self._shared = SharedGallery(directory)
+    
+    def _current(self):
+        """The snapshot to serve, remapping the shared gallery if another process updated it"""
+        shared = self._shared
+        # Generation 0 means nothing has been published yet
+        if shared is not None and shared.generation not in (0, self._generation):
+            with self._refresh_lock:
+                if shared.generation not in (0, self._generation):
+                    generation, gallery = shared.load()
+                    matcher = self._build_matcher(gallery, previous=self._snapshot, save=False)
+                    self._snapshot = GallerySnapshot(None, gallery, matcher)
+                    self._generation = generation
+        return self._snapshot
+    
+    @property
+    def _samples_on_disk(self):
+        """Whether samples live only in the encoding cache between updates"""
+        return self._shared is not None or self.storage != 'float32'
+    
+    @contextmanager
+    def _writing(self, reload=True):
+        """
+        Hold the gallery write lock; in shared mode also the cross-process lock
+        
+        A shared or quantized gallery keeps no per-image encodings in memory.
+        With reload, it first re-reads the samples (and in shared mode the file
+        stats, which another process may have changed) from the encoding
+        cache. They are dropped again afterwards so memory stays flat.
+        """
+        with self._update_lock:
+            if not self._samples_on_disk or self._write_depth > 0:
+                self._write_depth += 1
+                try:
+                    yield
+                finally:
+                    self._write_depth -= 1
+                return
+            
+            if reload and self._cache is None:
+                raise ValueError("Updating a shared or quantized gallery requires the encoding cache")
+            
+            with self._shared.lock() if self._shared is not None else nullcontext():
+                self._write_depth += 1
+                try:
+                    if reload:
+                        snapshot = self._current()
+                        self._cache.load()
+                        entries = self._cache.entries
+                        self._file_stats = {key: (e['size'], e['mtime_ns']) for key, e in entries.items()}
+                        samples = {key: e['encoding'] for key, e in entries.items() if e['encoding'] is not None}
+                        self._snapshot = GallerySnapshot(samples, snapshot.gallery, snapshot.matcher)
+                    yield
+                finally:
+                    self._write_depth -= 1
+                    snapshot = self._snapshot
+                    self._snapshot = GallerySnapshot(None, snapshot.gallery, snapshot.matcher)
+                    if self._cache is not None:
+                        self._cache.entries = {}
+                    # Only the watching process needs file stats between updates
+                    if self._shared is not None and self._watcher is None:
+                        self._file_stats = {}
+        
+    @property
+    def state_dir(self):
+        """Directory for the encoding cache and index; each shard keeps its own"""
+        if self.shard is None:
+            return self.known_faces_dir
+        path = os.path.join(self.known_faces_dir, f".shard-{self.shard[0]}-of-{self.shard[1]}")
+        os.makedirs(path, exist_ok=True)
+        return path
+    
+    def list_gallery_images(self):
+        """
+        Return {key: path} for every enrollable image in the gallery
+        
+        known_faces/Name.jpg is a single photo of Name (key 'Name.jpg');
+        known_faces/Name/*.jpg are several photos of Name (keys 'Name/x.jpg').
+        """
+        valid_extensions = ['.jpg', '.jpeg', '.png']
+        images = {}
+        
+        for filename in sorted(os.listdir(self.known_faces_dir)):
+            path = os.path.join(self.known_faces_dir, filename)
+            
+            if os.path.isdir(path) and not filename.startswith('.'):
+                for sample in sorted(os.listdir(path)):
+                    if os.path.splitext(sample)[1].lower() in valid_extensions:
+                        images[f"{filename}/{sample}"] = os.path.join(path, sample)
+                continue
+            
+            name, ext = os.path.splitext(filename)
+            if ext.lower() in valid_extensions:
+                images[filename] = path
+        
+        if self.shard is not None:
+            index, count = self.shard
+            images = {key: path for key, path in images.items() if shard_of(self.identity_name(key), count) == index}
+        return images
+    
+    @staticmethod
+    def identity_name(key):
+        """Identity a gallery image key belongs to"""
+        if '/' in key:
+            return key.split('/', 1)[0]
+        return os.path.splitext(key)[0]
+    
+    def _encode_images(self, pending, workers):
+        """
+        Encode {filename: path} and yield (filename, encodings, error) as each
+        image finishes. With workers > 1 the work is spread over a process pool.
+        """
+        if workers <= 1 or len(pending) <= 1:
+            for filename, image_path in pending.items():
+                encodings, error = encode_image_file(image_path)
+                yield filename, encodings, error
+            return
+        
+        # fork() from a background thread of a threaded server can deadlock the children
+        context = None
+        if threading.current_thread() is not threading.main_thread():
+            context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = {
+                executor.submit(encode_image_file, image_path): filename
+                for filename, image_path in pending.items()
+            }
+            for future in as_completed(futures):
+                encodings, error = future.result()
+                yield futures[future], encodings, error
+    
+    def load_known_faces(self, use_cache=True, rebuild_cache=False, workers=1, token=None):
+        """
+        Load all known faces from the known_faces directory
+        
+        Encodings are cached on disk (see encoding_cache.py) so only new or
+        changed images are re-encoded on restart. Pass rebuild_cache=True to
+        discard the cache and re-encode everything.
+        
+        workers > 1 encodes images in parallel worker processes. Results are
+        reported as they arrive, but the gallery is always assembled in sorted
+        filename order so known_face_names is deterministic.
+        
+        With a shared gallery, processes passing the same token (one per
+        server start) load known_faces/ only once: the first one loads and
+        publishes, the others wait for it and map what it published.
+        """
+        if self._samples_on_disk and not use_cache:
+            raise ValueError("A shared or quantized gallery requires the encoding cache")
+        
+        if self._shared is not None and token is not None:
+            with self._shared.lock('load.lock'):
+                if self._shared.loaded_by() == token and self._shared.generation:
+                    self._cache = EncodingCache(self.state_dir)
+                    print(f"[OK] Mapped the shared gallery: {len(self.known_face_names)} identities")
+                    return
+                self.load_known_faces(use_cache, rebuild_cache, workers)
+                self._shared.mark_loaded(token)
+            return
         
-    def load_known_faces(self):
-        """Load all known faces from the known_faces directory"""
         if not os.path.exists(self.known_faces_dir):
             os.makedirs(self.known_faces_dir)
             print(f"Created directory: {self.known_faces_dir}")
             print("Please add face images to this directory!")
-            return
+            if self._shared is None:
+                return
         
-        valid_extensions = ['.jpg', '.jpeg', '.png']
+        cache = EncodingCache(self.state_dir) if use_cache else None
+        if cache is not None:
+            if rebuild_cache:
+                cache.clear()
+            else:
+                cache.load()
         
-        for filename in os.listdir(self.known_faces_dir):
-            name, ext = os.path.splitext(filename)
+        images = self.list_gallery_images()
+        file_stats = self._stat_images(images)
+        encodings_by_file = {}
+        pending = {}
+        
+        for filename, image_path in images.items():
+            if cache is not None:
+                hit, encoding = cache.lookup(filename, image_path)
+                if hit:
+                    encodings_by_file[filename] = encoding
+                    continue
+            pending[filename] = image_path
+        
+        cached_count = len(encodings_by_file)
+        
+        for filename, encodings, error in self._encode_images(pending, workers):
+            # Show the photo as well for multi-image identities
+            name = filename if '/' in filename else self.identity_name(filename)
             
-            if ext.lower() in valid_extensions:
-                image_path = os.path.join(self.known_faces_dir, filename)
+            if error is not None:
+                print(f"[X] {error}")
+                continue
+            
+            if len(encodings) > 0:
+                encodings_by_file[filename] = encodings[0]
+                print(f"[OK] Loaded: {name}")
+            else:
+                encodings_by_file[filename] = None
+                print(f"[X] No face found in: {filename}")
+            
+            if cache is not None:
+                cache.store(filename, pending[filename], encodings_by_file[filename])
+        
+        samples = {
+            filename: encodings_by_file[filename]
+            for filename in images
+            if encodings_by_file.get(filename) is not None
+        }
+        
+        if cache is not None:
+            cache.prune(images)
+        
+        with self._writing(reload=False):
+            self._cache = cache
+            self._file_stats = file_stats
+            self._save_cache()
+            self._publish(samples)
+        
+        if cached_count:
+            print(f"[OK] {cached_count} image(s) loaded from encoding cache")
+        
+        print(f"\nTotal known faces loaded: {len(self.known_face_names)} "
+              f"identities from {len(samples)} images")
+    
+    def resolve_detector(self, name=None):
+        """Return the detector name to use for a request, raising ValueError if not allowed"""
+        name = name or self.default_detector
+        if name not in self.allowed_detectors:
+            raise ValueError(f"Unknown detector '{name}'. Available: {', '.join(self.allowed_detectors)}")
+        return name
+    
+    def get_detector(self, name=None):
+        """The detector backend for name, created on first use"""
+        name = self.resolve_detector(name)
+        detector = self._detectors.get(name)
+        if detector is None:
+            with self._detector_lock:
+                detector = self._detectors.get(name)
+                if detector is None:
+                    detector = self._detectors[name] = create_detector(name, **self.detector_files)
+        return detector
+    
+    def warm_up_encoder(self):
+        """
+        Load dlib's landmark and encoding models (face_recognition is imported
+        lazily) and run one encoding, so the first request doesn't pay for it
+        """
+        import face_recognition
+        
+        blank = np.zeros((150, 150, 3), dtype=np.uint8)
+        face_recognition.face_encodings(blank, [(25, 125, 125, 25)])
+    
+    def _locate(self, detector, image_array, scale, upsample):
+        """Run detection on a copy resized by scale, boxes in original coordinates"""
+        if scale >= 1.0:
+            return detector.detect(image_array, upsample)
+        
+        small = cv2.resize(image_array, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        height, width = image_array.shape[:2]
+        
+        locations = []
+        for top, right, bottom, left in detector.detect(small, upsample):
+            locations.append((
+                max(0, int(round(top / scale))),
+                min(width, int(round(right / scale))),
+                min(height, int(round(bottom / scale))),
+                max(0, int(round(left / scale)))
+            ))
+        return locations
+    
+    def detect_faces(self, image_array, detector=None):
+        """
+        Find face boxes as (top, right, bottom, left) in full-resolution coordinates
+        
+        detector names an allowed backend (default: the service's detector).
+        With adaptive_detection, a downscaled pass that finds nothing is retried
+        at full resolution, so small faces are not lost on quiet frames.
+        """
+        backend = self.get_detector(detector)
+        with stage('detection'):
+            locations = self._locate(backend, image_array, self.detection_scale, self.upsample)
+            
+            if not locations and self.adaptive_detection and self.detection_scale < 1.0:
+                locations = self._locate(backend, image_array, 1.0, self.upsample)
+        
+        return locations
+    
+    def load_encodings(self, sample_names, sample_encodings):
+        """
+        Replace the gallery with already computed encodings
+        
+        sample_names[i] is the identity of sample_encodings[i]; several samples
+        may share a name and are aggregated into one identity template.
+        """
+        samples = {
+            f"{name}/{position}": encoding
+            for position, (name, encoding) in enumerate(zip(sample_names, sample_encodings))
+        }
+        with self._writing(reload=False):
+            self._publish(
+                samples, IdentityGallery.from_encodings(
+                    sample_names, sample_encodings, self.max_medoids, self.storage, self.rescore
+                )
+            )
+    
+    def _publish(self, samples, gallery=None, previous=None):
+        """Build a snapshot from {image key: encoding} and swap it in"""
+        if gallery is None:
+            gallery = IdentityGallery.from_encodings(
+                [self.identity_name(key) for key in samples], list(samples.values()), self.max_medoids, self.storage,
+                self.rescore
+            )
+        
+        if self._shared is not None:
+            # Serve the mapped copy too, so this process holds no private gallery
+            generation, gallery = self._shared.load(self._shared.publish(gallery))
+            self._generation = generation
+        elif gallery.exact_rows is not None:
+            gallery.exact_rows = self._map_exact_rows(gallery.exact_rows)
+        
+        # The index holds one centroid per identity; templates refine its shortlist
+        self._snapshot = GallerySnapshot(samples, gallery, self._build_matcher(gallery, previous))
+    
+    def _map_exact_rows(self, rows):
+        """
+        Write the float32 originals of a quantized gallery to a file and map it
+        
+        Re-scoring reads only the shortlisted rows, so they stay on disk and in
+        the page cache instead of on the heap. Readers of the previous snapshot
+        keep their mapping of the replaced file.
+        """
+        os.makedirs(self.state_dir, exist_ok=True)
+        path = os.path.join(self.state_dir, '.exact_templates.npy')
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, rows)
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+    
+    def apply_changes(self, updated=None, removed=()):
+        """
+        Apply incremental changes to the gallery and publish them atomically
+        
+        updated maps image key -> encoding for added or replaced images (None
+        drops the image, e.g. no face found); removed lists deleted image keys.
+        Only the identities touched are rebuilt. Returns their names.
+        """
+        with self._writing():
+            snapshot = self._snapshot
+            samples = dict(snapshot.samples)
+            touched = set()
+            
+            for key in removed:
+                if samples.pop(key, None) is not None:
+                    touched.add(self.identity_name(key))
+            
+            for key, encoding in (updated or {}).items():
+                if encoding is None:
+                    if samples.pop(key, None) is None:
+                        continue
+                else:
+                    samples[key] = encoding
+                touched.add(self.identity_name(key))
+            
+            if not touched:
+                return touched
+            
+            identities = {name: [] for name in touched}
+            for key, encoding in samples.items():
+                name = self.identity_name(key)
+                if name in identities:
+                    identities[name].append(encoding)
+            
+            self._publish(
+                samples, snapshot.gallery.updated(identities, stable_ids=self.index == 'ivf'), previous=snapshot
+            )
+            return touched
+    
+    @staticmethod
+    def _stat_images(images):
+        """{key: (size, mtime_ns)} for {key: path}, skipping files that vanished"""
+        stats = {}
+        for key, path in images.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[key] = (stat.st_size, stat.st_mtime_ns)
+        return stats
+    
+    def _save_cache(self):
+        if self._cache is not None:
+            self._cache.save()
+    
+    def enroll(self, name, image_bytes, image=None):
+        """
+        Add a photo of name to the gallery and to known_faces/name/
+        
+        image is the already decoded RGB array of image_bytes, if available.
+        The photo must contain exactly one face. Returns the new image key;
+        raises ValueError if the name or image is unusable.
+        """
+        name = valid_name(name)
+        return self.enroll_encoded(name, [self.encode_enrollment(image_bytes, image)])[0]
+    
+    def encode_enrollment(self, image_bytes, image=None):
+        """
+        Check and encode a photo for enroll_encoded() without enrolling it
+        
+        Returns (JPEG or PNG bytes, encoding); raises ValueError unless the
+        photo contains exactly one face.
+        """
+        import face_recognition
+        
+        if image is None:
+            image, _ = decode_image(image_bytes)
+        
+        encodings = face_recognition.face_encodings(image, self.detect_faces(image))
+        if len(encodings) == 0:
+            raise ValueError("No face found in image")
+        if len(encodings) > 1:
+            raise ValueError(f"Expected one face, found {len(encodings)}")
+        
+        # Keep JPEG/PNG uploads byte for byte, store anything else as JPEG
+        if not image_bytes.startswith((b'\x89PNG', b'\xff\xd8')):
+            image_bytes = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1].tobytes()
+        
+        return image_bytes, encodings[0]
+    
+    def enroll_encoded(self, name, samples):
+        """
+        Add already encoded photos of name: samples is a list of
+        (JPEG or PNG bytes, encoding). Returns the new image keys.
+        With shards attached they are stored by the shard that owns name.
+        """
+        name = valid_name(name)
+        if self.shards is not None:
+            keys = self.shards.enroll(name, samples)
+            for key in keys:
+                print(f"[OK] Enrolled: {key} (gallery shard)")
+            return keys
+        directory = os.path.join(self.known_faces_dir, name)
+        
+        with self._writing():
+            os.makedirs(directory, exist_ok=True)
+            updated = {}
+            for image_bytes, encoding in samples:
+                extension = '.png' if image_bytes.startswith(b'\x89PNG') else '.jpg'
+                filename = hashlib.sha256(image_bytes).hexdigest()[:16] + extension
+                key = f"{name}/{filename}"
+                path = os.path.join(directory, filename)
                 
-                try:
-                    # Load image using OpenCV (more reliable)
-                    image = cv2.imread(image_path)
-                    
-                    if image is None:
-                        print(f"[X] Could not load image: {filename}")
+                tmp_path = os.path.join(directory, f".{filename}.tmp")
+                with open(tmp_path, 'wb') as f:
+                    f.write(image_bytes)
+                os.replace(tmp_path, path)
+                
+                if self._cache is not None:
+                    self._cache.store(key, path, encoding)
+                self._file_stats.update(self._stat_images({key: path}))
+                updated[key] = encoding
+            
+            if self._cache is not None:
+                self._save_cache()
+            self.apply_changes(updated)
+        
+        for key in updated:
+            print(f"[OK] Enrolled: {key}")
+        return list(updated)
+    
+    def unenroll(self, name, key=None):
+        """
+        Remove an identity (or just its image key) from the gallery and delete its files
+        
+        Returns the removed image keys; an empty list means nothing matched.
+        """
+        if self.shards is not None:
+            keys = self.shards.unenroll(name, key)
+            for k in keys:
+                print(f"[OK] Unenrolled: {k} (gallery shard)")
+            return keys
+        
+        with self._writing():
+            keys = [
+                k for k in self._file_stats
+                if self.identity_name(k) == name and (key is None or k == key)
+            ]
+            
+            for k in keys:
+                path = os.path.join(self.known_faces_dir, k)
+                if os.path.exists(path):
+                    os.remove(path)
+                del self._file_stats[k]
+            
+            directory = os.path.join(self.known_faces_dir, name)
+            if keys and os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+            
+            if self._cache is not None:
+                self._cache.forget(keys)
+                self._save_cache()
+            self.apply_changes(removed=keys)
+        
+        for k in keys:
+            print(f"[OK] Unenrolled: {k}")
+        return keys
+    
+    def sync_from_disk(self, workers=1):
+        """
+        Apply images added, replaced or deleted in known_faces/ since the last load
+        
+        Only changed files are encoded. Returns True if the gallery changed.
+        """
+        if not os.path.isdir(self.known_faces_dir):
+            return False
+        
+        # Cheap check without locks; in shared mode _file_stats may lag behind
+        # other processes, which at worst costs one locked re-check
+        if self._stat_images(self.list_gallery_images()) == self._file_stats:
+            return False
+        
+        with self._writing():
+            images = self.list_gallery_images()
+            stats = self._stat_images(images)
+            changed = [key for key in stats if self._file_stats.get(key) != stats[key]]
+            removed = [key for key in self._file_stats if key not in stats]
+            if not changed and not removed:
+                return False
+            
+            updated = {}
+            pending = {}
+            for key in changed:
+                if self._cache is not None:
+                    hit, encoding = self._cache.lookup(key, images[key])
+                    if hit:
+                        updated[key] = encoding
                         continue
-                    
-                    # Convert BGR to RGB (OpenCV uses BGR by default)
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                    
-                    # Get face encodings
-                    encodings = face_recognition.face_encodings(image)
-                    
-                    if len(encodings) > 0:
-                        self.known_face_encodings.append(encodings[0])
-                        self.known_face_names.append(name)
-                        print(f"[OK] Loaded: {name}")
-                    else:
-                        print(f"[X] No face found in: {filename}")
-                        
+                pending[key] = images[key]
+            
+            for key, encodings, error in self._encode_images(pending, workers):
+                if error is not None:
+                    print(f"[X] {error}")
+                    updated[key] = None
+                    continue
+                updated[key] = encodings[0] if len(encodings) > 0 else None
+                if updated[key] is None:
+                    print(f"[X] No face found in: {key}")
+                if self._cache is not None:
+                    self._cache.store(key, pending[key], updated[key])
+            
+            if self._cache is not None:
+                self._cache.forget(removed)
+                self._save_cache()
+            self._file_stats = stats
+            self.apply_changes(updated, removed)
+        
+        print(f"[OK] Gallery synced: {len(changed)} changed, {len(removed)} removed image(s)")
+        return True
+    
+    def watch(self, interval):
+        """Poll known_faces/ every interval seconds in a daemon thread and apply changes"""
+        if self._watcher is not None:
+            return self._watcher
+        
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sync_from_disk()
                 except Exception as e:
-                    print(f"[X] Error loading {filename}: {str(e)}")
+                    print(f"[X] Gallery sync failed: {str(e)}")
         
-        print(f"\nTotal known faces loaded: {len(self.known_face_names)}")
+        self._watcher = threading.Thread(target=poll, name='gallery-watcher', daemon=True)
+        self._watcher.start()
+        return self._watcher
     
-    def recognize_faces(self, image_array):
+    def recognize_faces(self, image_array, detector=None):
         """
         Recognize faces in the given image
         Returns list of dictionaries with face locations and names
         """
-        results = []
+        import face_recognition
         
         # Find all face locations and encodings in the image
-        face_locations = face_recognition.face_locations(image_array)
-        face_encodings = face_recognition.face_encodings(image_array, face_locations)
+        face_locations = self.detect_faces(image_array, detector)
+        with stage('encoding'):
+            face_encodings = face_recognition.face_encodings(image_array, face_locations)
+        
+        candidates = self.match_encodings(face_encodings)
+        self.capture_unknown(image_array, face_locations, face_encodings, candidates)
+        return self.build_results(face_locations, candidates)
+    
+    def recognize_faces_batch(self, image_arrays, detector=None):
+        """
+        Recognize faces in several images
+        
+        Detection and encoding run per image, then all faces of the batch are
+        matched against the gallery in a single pass. Returns one result list
+        per image, in order.
+        """
+        import face_recognition
+        
+        locations_per_image = []
+        encodings_per_image = []
+        all_encodings = []
+        
+        for image_array in image_arrays:
+            face_locations = self.detect_faces(image_array, detector)
+            with stage('encoding'):
+                face_encodings = face_recognition.face_encodings(image_array, face_locations)
+            locations_per_image.append(face_locations)
+            encodings_per_image.append(face_encodings)
+            all_encodings.extend(face_encodings)
+        
+        all_candidates = self.match_encodings(all_encodings)
+        
+        results = []
+        offset = 0
+        for image_array, face_locations, face_encodings in zip(image_arrays, locations_per_image, encodings_per_image):
+            candidates = all_candidates[offset:offset + len(face_locations)]
+            self.capture_unknown(image_array, face_locations, face_encodings, candidates)
+            results.append(self.build_results(face_locations, candidates))
+            offset += len(face_locations)
+        
+        return results
+    
+    def capture_unknown(self, image_array, face_locations, face_encodings, candidates_per_face):
+        """Keep the faces that matched nobody in the unknown face store, if one is attached"""
+        if self.unknown_faces is None:
+            return
+        # Faces of a missing shard's identities come back unmatched: don't collect them
+        if self.shards is not None and self.shards.missing():
+            return
+        unmatched = [i for i, candidates in enumerate(candidates_per_face) if not (candidates and candidates[0]["match"])]
+        if not unmatched:
+            return
+        # Never fail a recognition because the store is unavailable
+        try:
+            with stage('capture_unknown'):
+                self.unknown_faces.add(
+                    image_array, [face_locations[i] for i in unmatched], [face_encodings[i] for i in unmatched]
+                )
+        except Exception as e:
+            print(f"[X] Could not store unknown faces: {str(e)}")
+    
+    def _build_matcher(self, gallery, previous=None, save=True):
+        """
+        Build the gallery matcher selected by self.index over the gallery's centroids
+        
+        'exact' searches the whole gallery, scanning the centroids as the gallery
+        stores them (no copy); 'ivf' uses an approximate IVF index over the live
+        identities that is persisted next to the gallery. previous is the snapshot
+        being replaced: when the gallery only appended to it (see
+        IdentityGallery.updated), a copy of its index just drops the tombstoned ids
+        and adds the appended ones; otherwise its trained lists are refilled instead
+        of re-running k-means. With save, an updated index is written back so that
+        the next start can reuse it.
+        """
+        if self.index == 'exact':
+            matcher = FaceMatcher if gallery.storage == 'float32' else QuantizedMatcher
+            return matcher.wrap(gallery.centroids, gallery.centroid_norms, gallery.scale)
+        
+        if self.index != 'ivf':
+            raise ValueError(f"Unknown index type: {self.index}")
+        
+        matrix = as_encoding_matrix(gallery.centroids)
+        live = np.flatnonzero(gallery.live)
+        index = previous.matcher if previous is not None else None
+        if isinstance(index, IVFIndex) and index.is_trained == (len(live) >= index.min_train_size):
+            base_length = len(previous.gallery)
+            if gallery.base_length == base_length:
+                index = index.copy()
+                index.remove(np.flatnonzero(previous.gallery.live & ~gallery.live[:base_length]))
+                added = live[live >= base_length]
+                index.add(matrix[added], added)
+            else:
+                index = index.empty_copy()
+                index.add(matrix[live], live)
+            if save:
+                self._save_ivf_index(index, gallery)
+            return index
         
-        # Loop through each face found
-        for (top, right, bottom, left), face_encoding in zip(face_locations, face_encodings):
+        index = self._load_ivf_index(gallery, matrix, live)
+        if index is not None:
+            print(f"[OK] Loaded IVF index ({len(index.list_ids)} lists)")
+            return index
+        
+        index = IVFIndex(n_probe=self.n_probe)
+        index.build(matrix[live], live)
+        if save:
+            self._save_ivf_index(index, gallery)
+        print(f"[OK] Built IVF index ({len(index.list_ids)} lists)")
+        return index
+    
+    @property
+    def _ivf_index_path(self):
+        return os.path.join(self.state_dir, '.ivf_index.npz')
+    
+    def _save_ivf_index(self, index, gallery):
+        """Write the index with the name of every id, so a reordered gallery can still use it"""
+        names = list(gallery.names)
+        table = StringTable.from_strings(names[i] for i in index.ids)
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = f"{self._ivf_index_path}.{os.getpid()}.tmp.npz"
+        try:
+            index.save(tmp_path, name_data=table.data, name_offsets=table.offsets)
+            os.replace(tmp_path, self._ivf_index_path)
+        except OSError as e:
+            print(f"[X] Could not save IVF index: {str(e)}")
+    
+    def _load_ivf_index(self, gallery, matrix, live):
+        """
+        The saved index renumbered to the gallery's ids, or None when it is
+        missing or does not hold exactly the live identities' centroids
+        """
+        if not os.path.exists(self._ivf_index_path):
+            return None
+        try:
+            index, metadata = IVFIndex.load(self._ivf_index_path)
+            saved_names = StringTable(metadata['name_data'], metadata['name_offsets'])
+        except Exception as e:
+            print(f"[X] Could not load IVF index, rebuilding: {str(e)}")
+            return None
+        
+        names = list(gallery.names)
+        positions = {names[i]: i for i in live}
+        ids = np.array([positions.get(name, -1) for name in saved_names], dtype=np.int64)
+        if len(ids) != len(live) or (ids < 0).any() or len(np.unique(ids)) != len(ids):
+            return None
+        vectors = np.vstack(index.list_vectors) if index.list_vectors else as_encoding_matrix([])
+        if not np.array_equal(vectors, matrix[ids]):
+            return None
+        
+        index.renumber(ids)
+        index.n_probe = self.n_probe
+        return index
+    
+    def match_encodings(self, face_encodings, top_k=None):
+        """
+        Match a batch of face encodings against the gallery in one pass
+        
+        Returns one list of candidates per encoding, best first. Each candidate
+        is a dict with name, distance and whether it is within tolerance.
+        With shards attached the gallery is searched remotely.
+        """
+        top_k = top_k or self.top_k
+        if len(face_encodings) == 0:
+            return []
+        
+        if self.shards is not None:
+            with stage('matching'):
+                results = self.shards.match(face_encodings, top_k)
+            return [
+                [{"name": name, "distance": distance, "match": bool(distance <= self.tolerance)} for name, distance in row]
+                for row in results
+            ]
+        
+        # Read the gallery once so a concurrent update can't mix two versions
+        snapshot = self._current()
+        if len(snapshot.matcher) == 0:
+            return [[] for _ in face_encodings]
+        
+        # Shortlist identities by centroid, then refine against their templates;
+        # without rescore the (possibly quantized) centroid distances are final
+        with stage('matching'):
+            if self.rescore:
+                shortlists, _ = snapshot.matcher.search(face_encodings, k=max(top_k, self.prune_k))
+                indices, distances = snapshot.gallery.refine(face_encodings, shortlists, top_k)
+            else:
+                indices, distances = snapshot.matcher.search(face_encodings, k=top_k)
+        
+        names = snapshot.gallery.names
+        return [
+            [
+                {
+                    "name": names[index],
+                    "distance": float(distance),
+                    "match": bool(distance <= self.tolerance)
+                }
+                for index, distance in zip(row_indices, row_distances)
+                if index >= 0
+            ]
+            for row_indices, row_distances in zip(indices, distances)
+        ]
+    
+    def build_results(self, face_locations, candidates_per_face):
+        """Turn face locations and their match candidates into API results"""
+        results = []
+        
+        for (top, right, bottom, left), candidates in zip(face_locations, candidates_per_face):
             name = "Unknown"
             confidence = 0.0
             
-            if len(self.known_face_encodings) > 0:
-                # Compare face with known faces
-                matches = face_recognition.compare_faces(
-                    self.known_face_encodings, 
-                    face_encoding,
-                    tolerance=0.6
-                )
-                
-                # Calculate face distances
-                face_distances = face_recognition.face_distance(
-                    self.known_face_encodings, 
-                    face_encoding
-                )
-                
-                # Find best match
-                if len(face_distances) > 0:
-                    best_match_index = np.argmin(face_distances)
-                    
-                    if matches[best_match_index]:
-                        name = self.known_face_names[best_match_index]
-                        confidence = 1 - face_distances[best_match_index]
+            # Candidates are sorted, so the first one is the best match
+            if candidates and candidates[0]["match"]:
+                name = candidates[0]["name"]
+                confidence = 1 - candidates[0]["distance"]
             
             results.append({
                 "name": name,
                 "confidence": float(confidence),
                 "location": {
-                    "top": top,
-                    "right": right,
-                    "bottom": bottom,
-                    "left": left
-                }
+                    "top": int(top),
+                    "right": int(right),
+                    "bottom": int(bottom),
+                    "left": int(left)
+                },
+                "candidates": [
+                    {"name": c["name"], "distance": c["distance"]}
+                    for c in candidates if c["match"]
+                ]
             })
         
         return results
     
     def get_known_faces_list(self):
-        """Return list of known face names"""
-        return self.known_face_names
\ No newline at end of file
+        """Return list of known identities with their number of enrolled images"""
+        if self.shards is not None:
+            return self.shards.known_faces()
+        gallery = self._current().gallery
+        return [
+            {"name": name, "samples": int(count)}
+            for name, count in zip(gallery.names, gallery.sample_counts)
+            if count > 0
+        ]
\ No newline at end of file
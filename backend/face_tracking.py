@@ -0,0 +1,184 @@
+"""
+Per-session face tracking for streaming recognition
+
+Faces are detected on every frame but only encoded and matched when their
+track is new, was lost, or is due for periodic re-verification. Stable tracks
+reuse their cached identity, which removes most of the encoding and matching
+work for a person standing in front of a camera.
+"""
+import threading
+import time
+import uuid
+
+from metrics import stage
+
+
+def box_iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes"""
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    inter = max(0, bottom - top) * max(0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - inter
+    return inter / union if union else 0.0
+
+
+class Track:
+    def __init__(self, track_id, box, frame_number):
+        self.track_id = track_id
+        self.box = box
+        self.candidates = []
+        self.last_verified = None
+        self.last_seen = frame_number
+        self.misses = 0
+        # Seen again after missed frames: the box may now be someone else
+        self.reacquired = False
+
+
+class StreamSession:
+    """
+    Track state for one camera stream
+
+    iou_threshold: minimum overlap for a box to continue a track
+    reverify_every: re-encode a stable track after this many frames
+    max_misses: drop a track after this many frames without a matching box
+    detector: detector backend for this camera (default: the service's)
+    """
+
+    def __init__(self, service, iou_threshold=0.3, reverify_every=15, max_misses=5, detector=None):
+        self.session_id = uuid.uuid4().hex
+        self.service = service
+        self.detector = detector
+        self.iou_threshold = iou_threshold
+        self.reverify_every = reverify_every
+        self.max_misses = max_misses
+        self.tracks = []
+        self.frame_number = 0
+        self.next_track_id = 1
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {"frames": 0, "faces": 0, "encoded": 0}
+
+    def _associate(self, boxes):
+        """Greedily pair boxes with existing tracks by descending IoU"""
+        pairs = sorted(
+            ((box_iou(track.box, box), t, b)
+             for t, track in enumerate(self.tracks)
+             for b, box in enumerate(boxes)),
+            reverse=True
+        )
+        track_for_box = [None] * len(boxes)
+        used_tracks = set()
+        for overlap, t, b in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if t in used_tracks or track_for_box[b] is not None:
+                continue
+            track_for_box[b] = self.tracks[t]
+            used_tracks.add(t)
+        return track_for_box
+
+    def process_frame(self, image_array):
+        """
+        Detect faces in the frame, update tracks and return API results with
+        a track_id and whether the identity came from the track cache
+        """
+        with self.lock:
+            self.frame_number += 1
+            self.last_active = time.monotonic()
+
+            boxes = self.service.detect_faces(image_array, self.detector)
+            track_for_box = self._associate(boxes)
+
+            for b, box in enumerate(boxes):
+                if track_for_box[b] is None:
+                    track = Track(self.next_track_id, box, self.frame_number)
+                    self.next_track_id += 1
+                    self.tracks.append(track)
+                    track_for_box[b] = track
+
+            seen = set()
+            for track, box in zip(track_for_box, boxes):
+                track.box = box
+                track.last_seen = self.frame_number
+                track.reacquired = track.misses > 0
+                track.misses = 0
+                seen.add(track.track_id)
+
+            for track in self.tracks:
+                if track.track_id not in seen:
+                    track.misses += 1
+            self.tracks = [t for t in self.tracks if t.misses <= self.max_misses]
+
+            # Only new, reacquired and due tracks are encoded
+            stale = [
+                b for b, track in enumerate(track_for_box)
+                if track.last_verified is None
+                or track.reacquired
+                or self.frame_number - track.last_verified >= self.reverify_every
+            ]
+            if stale:
+                import face_recognition
+
+                with stage('encoding'):
+                    encodings = face_recognition.face_encodings(image_array, [boxes[b] for b in stale])
+                matches = self.service.match_encodings(encodings)
+                # Keep one sample of each new track that nobody matched
+                new = [i for i, b in enumerate(stale) if track_for_box[b].last_verified is None]
+                if new:
+                    self.service.capture_unknown(
+                        image_array, [boxes[stale[i]] for i in new], [encodings[i] for i in new], [matches[i] for i in new]
+                    )
+                for b, candidates in zip(stale, matches):
+                    track_for_box[b].candidates = candidates
+                    track_for_box[b].last_verified = self.frame_number
+                    track_for_box[b].reacquired = False
+
+            self.stats["frames"] += 1
+            self.stats["faces"] += len(boxes)
+            self.stats["encoded"] += len(stale)
+
+            results = self.service.build_results(boxes, [t.candidates for t in track_for_box])
+            stale = set(stale)
+            for b, (result, track) in enumerate(zip(results, track_for_box)):
+                result["track_id"] = track.track_id
+                result["cached"] = b not in stale
+            return results
+
+
+class StreamSessionStore:
+    """Thread-safe registry of live sessions with idle expiry"""
+
+    def __init__(self, service, idle_timeout=60.0, max_sessions=100, **session_options):
+        self.service = service
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.session_options = session_options
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _expire(self):
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if now - session.last_active > self.idle_timeout:
+                del self.sessions[session_id]
+
+    def create(self, detector=None):
+        """Start a new session; returns None when the store is full"""
+        with self.lock:
+            self._expire()
+            if len(self.sessions) >= self.max_sessions:
+                return None
+            session = StreamSession(self.service, detector=detector, **self.session_options)
+            self.sessions[session.session_id] = session
+            return session
+
+    def get(self, session_id):
+        with self.lock:
+            self._expire()
+            return self.sessions.get(session_id)
+
+    def close(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None)
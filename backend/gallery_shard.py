@@ -0,0 +1,302 @@
+"""
+Sharded gallery: matcher processes that each hold part of the identities
+
+Identities are assigned to shards by a hash of their name (face_service.
+shard_of), so every shard loads only its part of known_faces/ and keeps its own
+encoding cache and index under known_faces/.shard-<i>-of-<n>/. The API front
+sends each batch of query encodings to all shards at once (POST /match with a
+raw float32 body), waits at most the per-shard timeout and merges the top-k
+lists. A shard that is slow or down only removes its identities from the
+answer; the request still succeeds, with the missing shards named in the
+X-Shards-Missing response header. Enrolling and unenrolling go to the one
+shard that owns the name (POST /enroll, /unenroll), which stores the photos in
+its known_faces/ and updates its index; these fail if that shard is down.
+
+Run one shard per process (or node):
+    python gallery_shard.py --shard 0 --shards 4 --port 5100
+    python gallery_shard.py --shard 1 --shards 4 --port 5101
+    ...
+and point the front at them with
+    GALLERY_SHARDS=http://127.0.0.1:5100,http://127.0.0.1:5101,...
+"""
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+import metrics
+from face_service import FaceRecognitionService, shard_of, valid_name
+
+# Most candidates per query a shard returns, whatever k the caller asks for
+MAX_K = 100
+
+
+class ShardUnavailable(Exception):
+    """The shard that owns a name did not answer a gallery update"""
+
+
+class ShardClient:
+    """
+    Scatter-gather matching over gallery shards
+
+    urls[i] must serve shard i of len(urls). timeout is the per-shard budget
+    in seconds. Every shard has its own pool of max_parallel threads, so calls
+    stuck on a slow shard only queue up behind that shard; queued calls whose
+    request has already given up on the shard are dropped unsent. write_timeout is the budget for enrolling and unenrolling, which write
+    files and update the shard's index.
+    """
+
+    def __init__(self, urls, timeout=0.5, max_parallel=8, write_timeout=30.0):
+        self.urls = [url.rstrip('/') for url in urls]
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self._executors = [
+            ThreadPoolExecutor(max_parallel, thread_name_prefix=f'shard-{shard}-client')
+            for shard in range(len(self.urls))
+        ]
+        self._local = threading.local()
+        # Shards whose last call failed; state changes are logged once
+        self._failing = set()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def begin_request(self):
+        self._local.missing = set()
+
+    def missing(self):
+        """Shards that gave no answer during this thread's request"""
+        return sorted(getattr(self._local, 'missing', ()))
+
+    def _call(self, shard, path, body=None, content_type='application/octet-stream', timeout=None):
+        request = urllib.request.Request(self.urls[shard] + path, data=body, headers={"Content-Type": content_type})
+        start = time.perf_counter()
+        with urllib.request.urlopen(request, timeout=timeout or self.timeout) as response:
+            result = json.load(response)
+        metrics.SHARD_SECONDS.observe(time.perf_counter() - start, shard=shard)
+        if result.get("shard") != [shard, len(self.urls)]:
+            raise ValueError(f"Shard {shard} serves {result.get('shard')}")
+        return result
+
+    def _call_before(self, deadline, shard, path, body):
+        if time.monotonic() >= deadline:
+            raise TimeoutError("queued past the timeout")
+        return self._call(shard, path, body)
+
+    def _scatter(self, path, body=None):
+        """{shard: response} of the shards that answered within the timeout"""
+        deadline = time.monotonic() + self.timeout
+        futures = {
+            self._executors[shard].submit(self._call_before, deadline, shard, path, body): shard
+            for shard in range(len(self.urls))
+        }
+        done, _ = wait(futures, timeout=self.timeout)
+
+        answers = {}
+        failures = []
+        for future, shard in futures.items():
+            if future not in done:
+                failures.append((shard, 'timeout', f"no answer within {self.timeout * 1000:.0f} ms"))
+            elif future.exception() is not None:
+                failures.append((shard, 'error', str(future.exception())))
+            else:
+                answers[shard] = future.result()
+                if shard in self._failing:
+                    self._failing.discard(shard)
+                    print(f"[OK] Gallery shard {shard} ({self.urls[shard]}) is answering again")
+
+        missing = getattr(self._local, 'missing', None)
+        for shard, reason, error in failures:
+            metrics.SHARD_ERRORS.inc(shard=shard, reason=reason)
+            if shard not in self._failing:
+                self._failing.add(shard)
+                print(f"[X] Gallery shard {shard} ({self.urls[shard]}): {error}")
+            if missing is not None:
+                missing.add(shard)
+        return answers
+
+    def match(self, encodings, k):
+        """Top-k [(name, distance)] per encoding, merged over the shards that answered"""
+        body = np.ascontiguousarray(encodings, dtype='<f4').reshape(-1, 128).tobytes()
+        answers = self._scatter(f"/match?k={int(k)}", body)
+
+        merged = [[] for _ in range(len(encodings))]
+        for answer in answers.values():
+            for row, candidates in zip(merged, answer["results"]):
+                row.extend((name, distance) for name, distance in candidates)
+        # Shards hold disjoint identities, so merging is a sort per query
+        return [sorted(row, key=lambda candidate: candidate[1])[:k] for row in merged]
+
+    def known_faces(self):
+        faces = []
+        for answer in self._scatter('/known-faces').values():
+            faces.extend(answer["known_faces"])
+        return sorted(faces, key=lambda face: face["name"])
+
+    def _write(self, name, path, payload):
+        """
+        POST a gallery update to the shard that owns name
+        Raises ValueError when the shard rejects it and ShardUnavailable when
+        it can't be reached.
+        """
+        shard = shard_of(name, len(self.urls))
+        body = json.dumps(payload).encode()
+        try:
+            return self._call(shard, path, body, 'application/json', self.write_timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                error = json.load(e).get("error", e.reason)
+            except ValueError:
+                error = e.reason
+            if e.code == 400:
+                raise ValueError(error)
+            if e.code == 404:
+                return None
+            raise ShardUnavailable(f"Gallery shard {shard} ({self.urls[shard]}): {error}")
+        except (OSError, ValueError) as e:
+            metrics.SHARD_ERRORS.inc(shard=shard, reason='error')
+            raise ShardUnavailable(f"Gallery shard {shard} ({self.urls[shard]}): {str(e)}")
+
+    def enroll(self, name, samples):
+        """Add [(JPEG or PNG bytes, encoding)] of name to its shard; returns the new image keys"""
+        name = valid_name(name)
+        result = self._write(name, '/enroll', {
+            "name": name,
+            "samples": [
+                {"image": base64.b64encode(image_bytes).decode(), "encoding": [float(x) for x in encoding]}
+                for image_bytes, encoding in samples
+            ]
+        })
+        return result["added"]
+
+    def unenroll(self, name, key=None):
+        """Remove name (or one of its image keys) from its shard; returns the removed keys"""
+        try:
+            name = valid_name(name)
+        except ValueError:
+            return []
+        result = self._write(name, '/unenroll', {"name": name, "image": key})
+        return result["removed"] if result is not None else []
+
+
+def create_app(service):
+    """Flask app serving one shard of service's gallery"""
+    from flask import Flask, jsonify, request
+
+    app = Flask(__name__)
+    shard = list(service.shard)
+
+    @app.route('/match', methods=['POST'])
+    def match():
+        data = request.get_data()
+        if len(data) % (128 * 4):
+            return jsonify({"error": "Body must be float32 encodings of 128 values"}), 400
+        try:
+            k = min(max(1, int(request.args.get('k', 1))), MAX_K)
+        except ValueError:
+            return jsonify({"error": "k must be an integer"}), 400
+
+        encodings = np.frombuffer(data, dtype='<f4').reshape(-1, 128)
+        results = service.match_encodings(encodings, top_k=k) if len(encodings) else []
+        return jsonify({
+            "shard": shard,
+            "results": [[[c["name"], c["distance"]] for c in candidates] for candidates in results]
+        })
+
+    def owned_name(data):
+        """The request's name, if this shard owns it; raises ValueError"""
+        name = valid_name(data.get('name'))
+        if shard_of(name, shard[1]) != shard[0]:
+            raise ValueError(f"{name} belongs to shard {shard_of(name, shard[1])}, not {shard[0]}")
+        return name
+
+    @app.route('/enroll', methods=['POST'])
+    def enroll():
+        """Store already encoded photos (base64 image and 128 floats each) of a name this shard owns"""
+        data = request.get_json(silent=True) or {}
+        try:
+            name = owned_name(data)
+            samples = [
+                (base64.b64decode(sample["image"]), np.array(sample["encoding"], dtype=np.float64).reshape(128))
+                for sample in data.get('samples') or ()
+            ]
+        except (ValueError, TypeError, KeyError) as e:
+            return jsonify({"error": str(e) or "Invalid samples"}), 400
+        if not samples:
+            return jsonify({"error": "No samples provided"}), 400
+        return jsonify({"shard": shard, "added": service.enroll_encoded(name, samples)})
+
+    @app.route('/unenroll', methods=['POST'])
+    def unenroll():
+        data = request.get_json(silent=True) or {}
+        try:
+            name = owned_name(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        removed = service.unenroll(name, data.get('image'))
+        if not removed:
+            return jsonify({"error": "Unknown name or image"}), 404
+        return jsonify({"shard": shard, "removed": removed})
+
+    @app.route('/known-faces', methods=['GET'])
+    def known_faces():
+        return jsonify({"shard": shard, "known_faces": service.get_known_faces_list()})
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify({"status": "healthy", "shard": shard, "identities": len(service.known_face_names)})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shard', type=int, required=True, help="index of this shard")
+    parser.add_argument('--shards', type=int, required=True, help="total number of shards")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help="default 5100 + shard")
+    parser.add_argument('--known-faces', default='known_faces')
+    parser.add_argument('--encodings', help=".npz with names and encodings to load instead of known_faces/")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('ENROLL_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--watch', type=float, default=float(os.environ.get('GALLERY_WATCH_INTERVAL', 0)),
+                        help="seconds between scans of known_faces/ (0 = off)")
+    parser.add_argument('--index', default=os.environ.get('FACE_INDEX', 'exact'))
+    parser.add_argument('--nprobe', type=int, default=int(os.environ.get('FACE_INDEX_NPROBE', 8)))
+    parser.add_argument('--storage', default=os.environ.get('FACE_STORAGE', 'float32'),
+                        help="float32, float16 or int8")
+    parser.add_argument('--no-rescore', action='store_true', default=os.environ.get('FACE_RESCORE', '1') != '1',
+                        help="use the (quantized) centroid distances without exact re-scoring")
+    args = parser.parse_args()
+
+    if not 0 <= args.shard < args.shards:
+        parser.error("--shard must be between 0 and --shards - 1")
+
+    service = FaceRecognitionService(
+        known_faces_dir=args.known_faces, index=args.index, n_probe=args.nprobe, shard=(args.shard, args.shards),
+        storage=args.storage, rescore=not args.no_rescore
+    )
+    if args.encodings:
+        with np.load(args.encodings) as data:
+            names, encodings = data['names'], data['encodings']
+        mine = np.array([shard_of(str(name), args.shards) == args.shard for name in names], dtype=bool)
+        service.load_encodings([str(name) for name in names[mine]], encodings[mine])
+        print(f"[OK] Loaded {len(service.known_face_names)} identities from {args.encodings}")
+    else:
+        service.load_known_faces(workers=args.workers)
+        if args.watch > 0:
+            service.watch(args.watch)
+
+    port = args.port or 5100 + args.shard
+    print(f"Gallery shard {args.shard}/{args.shards} running on http://{args.host}:{port}")
+    create_app(service).run(host=args.host, port=port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Production server: one worker process with a thread pool, or several sharing one gallery
+
+    cd backend
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported and dlib's models are loaded in the master process, then
+workers are forked and start answering right away (/health). Each worker loads
+the gallery and warms up its detectors and ONNX Runtime sessions in a
+background thread; /ready turns 200 once that is done. The first worker to
+start loads known_faces/ and publishes the encodings as memory-mapped files
+under GALLERY_SHARED_DIR; the others wait for it and map the same files
+read-only. Updates from /enroll, /unenroll or the directory watcher are picked
+up by all workers through a shared generation counter (see shared_gallery.py).
+
+One worker is the default. Multi-worker mode (WEB_WORKERS > 1) is unsupported
+for the endpoints whose state lives in one worker, because gunicorn gives each
+request to any worker:
+    /stream/sessions/...          refused with 501 (sessions are per worker)
+    /remove-background/jobs,
+    /jobs/<id>                    refused with 501 (jobs are per worker)
+    /metrics                      served, but counts only the worker that answers
+/recolor works across workers: masks are written through to MASK_CACHE_DIR,
+which defaults to a directory shared by the workers. See the README,
+Multi-Worker Serving.
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_WORKERS', 1))
+worker_class = 'gthread'
+timeout = 120
+preload_app = True
+
+os.environ.setdefault('GALLERY_SHARED_DIR', os.path.join('known_faces', '.shared_gallery'))
+# app.py refuses per-worker endpoints when this is above 1
+os.environ['WEB_WORKERS'] = str(workers)
+if workers > 1:
+    # Masks from /remove-background must be visible to the worker that gets /recolor
+    os.environ.setdefault('MASK_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'face-app-masks'))
+    # One ONNX Runtime session per worker, with the cores split between workers
+    os.environ.setdefault('BG_POOL_SIZE', '1')
+    os.environ.setdefault('BG_INTRA_OP_THREADS', str(max(1, multiprocessing.cpu_count() // workers)))
+    # Admission budgets (see app.py) are per worker: split recognition too
+    os.environ.setdefault('ADMIT_RECOGNITION_CONCURRENCY', str(max(1, multiprocessing.cpu_count() // workers)))
+
+
+def _budget_threads(budget, concurrency, queue=None):
+    """Requests a budget can run plus queue, with app.py's defaults"""
+    prefix = f"ADMIT_{budget.upper()}_"
+    concurrency = int(os.environ.get(prefix + 'CONCURRENCY', concurrency))
+    return concurrency + int(os.environ.get(prefix + 'QUEUE', 2 * concurrency if queue is None else queue))
+
+
+# Give each worker a thread for every request its budgets can admit or queue,
+# plus a spare few, so no mix of slow or waiting requests can take the threads
+# /health and /ready need
+threads = int(os.environ.get('WEB_THREADS', 0)) or (
+    _budget_threads('recognition', multiprocessing.cpu_count())
+    + _budget_threads('background', os.environ.get('BG_POOL_SIZE', 2))
+    + _budget_threads('control', 4)
+    + _budget_threads('poll', 8, queue=0)
+    + _budget_threads('health', 4)
+    + 2
+)
+
+
+# Identifies this server start, so workers load the gallery only once
+GALLERY_TOKEN = f"{os.getpid()}-{time.time_ns()}"
+
+
+def on_starting(server):
+    import app
+    # The one step the master waits for (about a second): dlib's models are
+    # loaded before fork so workers share them copy-on-write, and importing
+    # them in a thread could race the fork
+    app.warm_up_encoder()
+
+
+def post_fork(server, worker):
+    import app
+
+    def load_gallery():
+        app.load_gallery(token=GALLERY_TOKEN)
+
+    app.start_warm_up([load_gallery, app.warm_up_models])
@@ -0,0 +1,307 @@
+"""
+Per-identity face templates
+
+Every enrolled photo of a person is reduced to a compact template: the
+centroid of their encodings plus a few medoids (real samples chosen to cover
+the spread of poses/lighting). Matching first shortlists identities by
+centroid and then refines against the full templates of the shortlist only.
+Template rows are stored as float32, float16 or int8 (see face_matcher.quantize)
+and widened only for the rows a query is compared with.
+"""
+import numpy as np
+
+from face_matcher import as_encoding_matrix, dequantize, pairwise_distances, quantization_scale, quantize, stored_norms
+
+
+class StringTable:
+    """
+    Read-only sequence of strings kept as one UTF-8 byte array plus offsets
+
+    A million names cost their UTF-8 bytes plus 8 bytes of offset each instead
+    of a str object (~50 bytes) and a list slot per name, and the two arrays can
+    be saved and memory-mapped like the rest of the gallery.
+    """
+
+    def __init__(self, data=None, offsets=None):
+        self.data = np.zeros(0, dtype=np.uint8) if data is None else data
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        if isinstance(strings, cls):
+            return strings
+        encoded = [str(string).encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("StringTable index out of range")
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield data[start:end].decode('utf-8')
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.offsets.nbytes
+
+
+def select_medoids(samples, count):
+    """
+    Pick up to count representative samples: the one nearest the centroid,
+    then repeatedly the sample farthest from those already chosen
+    """
+    centroid = samples.mean(axis=0)
+    chosen = [int(np.argmin(np.linalg.norm(samples - centroid, axis=1)))]
+    nearest = np.linalg.norm(samples - samples[chosen[0]], axis=1)
+
+    while len(chosen) < min(count, len(samples)):
+        candidate = int(np.argmax(nearest))
+        if nearest[candidate] == 0:
+            break
+        chosen.append(candidate)
+        nearest = np.minimum(nearest, np.linalg.norm(samples - samples[candidate], axis=1))
+
+    return samples[chosen]
+
+
+def build_template(samples, max_medoids=3):
+    """Return the template rows for one identity: [centroid, medoids...]"""
+    samples = as_encoding_matrix(samples)
+    if len(samples) == 1:
+        return samples
+    centroid = samples.mean(axis=0, keepdims=True)
+    return np.vstack([centroid, select_medoids(samples, max_medoids)])
+
+
+class IdentityGallery:
+    """
+    Unique identities with their sample counts, centroids and templates
+
+    storage is the dtype of the template rows: 'float32', 'float16' or 'int8'
+    (with one scale per dimension, in scale). With keep_exact, a quantized
+    gallery also keeps the float32 originals of its template rows in
+    exact_rows, for re-scoring; the service moves them to a memory-mapped file.
+    Identities with a sample count of 0 are tombstones left by
+    updated(stable_ids=True); they keep their rows but are not live.
+    """
+
+    def __init__(self, names=(), samples=(), max_medoids=3, storage='float32', keep_exact=False):
+        self.max_medoids = max_medoids
+        self.storage = storage
+        self.keep_exact = keep_exact and storage != 'float32'
+        self.scale = None
+        templates = [build_template(s, max_medoids) for s in samples]
+        rows = as_encoding_matrix(np.vstack(templates)) if templates else as_encoding_matrix([])
+        self._set(names, [len(s) for s in samples], self._store(rows), [len(t) for t in templates],
+                  rows if self.keep_exact else None)
+
+    def _store(self, rows, rescale=True):
+        """Convert float32 template rows to self.storage; rescale picks new int8 scales from rows"""
+        if self.storage == 'int8' and (rescale or self.scale is None):
+            self.scale = quantization_scale(rows)
+        return quantize(rows, self.storage, self.scale)
+
+    def _set(self, names, sample_counts, template_rows, template_lengths, exact_rows=None):
+        """Install the stacked, stored template rows and derive norms and offsets; every builder ends here"""
+        self.exact_rows = exact_rows
+        self.names = StringTable.from_strings(names)
+        self.sample_counts = np.asarray(sample_counts, dtype=np.int64)
+        self.template_rows = template_rows
+        # Norms of the stored rows, so that distances are consistent with them
+        self.template_norms = stored_norms(template_rows, self.scale)
+        lengths = np.asarray(template_lengths, dtype=np.int64)
+        self.template_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self._centroids = None
+        self._centroid_norms = None
+        self.base_length = None
+
+    @property
+    def live(self):
+        """Mask of the identities that are not tombstones (see updated)"""
+        return np.asarray(self.sample_counts) > 0
+
+    @property
+    def single_row(self):
+        """True when every template is just its centroid (one photo per identity)"""
+        return len(self.template_rows) == len(self.names)
+
+    @property
+    def centroids(self):
+        """
+        (identities, 128) centroids in the gallery's storage, the first row of every template
+
+        With one photo per identity these are the template rows themselves;
+        otherwise they are gathered on demand unless the gallery was created
+        from precomputed arrays.
+        """
+        if self._centroids is not None:
+            return self._centroids
+        if self.single_row:
+            return self.template_rows
+        return np.ascontiguousarray(self.template_rows[self.template_offsets[:-1]])
+
+    @property
+    def centroid_norms(self):
+        """Squared norms of centroids"""
+        if self._centroid_norms is not None:
+            return self._centroid_norms
+        if self.single_row:
+            return self.template_norms
+        return self.template_norms[self.template_offsets[:-1]]
+
+    @property
+    def nbytes(self):
+        """Bytes of the gallery's arrays, names included; exact_rows are counted apart (exact_nbytes)"""
+        arrays = [self.template_rows, self.template_norms, self.template_offsets, self.sample_counts]
+        if not self.single_row:
+            arrays += [self._centroids, self._centroid_norms]
+        if self.scale is not None:
+            arrays.append(self.scale)
+        return self.names.nbytes + sum(a.nbytes for a in arrays if a is not None)
+
+    @property
+    def exact_nbytes(self):
+        """Bytes of the float32 originals kept for re-scoring (usually memory-mapped)"""
+        return 0 if self.exact_rows is None else self.exact_rows.nbytes
+
+    @classmethod
+    def from_encodings(cls, names, encodings, max_medoids=3, storage='float32', keep_exact=False):
+        """Group per-photo (name, encoding) pairs into identities, keeping first-seen order"""
+        names = list(names)
+        if len(set(names)) == len(names):
+            # One photo per identity: build_template() would return each encoding
+            # as it is, so skip grouping and stack them directly (same arrays)
+            gallery = cls(max_medoids=max_medoids, storage=storage, keep_exact=keep_exact)
+            rows = as_encoding_matrix(encodings)
+            gallery._set(names, np.ones(len(names)), gallery._store(rows), np.ones(len(names)),
+                         rows if gallery.keep_exact else None)
+            return gallery
+
+        grouped = {}
+        for name, encoding in zip(names, encodings):
+            grouped.setdefault(name, []).append(encoding)
+        return cls(grouped.keys(), grouped.values(), max_medoids, storage, keep_exact)
+
+    @classmethod
+    def from_arrays(cls, names, sample_counts, template_rows, template_norms, template_offsets, centroids=None,
+                    centroid_norms=None, scale=None, exact_rows=None, max_medoids=3, base_length=None):
+        """Wrap precomputed arrays (e.g. memory-mapped, see shared_gallery.py) without copying them"""
+        gallery = cls(max_medoids=max_medoids, storage=str(template_rows.dtype), keep_exact=exact_rows is not None)
+        gallery.exact_rows = exact_rows
+        gallery.names = StringTable.from_strings(names)
+        gallery.sample_counts = sample_counts
+        gallery.template_rows = template_rows
+        gallery.template_norms = template_norms
+        gallery.template_offsets = template_offsets
+        gallery._centroids = centroids
+        gallery._centroid_norms = centroid_norms
+        gallery.scale = scale
+        gallery.base_length = base_length
+        return gallery
+
+    def __len__(self):
+        return len(self.names)
+
+    def updated(self, identities, stable_ids=False):
+        """
+        Return a new gallery with some identities replaced, leaving self untouched
+
+        identities maps name -> all sample encodings of that identity; an empty
+        list removes it. Other identities keep their template rows as they are,
+        so only the changed identities are rebuilt. Changed identities move to
+        the end of the gallery.
+
+        With stable_ids, every identity keeps its id (position): a replaced or
+        removed identity stays behind as a tombstone (sample count 0, see live)
+        and its new version is appended, so an index over the centroids only
+        has to remove and add the changed ids. base_length of the result is
+        then len(self). Once tombstones outnumber live identities the gallery
+        is compacted instead, which renumbers them (base_length None).
+        """
+        changed = set(identities)
+        retired = np.array([name in changed for name in self.names], dtype=bool) & self.live
+        kept = self.live & ~retired
+        lengths = np.diff(self.template_offsets)
+        new_names, new_counts, templates = [], [], []
+
+        for name, samples in identities.items():
+            if len(samples) == 0:
+                continue
+            new_names.append(name)
+            new_counts.append(len(samples))
+            templates.append(build_template(samples, self.max_medoids))
+
+        # New templates use the kept rows' int8 scales (outliers are clipped)
+        # unless nothing is kept
+        gallery = IdentityGallery(max_medoids=self.max_medoids, storage=self.storage, keep_exact=self.keep_exact)
+        gallery.scale = self.scale
+        new_exact = as_encoding_matrix(np.vstack(templates)) if templates else as_encoding_matrix([])
+        new_rows = gallery._store(new_exact, rescale=not kept.any())
+
+        tombstones = np.count_nonzero(~kept)
+        keep = kept
+        if stable_ids and kept.any() and tombstones <= np.count_nonzero(kept) + len(new_names):
+            keep = np.ones(len(self), dtype=bool)
+        kept_rows = np.repeat(keep, lengths)
+
+        names = [name for name, kept_name in zip(self.names, keep) if kept_name] + new_names
+        sample_counts = np.concatenate([np.where(retired, 0, self.sample_counts)[keep], new_counts])
+        rows = np.vstack([self.template_rows[kept_rows], new_rows])
+        exact_rows = None
+        if self.exact_rows is not None:
+            exact_rows = np.vstack([self.exact_rows[kept_rows], new_exact])
+        gallery._set(names, sample_counts, rows, np.concatenate([lengths[keep], [len(t) for t in templates]]),
+                     exact_rows)
+        if keep.all():
+            gallery.base_length = len(self)
+        return gallery
+
+    def refine(self, queries, shortlists, k):
+        """
+        Identity distances for each query's shortlisted identities
+
+        The distance to an identity is the minimum over its template rows:
+        the float32 originals when the gallery keeps them (exact_rows),
+        otherwise the stored rows widened to float32.
+        Returns (identity_ids, distances) per query, best first, padded with
+        -1/inf to k columns.
+        """
+        queries = as_encoding_matrix(queries)
+        out_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        out_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+
+        for row, (query, shortlist) in enumerate(zip(queries, shortlists)):
+            shortlist = shortlist[shortlist >= 0]
+            if len(shortlist) == 0:
+                continue
+
+            starts = self.template_offsets[shortlist]
+            ends = self.template_offsets[shortlist + 1]
+            rows = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+            if self.exact_rows is not None:
+                distances = pairwise_distances(query[None, :], self.exact_rows[rows])[0]
+            else:
+                distances = pairwise_distances(
+                    query[None, :], dequantize(self.template_rows[rows], self.scale), self.template_norms[rows]
+                )[0]
+
+            # Minimum per identity over its contiguous block of template rows
+            segment_starts = np.concatenate([[0], np.cumsum(ends - starts)[:-1]])
+            per_identity = np.minimum.reduceat(distances, segment_starts)
+
+            order = np.argsort(per_identity)[:k]
+            out_ids[row, :len(order)] = shortlist[order]
+            out_distances[row, :len(order)] = per_identity[order]
+
+        return out_ids, out_distances
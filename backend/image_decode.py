@@ -0,0 +1,157 @@
+"""
+Shared decode stage for uploaded images
+
+Every endpoint turns request bytes into pixels through decode_image(), which
+    - rejects payloads over the byte limit before decoding, and images over the
+      pixel limit after reading only their header,
+    - decodes JPEGs at 1/2, 1/4 or 1/8 scale inside the decoder when max_side
+      asks for less than full resolution (DCT scaling, like PIL's draft mode),
+    - applies the EXIF orientation,
+    - returns a C-contiguous, writable uint8 RGB array that the decoder wrote
+      directly (gray, palette, alpha and 16-bit inputs are normalized).
+"""
+import base64
+import binascii
+import io
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+DEFAULT_MAX_PIXELS = 40_000_000
+
+# Largest reduction first; reduced decoding is only used for JPEG
+REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+EXIF_ORIENTATION = 0x0112
+
+
+class ImageDecodeError(ValueError):
+    """The payload is not a decodable image"""
+
+
+class ImageTooLarge(ImageDecodeError):
+    """The payload or the image exceeds the configured limits"""
+
+
+def check_payload_size(size, max_bytes=DEFAULT_MAX_BYTES):
+    if max_bytes and size > max_bytes:
+        raise ImageTooLarge(f"Image too large ({size} bytes, max {max_bytes})")
+
+
+def b64decode_image(value, max_bytes=DEFAULT_MAX_BYTES):
+    """Decode a base64 string or data URL to bytes, checking the size before decoding"""
+    if not isinstance(value, str):
+        raise ImageDecodeError("Image must be a base64 string or data URL")
+    payload = value.split(',', 1)[1] if value.startswith('data:') else value
+    check_payload_size(len(payload) * 3 // 4, max_bytes)
+    try:
+        return base64.b64decode(payload)
+    except (binascii.Error, ValueError) as e:
+        raise ImageDecodeError(f"Invalid base64 image: {str(e)}")
+
+
+def read_header(data, max_bytes=DEFAULT_MAX_BYTES, max_pixels=DEFAULT_MAX_PIXELS):
+    """
+    Open an image without decoding its pixels and enforce the limits
+    Returns the lazy PIL image (format, size and EXIF are available).
+    """
+    check_payload_size(len(data), max_bytes)
+    try:
+        header = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        raise ImageDecodeError("Could not decode image: unknown or corrupt image format")
+    except Exception as e:
+        raise ImageDecodeError(f"Could not decode image: {str(e)}")
+
+    width, height = header.size
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLarge(f"Image too large ({width}x{height}, max {max_pixels} pixels)")
+    return header
+
+
+def _orientation(header):
+    try:
+        return header.getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        return 1
+
+
+def _apply_orientation(image, orientation):
+    """Rotate/flip a decoded array as EXIF orientation 2-8 asks"""
+    if orientation == 2:
+        return cv2.flip(image, 1)
+    if orientation == 3:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(image, 0)
+    if orientation == 5:
+        return cv2.transpose(image)
+    if orientation == 6:
+        return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(image), -1)
+    if orientation == 8:
+        return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return image
+
+
+def _decode_with_pil(header):
+    """Fallback for formats OpenCV can't read"""
+    image = ImageOps.exif_transpose(header)
+    if image.mode in ('I', 'I;16', 'I;16B', 'I;16L'):
+        # 16-bit grayscale: keep the high byte
+        gray = (np.asarray(image, dtype=np.uint32) >> 8).astype(np.uint8)
+        return cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.array(image)
+
+
+def decode_image(data, max_side=None, max_bytes=DEFAULT_MAX_BYTES, max_pixels=DEFAULT_MAX_PIXELS):
+    """
+    Decode image bytes to a contiguous uint8 RGB array
+
+    With max_side the long edge is limited to max_side pixels. Returns
+    (array, scale) where scale is the decoded size relative to the original.
+    Raises ImageTooLarge or ImageDecodeError.
+    """
+    header = read_header(data, max_bytes, max_pixels)
+    long_side = max(header.size)
+
+    flags = cv2.IMREAD_COLOR
+    if max_side and header.format == 'JPEG':
+        for factor, reduced in REDUCED_FLAGS:
+            if long_side / factor >= max_side:
+                flags = reduced
+                break
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        try:
+            image = _decode_with_pil(header)
+        except (OSError, Image.DecompressionBombError) as e:
+            # e.g. "image file is truncated"; PIL only reads the pixels here
+            raise ImageDecodeError(f"Could not decode image: {str(e)}")
+    else:
+        cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+        image = _apply_orientation(image, _orientation(header))
+
+    height, width = image.shape[:2]
+    if max_side and max(height, width) > max_side:
+        scale = max_side / max(height, width)
+        image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+
+    return image, max(image.shape[:2]) / long_side
+
+
+def decode_image_file(path, max_side=None):
+    """decode_image() for a file on disk, without the payload limits"""
+    with open(path, 'rb') as f:
+        return decode_image(f.read(), max_side, max_bytes=None, max_pixels=None)
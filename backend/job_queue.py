@@ -0,0 +1,121 @@
+"""
+In-process job queue for long-running image work
+
+A bounded pool of worker threads drains a bounded queue, so heavy requests
+(background removal) never run inside a Flask request thread and can't starve
+/recognize or /health. Results are kept for a TTL and fetched by job id,
+optionally long-polling until the job finishes.
+
+Worker threads are started on the first submit, in the process that submits:
+threads don't survive fork(), so a queue created before a pre-forking server
+forks its workers still gets its own threads in each worker.
+"""
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity"""
+
+
+class Job:
+    def __init__(self, func, args, kwargs):
+        self.job_id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created = time.monotonic()
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        data = {"jobId": self.job_id, "status": self.status}
+        if self.status == 'done':
+            data["result"] = self.result
+        elif self.status == 'failed':
+            data["error"] = self.error
+        return data
+
+
+class JobQueue:
+    def __init__(self, workers=2, max_queue=32, result_ttl=300.0, name='jobs'):
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.workers = workers
+        self.name = name
+        self.pending = queue.Queue(maxsize=max_queue)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        self.pid = None
+
+    def _start_workers(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job = self.pending.get()
+            job.status = 'running'
+            try:
+                job.result = job.func(*job.args, **job.kwargs)
+                job.status = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                job.status = 'failed'
+            finally:
+                job.finished = time.monotonic()
+                job.func = job.args = job.kwargs = None
+                job.done.set()
+                self.pending.task_done()
+
+    def _expire(self):
+        now = time.monotonic()
+        with self.lock:
+            for job_id, job in list(self.jobs.items()):
+                if job.finished is not None and now - job.finished > self.result_ttl:
+                    del self.jobs[job_id]
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs); returns the Job or raises QueueFull"""
+        if self.pid != os.getpid():
+            self._start_workers()
+        self._expire()
+        job = Job(func, args, kwargs)
+        with self.lock:
+            self.jobs[job.job_id] = job
+        try:
+            self.pending.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                del self.jobs[job.job_id]
+            raise QueueFull(f"Job queue is full ({self.max_queue} jobs)")
+        return job
+
+    def get(self, job_id, wait=0.0):
+        """Return the Job (waiting up to wait seconds for it to finish) or None"""
+        self._expire()
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None and wait > 0:
+            job.done.wait(wait)
+        return job
+
+    def depth(self):
+        """Number of jobs waiting to start"""
+        return self.pending.qsize()
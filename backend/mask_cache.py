@@ -0,0 +1,167 @@
+"""
+Content-addressed cache of background-removal alpha masks
+
+Entries are keyed by (image id, model), where the image id is the SHA-256 of
+the uploaded image bytes. Each entry keeps the original image bytes and the
+computed mask so a background color change only needs a re-composite. The
+in-memory cache is an LRU bounded by bytes; evicted entries can optionally
+spill to a directory on disk (also bounded) and are promoted back on access.
+With write_through every entry is written to the directory as soon as it is
+cached, so several server processes sharing the directory see each other's
+masks.
+"""
+import hashlib
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+def image_id_for(image_bytes):
+    """Content address of an uploaded image"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+IMAGE_ID = re.compile(r'[0-9a-f]{64}')
+# Model names such as u2net or isnet-general-use; no dots or separators
+MODEL_NAME = re.compile(r'[\w-]+')
+
+
+def is_image_id(value):
+    """Whether value has the form of an image_id_for() digest"""
+    return isinstance(value, str) and IMAGE_ID.fullmatch(value) is not None
+
+
+class MaskCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024, spill_dir=None, max_spill_bytes=2 * 1024 * 1024 * 1024,
+                 write_through=False):
+        if write_through and not spill_dir:
+            raise ValueError("write_through requires a spill directory")
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.write_through = write_through
+        self.max_spill_bytes = max_spill_bytes
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @staticmethod
+    def _entry_size(image_bytes, mask):
+        return len(image_bytes) + mask.nbytes
+
+    def _spill_path(self, image_id, model):
+        # Both parts end up in a file name: never let them leave spill_dir
+        if not is_image_id(image_id) or not isinstance(model, str) or not MODEL_NAME.fullmatch(model):
+            raise ValueError(f"Invalid mask cache key ({image_id!r}, {model!r})")
+        return os.path.join(self.spill_dir, f"{image_id}.{model}.npz")
+
+    def get(self, image_id, model):
+        """Return (image_bytes, mask) or None; mask is a uint8 (h, w) array"""
+        key = (image_id, model)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._load_spilled(image_id, model)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.put(image_id, model, *entry)
+        return entry
+
+    def put(self, image_id, model, image_bytes, mask):
+        """Insert an entry, evicting (and spilling) least recently used ones"""
+        mask = np.ascontiguousarray(mask, dtype=np.uint8)
+        size = self._entry_size(image_bytes, mask)
+        if size > self.max_bytes or self.write_through:
+            self._spill(image_id, model, image_bytes, mask)
+        if size > self.max_bytes:
+            return
+
+        evicted = []
+        with self.lock:
+            key = (image_id, model)
+            if key in self.entries:
+                old_bytes, old_mask = self.entries.pop(key)
+                self.current_bytes -= self._entry_size(old_bytes, old_mask)
+            self.entries[key] = (image_bytes, mask)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                old_key, (old_bytes, old_mask) = self.entries.popitem(last=False)
+                self.current_bytes -= self._entry_size(old_bytes, old_mask)
+                evicted.append((old_key, old_bytes, old_mask))
+
+        if not self.write_through:
+            for (old_id, old_model), old_bytes, old_mask in evicted:
+                self._spill(old_id, old_model, old_bytes, old_mask)
+
+    def _spill(self, image_id, model, image_bytes, mask):
+        if not self.spill_dir:
+            return
+        try:
+            path = self._spill_path(image_id, model)
+            if os.path.exists(path):
+                return
+            buffer = io.BytesIO()
+            np.savez(buffer, image=np.frombuffer(image_bytes, dtype=np.uint8), mask=mask)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(tmp_path, path)
+            self._trim_spill_dir()
+        except (OSError, ValueError) as e:
+            print(f"[X] Could not spill mask to disk: {str(e)}")
+
+    def _load_spilled(self, image_id, model):
+        if not self.spill_dir:
+            return None
+        try:
+            with np.load(self._spill_path(image_id, model)) as data:
+                return data['image'].tobytes(), data['mask']
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _trim_spill_dir(self):
+        """Delete the oldest spilled entries while the directory is over budget"""
+        files = []
+        for name in os.listdir(self.spill_dir):
+            if name.endswith('.npz'):
+                path = os.path.join(self.spill_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_spill_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+def composite(image, mask, bg_rgb):
+    """Place image over a solid bg_rgb background using mask as alpha"""
+    background = Image.new('RGB', image.size, bg_rgb)
+    background.paste(image.convert('RGB'), mask=Image.fromarray(mask, mode='L'))
+    return background
@@ -0,0 +1,219 @@
+"""
+Minimal Prometheus-style metrics and per-request stage timers
+
+Counters, gauges and histograms are rendered in the Prometheus text exposition
+format by render(). stage() times a block of work, records it in the stage
+histogram labelled with the current endpoint, and remembers it for the
+request's Server-Timing header.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(label_names, values, extra=()):
+    pairs = list(zip(label_names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """A gauge set explicitly, or read from a callback at render time"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, label_names=(), callback=None):
+        super().__init__(name, documentation, label_names)
+        self.values = {}
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def render(self):
+        if self.callback is not None:
+            try:
+                return self.header() + [f"{self.name} {float(self.callback())}"]
+            except Exception:
+                return self.header()
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            items = sorted((k, dict(v, counts=list(v["counts"]))) for k, v in self.series.items())
+        for key, series in items:
+            for bound, count in zip(self.buckets, series["counts"]):
+                labels = _format_labels(self.label_names, key, [("le", repr(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.label_names, key, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'face_app_request_seconds', 'Request latency by endpoint', ('endpoint', 'method')))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'face_app_stage_seconds', 'Time spent per processing stage', ('endpoint', 'stage')))
+REQUESTS = REGISTRY.register(Counter(
+    'face_app_requests_total', 'Requests by endpoint and status code', ('endpoint', 'status')))
+ERRORS = REGISTRY.register(Counter(
+    'face_app_errors_total', 'Failed requests (status >= 400) by endpoint and status code', ('endpoint', 'status')))
+FACES_PER_FRAME = REGISTRY.register(Histogram(
+    'face_app_faces_per_frame', 'Faces detected per image', ('endpoint',), buckets=(0, 1, 2, 3, 5, 10, 20, 50)))
+ADMISSION_ACTIVE = REGISTRY.register(Gauge(
+    'face_app_admission_active', 'Requests running per admission budget', ('budget',)))
+ADMISSION_QUEUED = REGISTRY.register(Gauge(
+    'face_app_admission_queued', 'Requests waiting for admission per budget', ('budget',)))
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    'face_app_admission_rejected_total', 'Requests shed by admission control', ('budget', 'reason')))
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    'face_app_startup_seconds', 'Time each startup step took', ('component',)))
+SHARD_SECONDS = REGISTRY.register(Histogram(
+    'face_app_shard_seconds', 'Gallery shard match latency by shard', ('shard',)))
+SHARD_ERRORS = REGISTRY.register(Counter(
+    'face_app_shard_errors_total', 'Gallery shard calls without a result', ('shard', 'reason')))
+
+
+# Timings of the request (or job) running on this thread
+_local = threading.local()
+
+
+@contextmanager
+def request_scope(endpoint):
+    """Attribute stage timings on this thread to endpoint until the block exits"""
+    previous = getattr(_local, 'scope', None)
+    _local.scope = {"endpoint": endpoint, "stages": []}
+    try:
+        yield _local.scope
+    finally:
+        _local.scope = previous
+
+
+def begin_request(endpoint):
+    _local.scope = {"endpoint": endpoint, "stages": []}
+
+
+def end_request():
+    """Return and clear the stage timings [(stage, seconds)] of this thread's request"""
+    scope = getattr(_local, 'scope', None)
+    _local.scope = None
+    return scope["stages"] if scope else []
+
+
+@contextmanager
+def stage(name):
+    """Time a processing stage of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        scope = getattr(_local, 'scope', None)
+        STAGE_SECONDS.observe(elapsed, endpoint=scope["endpoint"] if scope else 'none', stage=name)
+        if scope is not None:
+            scope["stages"].append((name, elapsed))
+
+
+def in_scope(endpoint, func):
+    """Wrap func so that its stage timings are attributed to endpoint (for worker threads)"""
+    def wrapper(*args, **kwargs):
+        with request_scope(endpoint):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def server_timing_header(stages):
+    """Format stage timings as a Server-Timing header value"""
+    totals = {}
+    for name, seconds in stages:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+
+def render():
+    return REGISTRY.render()
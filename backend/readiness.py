@@ -0,0 +1,78 @@
+"""
+Startup state of the app's components, for the /ready probe
+
+Each component (gallery, encoder, ...) is 'pending' until its warm-up starts,
+then 'loading' and finally 'ready' or 'failed', with the seconds it took.
+Warm-ups run in the background while the server already answers /health, so
+a load balancer should route traffic by /ready instead: it turns 200 once the
+required components are ready and no warm-up is still running.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+PENDING = 'pending'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class Readiness:
+    """
+    components lists every component in startup order; required ones must be
+    ready. started is the perf_counter() value startup is measured from.
+    """
+
+    def __init__(self, components, required=(), started=None):
+        self.required = tuple(required)
+        self.started = time.perf_counter() if started is None else started
+        self._components = {name: {"state": PENDING, "seconds": None} for name in components}
+        self._lock = threading.Lock()
+
+    def _set(self, name, **fields):
+        with self._lock:
+            self._components.setdefault(name, {"state": PENDING, "seconds": None}).update(fields)
+
+    def record(self, name, seconds, state=READY):
+        """Record a step that was timed elsewhere"""
+        self._set(name, state=state, seconds=round(seconds, 3))
+
+    def skip(self, name, reason):
+        self._set(name, state=SKIPPED, reason=reason)
+
+    @contextmanager
+    def track(self, name):
+        """Time a component's warm-up; an exception marks it failed and propagates"""
+        self._set(name, state=LOADING)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self._set(name, state=FAILED, seconds=round(time.perf_counter() - start, 3), error=str(e))
+            raise
+        self._set(name, state=READY, seconds=round(time.perf_counter() - start, 3))
+
+    def state(self, name):
+        with self._lock:
+            return self._components.get(name, {}).get("state", PENDING)
+
+    def components(self):
+        with self._lock:
+            return {name: dict(info) for name, info in self._components.items()}
+
+    @property
+    def ready(self):
+        components = self.components()
+        if any(info["state"] in (PENDING, LOADING) for info in components.values()):
+            return False
+        return all(components.get(name, {}).get("state") == READY for name in self.required)
+
+    def summary(self):
+        """One line with the total startup time and each component's share"""
+        parts = [
+            f"{name} {info['seconds']:.2f}s" + ('' if info["state"] == READY else f" {info['state']}")
+            for name, info in self.components().items()
+            if info["seconds"] is not None
+        ]
+        return f"{time.perf_counter() - self.started:.2f}s ({', '.join(parts)})"
@@ -0,0 +1,149 @@
+"""
+Memory-mapped identity gallery shared by several server processes
+
+The process that changes the gallery writes every array of the new version to
+.npy files in a fresh generation directory, then bumps a generation counter
+kept in a small memory-mapped file. Serving processes compare the counter with
+the generation they have mapped and remap when it moves. The arrays are mapped
+read-only, so N workers share one copy of the gallery in the page cache instead
+of holding N copies on their heaps.
+
+Layout of the shared directory:
+    generation      int64 counter, memory-mapped by every process
+    lock            flock()ed by writers (Unix only, like gunicorn)
+    load.lock       flock()ed while the first process loads known_faces/
+    loaded          token of the server start whose gallery was published
+    <generation>/   header.json (max_medoids, and base_length for a gallery
+                    that only appended to the previous generation) and one
+                    .npy file per gallery array, the identity names included
+                    (as a StringTable). Template rows keep the gallery's
+                    storage dtype; centroids are only written when they are
+                    not the template rows themselves, exact_rows (float32
+                    originals for re-scoring) only for a quantized gallery
+                    that keeps them.
+"""
+import json
+import os
+import shutil
+from contextlib import contextmanager
+
+import numpy as np
+
+from identity_gallery import IdentityGallery, StringTable
+
+ARRAYS = ('sample_counts', 'template_rows', 'template_norms', 'template_offsets')
+# Written only when the gallery has them
+OPTIONAL_ARRAYS = ('centroids', 'centroid_norms', 'scale', 'exact_rows')
+
+
+class SharedGallery:
+    def __init__(self, directory, keep=2):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+        counter_path = os.path.join(directory, 'generation')
+        if not os.path.exists(counter_path):
+            # Create the counter atomically; another process may be racing us
+            tmp_path = f"{counter_path}.{os.getpid()}.tmp"
+            np.zeros(1, dtype=np.int64).tofile(tmp_path)
+            try:
+                os.link(tmp_path, counter_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        self.counter = np.memmap(counter_path, dtype=np.int64, mode='r+', shape=(1,))
+
+    @property
+    def generation(self):
+        return int(self.counter[0])
+
+    @contextmanager
+    def lock(self, name='lock'):
+        """Exclusive lock across processes, held while a new generation is built"""
+        import fcntl
+
+        with open(os.path.join(self.directory, name), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def loaded_by(self):
+        """Token passed to mark_loaded() by the last full load, or None"""
+        try:
+            with open(os.path.join(self.directory, 'loaded')) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def mark_loaded(self, token):
+        path = os.path.join(self.directory, 'loaded')
+        with open(path + '.tmp', 'w') as f:
+            f.write(token)
+        os.replace(path + '.tmp', path)
+
+    def _path(self, generation):
+        return os.path.join(self.directory, str(generation))
+
+    def publish(self, gallery):
+        """Write gallery as the next generation and make it current; call with lock() held"""
+        generation = self.generation + 1
+        path = self._path(generation)
+        tmp_path = path + '.tmp'
+        for leftover in (path, tmp_path):
+            shutil.rmtree(leftover, ignore_errors=True)
+
+        os.makedirs(tmp_path)
+        arrays = {name: getattr(gallery, name) for name in ARRAYS}
+        if not gallery.single_row:
+            arrays.update(centroids=gallery.centroids, centroid_norms=gallery.centroid_norms)
+        if gallery.scale is not None:
+            arrays['scale'] = gallery.scale
+        if gallery.exact_rows is not None:
+            arrays['exact_rows'] = gallery.exact_rows
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.asarray(array))
+        names = StringTable.from_strings(gallery.names)
+        np.save(os.path.join(tmp_path, 'name_data.npy'), names.data)
+        np.save(os.path.join(tmp_path, 'name_offsets.npy'), names.offsets)
+        with open(os.path.join(tmp_path, 'header.json'), 'w') as f:
+            json.dump({"max_medoids": gallery.max_medoids, "base_length": gallery.base_length}, f)
+        os.replace(tmp_path, path)
+
+        # Readers only look at a generation once the counter points to it
+        self.counter[0] = generation
+        self.counter.flush()
+
+        # Mapped files stay valid after unlink, so old readers are unaffected
+        for entry in os.listdir(self.directory):
+            if entry.isdigit() and int(entry) <= generation - self.keep:
+                shutil.rmtree(self._path(entry), ignore_errors=True)
+        return generation
+
+    def load(self, generation=None):
+        """Map a generation (default: the current one) read-only; returns (generation, IdentityGallery)"""
+        while True:
+            current = self.generation if generation is None else generation
+            path = self._path(current)
+            try:
+                with open(os.path.join(path, 'header.json')) as f:
+                    header = json.load(f)
+                arrays = {
+                    name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+                    for name in ARRAYS + ('name_data', 'name_offsets')
+                }
+                for name in OPTIONAL_ARRAYS:
+                    if os.path.exists(os.path.join(path, f"{name}.npy")):
+                        arrays[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+                break
+            except FileNotFoundError:
+                # Superseded and removed while we were opening it; take the newest
+                if generation is not None or self.generation == current:
+                    raise
+        names = StringTable(arrays.pop('name_data'), arrays.pop('name_offsets'))
+        return current, IdentityGallery.from_arrays(
+            names, max_medoids=header["max_medoids"], base_length=header.get("base_length"), **arrays
+        )
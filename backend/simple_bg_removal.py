@@ -1,26 +1,21 @@
 """
 Simple background removal using OpenCV - no AI models required!
 Uses GrabCut algorithm for intelligent foreground/background segmentation
+
+Segmentation runs on a downscaled copy (max_side pixels on the long edge); the
+mask is then upsampled and feathered to full size and composited in a single
+integer blend.
 """
 import cv2
 import numpy as np
 from PIL import Image
 
 
-def remove_background_simple(image, bg_color=(255, 255, 255)):
-    """
-    Remove background using OpenCV's GrabCut algorithm
-
-    Args:
-        image: PIL Image or numpy array
-        bg_color: RGB tuple for background color (default white)
-
-    Returns:
-        PIL Image with background replaced by bg_color
-    """
+def _to_rgb_array(image):
+    """Return a uint8 RGB numpy array for a PIL Image or numpy array"""
     # Convert PIL to numpy if needed
     if isinstance(image, Image.Image):
-        img_array = np.array(image)
+        img_array = np.asarray(image.convert('RGB'))
     else:
         img_array = image
 
@@ -30,62 +25,75 @@ def remove_background_simple(image, bg_color=(255, 255, 255)):
     elif img_array.shape[2] == 4:  # RGBA
         img_array = cv2.cvtColor(img_array, cv2.COLOR_RGBA2RGB)
 
+    return np.ascontiguousarray(img_array, dtype=np.uint8)
+
+
+def _downscale(img_array, max_side):
+    """Shrink so the long edge is at most max_side; returns (small, scale)"""
+    height, width = img_array.shape[:2]
+    scale = min(1.0, max_side / max(height, width))
+    if scale >= 1.0:
+        return img_array, 1.0
+    small = cv2.resize(img_array, (max(1, int(width * scale)), max(1, int(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    return small, scale
+
+
+def _finish_mask(small_mask, size, feather):
+    """Upsample a 0/255 mask to size=(width, height) and feather its edges"""
+    mask = cv2.resize(small_mask, size, interpolation=cv2.INTER_LINEAR)
+    if feather > 0:
+        kernel = feather * 2 + 1
+        mask = cv2.GaussianBlur(mask, (kernel, kernel), 0)
+    return mask
+
+
+def grabcut_mask(image, max_side=512, iterations=3, feather=3):
+    """
+    Foreground mask using OpenCV's GrabCut algorithm
+
+    Returns a uint8 (h, w) mask at full resolution, 255 = foreground.
+    Assumes the subject is roughly in the center of the image.
+    """
+    img_array = _to_rgb_array(image)
+    small, _ = _downscale(img_array, max_side)
+
     # Create mask
-    mask = np.zeros(img_array.shape[:2], np.uint8)
+    mask = np.zeros(small.shape[:2], np.uint8)
 
     # Create temporary arrays for GrabCut
     bgd_model = np.zeros((1, 65), np.float64)
     fgd_model = np.zeros((1, 65), np.float64)
 
     # Define rectangle around the subject (slightly inside the image borders)
-    height, width = img_array.shape[:2]
-    margin = min(width, height) // 20  # 5% margin
+    height, width = small.shape[:2]
+    margin = max(1, min(width, height) // 20)  # 5% margin
     rect = (margin, margin, width - margin * 2, height - margin * 2)
 
-    # Apply GrabCut algorithm
-    # This assumes the subject is roughly in the center
-    try:
-        cv2.grabCut(img_array, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
-
-        # Create binary mask where 0 and 2 are background, 1 and 3 are foreground
-        mask2 = np.where((mask == 2) | (mask == 0), 0, 1).astype('uint8')
-
-        # Apply morphological operations to smooth the mask
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-        mask2 = cv2.morphologyEx(mask2, cv2.MORPH_CLOSE, kernel)
-        mask2 = cv2.morphologyEx(mask2, cv2.MORPH_OPEN, kernel)
+    cv2.grabCut(small, mask, rect, bgd_model, fgd_model, iterations, cv2.GC_INIT_WITH_RECT)
 
-        # Optional: blur the mask edges for smoother transition
-        mask2 = cv2.GaussianBlur(mask2, (5, 5), 0)
+    # 0 and 2 are background, 1 and 3 are foreground
+    mask = np.where((mask == cv2.GC_FGD) | (mask == cv2.GC_PR_FGD), 255, 0).astype(np.uint8)
 
-        # Create output image with custom background
-        output = np.full_like(img_array, bg_color, dtype=np.uint8)
+    # Apply morphological operations to smooth the mask
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
 
-        # Blend foreground with new background
-        for c in range(3):
-            output[:, :, c] = output[:, :, c] * (1 - mask2) + img_array[:, :, c] * mask2
+    return _finish_mask(mask, (img_array.shape[1], img_array.shape[0]), feather)
 
-        # Convert back to PIL Image
-        return Image.fromarray(output)
 
-    except Exception as e:
-        print(f"GrabCut failed: {e}")
-        # Fallback: return original image with note
-        return Image.fromarray(img_array)
-
-
-def remove_background_edge_detection(image, bg_color=(255, 255, 255)):
+def edge_mask(image, max_side=768, feather=2):
     """
-    Alternative method using edge detection and flood fill
-    Works better for images with clear subject boundaries
+    Foreground mask using edge detection and flood fill from the corners
+
+    Works better for images with clear subject boundaries on a plain background.
     """
-    if isinstance(image, Image.Image):
-        img_array = np.array(image)
-    else:
-        img_array = image
+    img_array = _to_rgb_array(image)
+    small, _ = _downscale(img_array, max_side)
 
     # Convert to grayscale for edge detection
-    gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+    gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
 
     # Apply edge detection
     edges = cv2.Canny(gray, 50, 150)
@@ -104,13 +112,53 @@ def remove_background_edge_detection(image, bg_color=(255, 255, 255)):
     cv2.floodFill(edges, mask, (0, height - 1), 255)
     cv2.floodFill(edges, mask, (width - 1, height - 1), 255)
 
-    # Invert mask
-    mask = mask[1:-1, 1:-1]
-    mask = cv2.bitwise_not(mask)
+    # floodFill marks filled pixels with 1; invert to get the foreground
+    mask = np.where(mask[1:-1, 1:-1] == 0, 255, 0).astype(np.uint8)
+
+    return _finish_mask(mask, (img_array.shape[1], img_array.shape[0]), feather)
+
+
+def composite_mask(image, mask, bg_color=(255, 255, 255)):
+    """
+    Blend image over a solid bg_color using a uint8 mask as alpha
+
+    One vectorized integer blend: out = (img * a + bg * (255 - a)) / 255
+    """
+    img_array = _to_rgb_array(image)
+    alpha = mask[:, :, None].astype(np.uint16)
+    background = np.asarray(bg_color, dtype=np.uint16)
+
+    blended = img_array * alpha
+    blended += background * (255 - alpha)
+    blended += 127
+    blended //= 255
+    return blended.astype(np.uint8)
 
-    # Apply to original image
-    output = np.full_like(img_array, bg_color, dtype=np.uint8)
-    mask_3ch = cv2.cvtColor(mask, cv2.COLOR_GRAY2RGB) / 255.0
-    output = (output * (1 - mask_3ch) + img_array * mask_3ch).astype(np.uint8)
 
-    return Image.fromarray(output)
+def remove_background_simple(image, bg_color=(255, 255, 255)):
+    """
+    Remove background using OpenCV's GrabCut algorithm
+
+    Args:
+        image: PIL Image or numpy array
+        bg_color: RGB tuple for background color (default white)
+
+    Returns:
+        PIL Image with background replaced by bg_color
+    """
+    img_array = _to_rgb_array(image)
+    try:
+        return Image.fromarray(composite_mask(img_array, grabcut_mask(img_array), bg_color))
+    except Exception as e:
+        print(f"GrabCut failed: {e}")
+        # Fallback: return original image with note
+        return Image.fromarray(img_array)
+
+
+def remove_background_edge_detection(image, bg_color=(255, 255, 255)):
+    """
+    Alternative method using edge detection and flood fill
+    Works better for images with clear subject boundaries
+    """
+    img_array = _to_rgb_array(image)
+    return Image.fromarray(composite_mask(img_array, edge_mask(img_array), bg_color))
@@ -0,0 +1,112 @@
+"""
+Checks that IdentityGallery.from_encodings builds the same gallery on its
+one-photo-per-identity fast path as on the general grouping path, and that
+quantized galleries re-score against float32 originals only when asked to,
+and that updates with stable ids leave tombstones instead of renumbering
+
+Run from backend/:
+    python test_identity_gallery.py     (or python -m pytest test_identity_gallery.py)
+"""
+import numpy as np
+
+from identity_gallery import IdentityGallery
+
+
+def random_encodings(count, seed=0):
+    return np.random.default_rng(seed).normal(0, 0.1, (count, 128))
+
+
+def assert_same_gallery(a, b):
+    assert list(a.names) == list(b.names)
+    assert list(a.sample_counts) == list(b.sample_counts)
+    for name in ('template_rows', 'template_norms', 'template_offsets', 'centroids'):
+        assert np.array_equal(getattr(a, name), getattr(b, name)), name
+
+
+def test_unique_names_fast_path():
+    """One photo per name: same arrays as building every identity's template"""
+    names = [f"person_{i}" for i in range(50)]
+    encodings = random_encodings(50)
+
+    fast = IdentityGallery.from_encodings(names, encodings)
+    general = IdentityGallery(names, [[encoding] for encoding in encodings])
+    assert_same_gallery(fast, general)
+
+    queries = encodings[:10] + random_encodings(10, seed=1) * 0.05
+    shortlists = np.tile(np.arange(50), (10, 1))
+    for got, expected in zip(fast.refine(queries, shortlists, 3), general.refine(queries, shortlists, 3)):
+        assert np.array_equal(got, expected)
+
+
+def test_repeated_names_are_grouped():
+    """Several photos per name still become one identity, in first-seen order"""
+    names = ['bob', 'alice', 'bob', 'carol', 'alice', 'bob']
+    encodings = random_encodings(len(names))
+
+    gallery = IdentityGallery.from_encodings(names, encodings)
+    assert list(gallery.names) == ['bob', 'alice', 'carol']
+    assert list(gallery.sample_counts) == [3, 2, 1]
+    # A one-photo identity's template is that photo, as on the fast path
+    carol = gallery.template_rows[gallery.template_offsets[2]:gallery.template_offsets[3]]
+    assert np.array_equal(carol, encodings[3:4].astype(np.float32))
+    assert np.allclose(gallery.centroids[0], encodings[[0, 2, 5]].mean(axis=0), atol=1e-6)
+
+
+def test_quantized_templates():
+    """int8 templates stay int8 through updates and refine close to float32"""
+    names = ['bob', 'alice', 'bob', 'carol']
+    encodings = random_encodings(len(names))
+    exact = IdentityGallery.from_encodings(names, encodings)
+    gallery = IdentityGallery.from_encodings(names, encodings, storage='int8')
+    assert gallery.template_rows.dtype == np.int8 and gallery.centroids.dtype == np.int8
+
+    updated = gallery.updated({'dave': [encodings[1]], 'carol': []})
+    assert list(updated.names) == ['bob', 'alice', 'dave']
+    assert updated.template_rows.dtype == np.int8 and np.array_equal(updated.scale, gallery.scale)
+
+    queries = encodings + random_encodings(len(names), seed=1) * 0.05
+    shortlists = np.tile(np.arange(3), (len(names), 1))
+    exact_ids, exact_distances = exact.refine(queries, shortlists, 3)
+    ids, distances = gallery.refine(queries, shortlists, 3)
+    assert np.array_equal(ids[:, 0], exact_ids[:, 0])
+    assert np.allclose(distances, exact_distances, atol=0.01)
+
+    # With keep_exact, refine uses the float32 originals, through updates too
+    kept = IdentityGallery.from_encodings(names, encodings, storage='int8', keep_exact=True)
+    assert kept.template_rows.dtype == np.int8 and kept.exact_rows.dtype == np.float32
+    for got, expected in zip(kept.refine(queries, shortlists, 3), exact.refine(queries, shortlists, 3)):
+        assert np.allclose(got, expected, atol=1e-6)
+    exact_updated = exact.updated({'dave': [encodings[1]]})
+    kept_updated = kept.updated({'dave': [encodings[1]]})
+    assert np.array_equal(kept_updated.exact_rows, exact_updated.template_rows)
+
+
+def test_stable_ids():
+    """Updates with stable_ids append and tombstone until tombstones outnumber live identities"""
+    names = ['bob', 'alice', 'carol', 'dave']
+    encodings = random_encodings(6)
+    gallery = IdentityGallery.from_encodings(names, encodings[:4])
+
+    updated = gallery.updated({'alice': [encodings[4]], 'carol': []}, stable_ids=True)
+    assert updated.base_length == 4
+    assert list(updated.names) == ['bob', 'alice', 'carol', 'dave', 'alice']
+    assert list(updated.live) == [True, False, False, True, True]
+    assert np.array_equal(updated.template_rows[:4], gallery.template_rows)
+    assert np.array_equal(updated.centroids[4], encodings[4].astype(np.float32))
+
+    # Three tombstones against two live identities: compacted and renumbered
+    compacted = updated.updated({'dave': []}, stable_ids=True)
+    assert compacted.base_length is None
+    assert list(compacted.names) == ['bob', 'alice'] and compacted.live.all()
+    assert_same_gallery(compacted, gallery.updated({'alice': [encodings[4]], 'carol': [], 'dave': []}))
+
+
+def main():
+    for test in (test_unique_names_fast_path, test_repeated_names_are_grouped, test_quantized_templates,
+                 test_stable_ids):
+        test()
+        print(f"[OK] {test.__name__}")
+
+
+if __name__ == '__main__':
+    main()
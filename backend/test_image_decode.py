@@ -0,0 +1,61 @@
+"""
+Checks that malformed uploads fail with ImageDecodeError (a 400) and never
+with a raw decoder error (a 500)
+
+Run from backend/:
+    python test_image_decode.py     (or python -m pytest test_image_decode.py)
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+from image_decode import ImageDecodeError, ImageTooLarge, decode_image
+
+
+def encoded(fmt, size=(64, 48)):
+    pixels = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def assert_rejected(data):
+    try:
+        decode_image(data)
+    except ImageDecodeError:
+        return
+    raise AssertionError("ImageDecodeError not raised")
+
+
+def test_valid_images():
+    for fmt in ('PNG', 'JPEG', 'BMP', 'GIF', 'TIFF'):
+        image, scale = decode_image(encoded(fmt))
+        assert image.shape == (48, 64, 3) and image.dtype == np.uint8 and scale == 1.0, fmt
+
+
+def test_truncated_images():
+    """Files cut short after their header fail as a decode error"""
+    for fmt in ('PNG', 'JPEG', 'BMP', 'GIF', 'TIFF'):
+        data = encoded(fmt)
+        assert_rejected(data[:len(data) // 2])
+
+
+def test_not_an_image_or_too_large():
+    assert_rejected(b'not an image')
+    assert_rejected(b'')
+    try:
+        decode_image(encoded('PNG'), max_pixels=100)
+    except ImageTooLarge:
+        return
+    raise AssertionError("ImageTooLarge not raised")
+
+
+def main():
+    for test in (test_valid_images, test_truncated_images, test_not_an_image_or_too_large):
+        test()
+        print(f"[OK] {test.__name__}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""
+Append-only store and incremental clustering of unrecognized faces
+
+Faces that match nobody in the gallery are kept in a directory:
+    faces.bin       one fixed-size record (time, float32 encoding) per face,
+                    append-only and memory-mapped for reading
+    crops/          a small JPEG crop per face: crops/<id // 1000>/<id>.jpg
+    labels.npy      cluster label of every clustered face (the id of one of
+                    its members), PROMOTED once it became a known identity
+    cells.npz       k-means cells that block the neighbour search
+    clusters.json   clusters with at least min_size faces, largest first
+
+Each clustering run only places the faces added since the previous run.
+Neighbours are found cell by cell: faces are bucketed into ~sqrt(N) k-means
+cells and the new faces of a cell are compared with the faces of its n_probe
+nearest cells, in chunks of at most chunk_elements distances, so no N x N
+matrix is ever built. Labels then spread over the neighbour graph in the
+manner of Chinese whispers: new faces repeatedly take the label with the most
+edge weight among their neighbours (half of them per round, at random, so the
+vectorized update doesn't oscillate), while faces clustered earlier keep
+theirs. cluster(full=True) relabels everything, which also merges clusters
+that later faces bridged.
+
+Appends and clustering take flock()s in the directory, so several server
+processes can share one store.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from ann_index import kmeans
+from face_matcher import pairwise_distances, top_k_smallest
+
+RECORD = np.dtype([('time', '<f8'), ('encoding', '<f4', (128,))])
+UNASSIGNED = -1
+PROMOTED = -2
+# Below this many faces one cell holds everything (exact search)
+MIN_CELL_TRAIN = 2000
+CROP_MARGIN = 0.4
+CROP_SIDE = 160
+
+
+def propagate_labels(labels, free, src, dst, weight, iterations=30, seed=0):
+    """
+    Chinese-whispers label propagation over the edges src -> dst, in place
+
+    Only nodes marked in free change label; each round a random half of them
+    takes the label with the largest summed edge weight among its neighbours.
+    """
+    if len(src) == 0:
+        return labels
+    rng = np.random.default_rng(seed)
+    quiet_rounds = 0
+    for _ in range(iterations):
+        # Total weight per (node, neighbour label)
+        neighbour_labels = labels[dst]
+        order = np.lexsort((neighbour_labels, src))
+        nodes, candidates, weights = src[order], neighbour_labels[order], weight[order]
+        starts = np.flatnonzero(np.r_[True, (nodes[1:] != nodes[:-1]) | (candidates[1:] != candidates[:-1])])
+        totals = np.add.reduceat(weights, starts)
+        nodes, candidates = nodes[starts], candidates[starts]
+
+        # Heaviest label per node, smallest label on ties
+        order = np.lexsort((candidates, -totals, nodes))
+        nodes, candidates = nodes[order], candidates[order]
+        first = np.r_[True, nodes[1:] != nodes[:-1]]
+        nodes, best = nodes[first], candidates[first]
+
+        update = free[nodes] & (rng.random(len(nodes)) < 0.5)
+        changed = labels[nodes[update]] != best[update]
+        labels[nodes[update]] = best[update]
+
+        quiet_rounds = 0 if changed.any() else quiet_rounds + 1
+        if quiet_rounds >= 3:
+            break
+    return labels
+
+
+class UnknownFaceStore:
+    """
+    threshold: largest distance between two faces that links them (stricter
+        than the match tolerance, so clusters stay pure)
+    min_size: faces a cluster needs before it is listed
+    k: neighbours kept per face
+    n_probe: nearest cells searched for the neighbours of a cell
+    """
+
+    def __init__(self, directory, threshold=0.5, min_size=3, k=20, n_probe=6, chunk_elements=4_000_000,
+                 representatives=5):
+        self.directory = directory
+        self.threshold = threshold
+        self.min_size = min_size
+        self.k = k
+        self.n_probe = n_probe
+        self.chunk_elements = chunk_elements
+        self.representatives = representatives
+        self.records_path = os.path.join(directory, 'faces.bin')
+        self._clusterer = None
+        self._summary = (None, [])
+        os.makedirs(os.path.join(directory, 'crops'), exist_ok=True)
+
+    def __len__(self):
+        if not os.path.exists(self.records_path):
+            return 0
+        return os.path.getsize(self.records_path) // RECORD.itemsize
+
+    @contextmanager
+    def _lock(self, name):
+        import fcntl
+
+        with open(os.path.join(self.directory, name), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def crop_path(self, face_id):
+        return os.path.join(self.directory, 'crops', str(face_id // 1000), f"{face_id}.jpg")
+
+    @staticmethod
+    def _crop(image, box):
+        """JPEG of the face box plus a margin, at most CROP_SIDE pixels long"""
+        top, right, bottom, left = box
+        margin = int(CROP_MARGIN * max(bottom - top, right - left))
+        height, width = image.shape[:2]
+        crop = image[max(0, top - margin):min(height, bottom + margin), max(0, left - margin):min(width, right + margin)]
+        scale = CROP_SIDE / max(crop.shape[:2])
+        if scale < 1.0:
+            crop = cv2.resize(crop, (max(1, round(crop.shape[1] * scale)), max(1, round(crop.shape[0] * scale))),
+                              interpolation=cv2.INTER_AREA)
+        return cv2.imencode('.jpg', cv2.cvtColor(crop, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+    def add(self, image, locations, encodings):
+        """Append faces of an RGB image, given their boxes and encodings; returns their ids"""
+        if len(encodings) == 0:
+            return []
+        crops = [self._crop(image, box) for box in locations]
+        records = np.zeros(len(encodings), dtype=RECORD)
+        records['time'] = time.time()
+        records['encoding'] = encodings
+
+        with self._lock('append.lock'):
+            start = len(self)
+            # Drop a partial record left by a crash, so ids stay aligned
+            if os.path.exists(self.records_path):
+                os.truncate(self.records_path, start * RECORD.itemsize)
+            for offset, crop in enumerate(crops):
+                path = self.crop_path(start + offset)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(crop)
+            with open(self.records_path, 'ab') as f:
+                f.write(records.tobytes())
+        return list(range(start, start + len(encodings)))
+
+    def records(self, count=None):
+        """The first count records (default: all), memory-mapped read-only"""
+        count = len(self) if count is None else count
+        if count == 0:
+            return np.zeros(0, dtype=RECORD)
+        return np.memmap(self.records_path, dtype=RECORD, mode='r', shape=(count,))
+
+    def _load(self, name, default):
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return default
+        if name.endswith('.json'):
+            with open(path) as f:
+                return json.load(f)
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+    def _save(self, name, value, **arrays):
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            if name.endswith('.json'):
+                f.write(json.dumps(value).encode())
+            elif arrays:
+                np.savez(f, **arrays)
+            else:
+                np.save(f, value)
+        os.replace(tmp_path, path)
+
+    def _load_labels(self):
+        path = os.path.join(self.directory, 'labels.npy')
+        return np.load(path) if os.path.exists(path) else np.empty(0, dtype=np.int64)
+
+    def _cells(self, records, rebuild=False):
+        """Cell of every face and the cell centroids, training or extending them as needed"""
+        total = len(records)
+        saved = None if rebuild else self._load('cells.npz', None)
+        if saved is None or total > 4 * int(saved['trained_on']):
+            if total < MIN_CELL_TRAIN:
+                centroids = records['encoding'].mean(axis=0, keepdims=True).astype(np.float32)
+            else:
+                n_cells = int(np.sqrt(total))
+                rng = np.random.default_rng(0)
+                sample = np.sort(rng.choice(total, min(total, max(20000, 10 * n_cells)), replace=False))
+                centroids = kmeans(np.ascontiguousarray(records['encoding'][sample]), n_cells)
+            saved = {"centroids": centroids, "assignment": np.empty(0, dtype=np.int32), "trained_on": total}
+
+        assignment = [saved["assignment"]]
+        chunk = max(1, self.chunk_elements // len(saved["centroids"]))
+        for start in range(len(saved["assignment"]), total, chunk):
+            encodings = np.ascontiguousarray(records['encoding'][start:start + chunk])
+            assignment.append(np.argmin(pairwise_distances(encodings, saved["centroids"]), axis=1).astype(np.int32))
+        saved["assignment"] = np.concatenate(assignment)
+        self._save('cells.npz', None, **saved)
+        return saved["assignment"], saved["centroids"]
+
+    def _neighbour_graph(self, records, assignment, centroids, queries, active):
+        """Edges (src, dst, weight) from each query face to its k nearest active faces within threshold"""
+        n_cells = len(centroids)
+        order = np.argsort(assignment, kind='stable')
+        order = order[active[order]]
+        offsets = np.searchsorted(assignment[order], np.arange(n_cells + 1))
+        probes, _ = top_k_smallest(pairwise_distances(centroids, centroids), min(self.n_probe, n_cells))
+
+        query_cells = np.unique(assignment[queries])
+        src, dst, weight = [], [], []
+        for cell in query_cells:
+            members = order[offsets[cell]:offsets[cell + 1]]
+            cell_queries = members[queries[members]]
+            candidates = np.sort(np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probes[cell]]))
+            if len(cell_queries) == 0 or len(candidates) < 2:
+                continue
+            vectors = np.ascontiguousarray(records['encoding'][candidates])
+            norms = np.einsum('ij,ij->i', vectors, vectors)
+
+            rows = max(1, self.chunk_elements // len(candidates))
+            for start in range(0, len(cell_queries), rows):
+                chunk = cell_queries[start:start + rows]
+                distances = pairwise_distances(records['encoding'][chunk], vectors, norms)
+                # A face is not its own neighbour
+                distances[candidates[None, :] == chunk[:, None]] = np.inf
+                positions, best = top_k_smallest(distances, self.k)
+                keep = best <= self.threshold
+                src.append(np.repeat(chunk, keep.sum(axis=1)))
+                dst.append(candidates[positions[keep]])
+                weight.append(1.0 - best[keep])
+
+        if not src:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate(src), np.concatenate(dst), np.concatenate(weight).astype(np.float32)
+
+    def cluster(self, full=False):
+        """
+        Cluster the faces added since the last run (all faces with full)
+        Returns a dict with the face, newly clustered and cluster counts.
+        """
+        with self._lock('cluster.lock'):
+            records = self.records()
+            total = len(records)
+            labels = self._load_labels()
+            if full:
+                labels = np.where(labels == PROMOTED, PROMOTED, UNASSIGNED)
+            labels = np.concatenate([labels, np.full(total - len(labels), UNASSIGNED, dtype=np.int64)])
+
+            free = labels == UNASSIGNED
+            new_faces = int(free.sum())
+            if new_faces:
+                assignment, centroids = self._cells(records, rebuild=full)
+                src, dst, weight = self._neighbour_graph(records, assignment, centroids, free, labels != PROMOTED)
+                labels[free] = np.flatnonzero(free)
+                propagate_labels(labels, free, src, dst, weight)
+                self._save('labels.npy', labels)
+                self._save('clusters.json', self._summarize(records, labels))
+
+            return {"faces": total, "clustered": new_faces, "clusters": len(self.clusters())}
+
+    def _summarize(self, records, labels):
+        """Listed clusters: size, first/last seen and the faces closest to the cluster mean"""
+        clustered = np.flatnonzero(labels >= 0)
+        order = clustered[np.argsort(labels[clustered], kind='stable')]
+        cluster_ids, starts, sizes = np.unique(labels[order], return_index=True, return_counts=True)
+
+        summary = []
+        for cluster_id, start, size in zip(cluster_ids, starts, sizes):
+            if size < self.min_size:
+                continue
+            members = order[start:start + size]
+            encodings = np.asarray(records['encoding'][members])
+            spread = np.linalg.norm(encodings - encodings.mean(axis=0), axis=1)
+            times = records['time'][members]
+            summary.append({
+                "id": int(cluster_id),
+                "size": int(size),
+                "first_seen": float(times.min()),
+                "last_seen": float(times.max()),
+                "faces": [int(i) for i in members[np.argsort(spread)[:self.representatives]]],
+            })
+        summary.sort(key=lambda c: (-c["size"], c["id"]))
+        return summary
+
+    def clusters(self):
+        """Listed clusters, largest first (re-read only when clusters.json changed)"""
+        path = os.path.join(self.directory, 'clusters.json')
+        if not os.path.exists(path):
+            return []
+        mtime = os.stat(path).st_mtime_ns
+        if self._summary[0] != mtime:
+            self._summary = (mtime, self._load('clusters.json', []))
+        return self._summary[1]
+
+    def promote(self, cluster_id, enroll):
+        """
+        Turn a cluster into a known identity
+
+        enroll receives [(crop JPEG bytes, encoding)] for the cluster's
+        representative faces and adds them to the gallery; the cluster's faces
+        are then retired. Returns (enroll's result, cluster size); raises
+        KeyError for an unknown cluster.
+        """
+        with self._lock('cluster.lock'):
+            cluster = next((c for c in self._load('clusters.json', []) if c["id"] == cluster_id), None)
+            if cluster is None:
+                raise KeyError(cluster_id)
+
+            records = self.records()
+            samples = []
+            for face_id in cluster["faces"]:
+                if os.path.exists(self.crop_path(face_id)):
+                    with open(self.crop_path(face_id), 'rb') as f:
+                        samples.append((f.read(), np.array(records['encoding'][face_id], dtype=np.float64)))
+            if not samples:
+                raise ValueError("No face crops left for this cluster")
+            result = enroll(samples)
+
+            labels = self._load_labels()
+            labels[labels == cluster_id] = PROMOTED
+            self._save('labels.npy', labels)
+            self._save('clusters.json', [c for c in self._load('clusters.json', []) if c["id"] != cluster_id])
+            return result, cluster["size"]
+
+    def watch(self, interval):
+        """Cluster new faces every interval seconds in a daemon thread"""
+        if self._clusterer is not None:
+            return self._clusterer
+
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.cluster()
+                except Exception as e:
+                    print(f"[X] Unknown face clustering failed: {str(e)}")
+
+        self._clusterer = threading.Thread(target=poll, name='unknown-clusterer', daemon=True)
+        self._clusterer.start()
+        return self._clusterer
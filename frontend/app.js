@@ -29,6 +29,7 @@ const downloadBtn = document.getElementById('downloadBtn');
 
 let stream = null;
 let uploadedImageData = null;
+let processedImageId = null;  // lets color changes skip re-running segmentation
 
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
@@ -55,7 +56,7 @@ async function loadKnownFaces() {
         
         if (data.success && data.known_faces.length > 0) {
             knownFacesDiv.innerHTML = data.known_faces
-                .map(name => `<span class="face-tag">${name}</span>`)
+                .map(face => `<span class="face-tag">${face.name}${face.samples > 1 ? ` (${face.samples})` : ''}</span>`)
                 .join('');
         } else {
             knownFacesDiv.innerHTML = '<p class="loading">No known faces loaded yet. Add images to backend/known_faces/</p>';
@@ -188,6 +189,7 @@ function handleFileUpload(event) {
     const reader = new FileReader();
     reader.onload = (e) => {
         uploadedImageData = e.target.result;
+        processedImageId = null;
 
         // Show original image
         originalImage.src = uploadedImageData;
@@ -218,20 +220,41 @@ async function removeBackgroundFromImage() {
         updateBgStatus('Processing... This may take a few seconds', 'processing');
         removeBgBtn.disabled = true;
 
-        const response = await fetch(`${API_URL}/remove-background`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                image: uploadedImageData,
-                backgroundColor: colorPicker.value
-            })
-        });
+        let data = null;
+
+        // Same upload, new color: only re-composite on the server
+        if (processedImageId) {
+            const response = await fetch(`${API_URL}/recolor`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({
+                    imageId: processedImageId,
+                    backgroundColor: colorPicker.value
+                })
+            });
+            data = response.ok ? await response.json() : null;
+        }
 
-        const data = await response.json();
+        if (!data) {
+            const response = await fetch(`${API_URL}/remove-background`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({
+                    image: uploadedImageData,
+                    backgroundColor: colorPicker.value
+                })
+            });
+
+            data = await response.json();
+        }
 
         if (data.success) {
+            processedImageId = data.imageId || null;
+
             // Show processed image
             processedImage.src = data.image;
             processedImage.style.display = 'block';